@@ -31,6 +31,13 @@ pkg_ver = '0.2.2';
 
 cmdclass = {};
 
+# (ansible plugin directory, file in the package, name of the plugin)
+pkg_plugins = [
+    ('plugins/lookup', 'tpmstore.py', pkg_name),
+    ('plugins/callback', 'metrics_callback.py', 'tpmstore_metrics'),
+    ('plugins/vars', 'vars_plugin.py', 'tpmstore_vars'),
+];
+
 
 def pre_build_toolkit():
     print("[INFO] checking whether 'ansible' python package is installed ...");
@@ -40,21 +47,21 @@ def pre_build_toolkit():
         return [];
     print("[INFO] the path to 'ansible' python package is: " + str(ansible_dirs));
     for ansible_dir in ansible_dirs:
-        for suffix in ['.py', '.pyc']:
-            plugin_type = 'plugins/lookup'
-            plugin_file = os.path.join(ansible_dir, plugin_type , pkg_name + suffix);
-            try:
-                os.unlink(plugin_file);
-            except:
-                pass;
-            try:
-                os.remove(plugin_file);
-            except:
-                pass;
-            if os.path.exists(plugin_file):
-                print("[ERROR] 'ansible' python package contains traces '" + pkg_name + "' package ("+ plugin_file +"), failed to delete, aborting!");
-            else:
-                print("[INFO] 'ansible' python package contains traces '" + pkg_name + "' package ("+ plugin_file +"), deleted!");
+        for (plugin_type, _, plugin_name) in pkg_plugins:
+            for suffix in ['.py', '.pyc']:
+                plugin_file = os.path.join(ansible_dir, plugin_type , plugin_name + suffix);
+                try:
+                    os.unlink(plugin_file);
+                except:
+                    pass;
+                try:
+                    os.remove(plugin_file);
+                except:
+                    pass;
+                if os.path.exists(plugin_file):
+                    print("[ERROR] 'ansible' python package contains traces '" + pkg_name + "' package ("+ plugin_file +"), failed to delete, aborting!");
+                else:
+                    print("[INFO] 'ansible' python package contains traces '" + pkg_name + "' package ("+ plugin_file +"), deleted!");
     return ansible_dirs;
 
 def _find_utility(name):
@@ -102,18 +109,19 @@ def _post_build_toolkit(ansible_dirs, plugin_dir=None):
     '''
     _egg_files = [];
     for ansible_dir in ansible_dirs:
-        symlink_target = os.path.join(plugin_dir, 'tpmstore.py');
-        symlink_name = os.path.join(ansible_dir, 'plugins/lookup/tpmstore.py');
-        try:
-            os.symlink(symlink_target, symlink_name);
-            os.chmod(symlink_name, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH);
-            _egg_files.append(symlink_name);
-            _egg_files.append(symlink_name + 'c');
-            print("[INFO] created symlink '" + symlink_name + "' to plugin '" + symlink_target + "'");
-        except:
-            exc_type, exc_value, exc_traceback = sys.exc_info();
-            print('[ERROR] an attempt to create a symlink ' + symlink_name + ' to plugin ' + symlink_target + ' failed, aborting!');
-            print(traceback.format_exception(exc_type, exc_value, exc_traceback));
+        for (plugin_type, plugin_source, plugin_name) in pkg_plugins:
+            symlink_target = os.path.join(plugin_dir, plugin_source);
+            symlink_name = os.path.join(ansible_dir, plugin_type, plugin_name + '.py');
+            try:
+                os.symlink(symlink_target, symlink_name);
+                os.chmod(symlink_name, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH);
+                _egg_files.append(symlink_name);
+                _egg_files.append(symlink_name + 'c');
+                print("[INFO] created symlink '" + symlink_name + "' to plugin '" + symlink_target + "'");
+            except:
+                exc_type, exc_value, exc_traceback = sys.exc_info();
+                print('[ERROR] an attempt to create a symlink ' + symlink_name + ' to plugin ' + symlink_target + ' failed, aborting!');
+                print(traceback.format_exception(exc_type, exc_value, exc_traceback));
     return;
 
 class install_(install):
@@ -165,17 +173,17 @@ class uninstall_(develop):
             print("[ERROR] 'ansible' python package was not found");
             return;
         for ansible_dir in ansible_dirs:
-            for suffix in ['.py', '.pyc']:
-                plugin_type = 'plugins/lookup'
-                plugin_file = os.path.join(ansible_dir, plugin_type , pkg_name + suffix);
-                try:
-                    os.unlink(plugin_file);
-                except:
-                    pass;
-                try:
-                    os.remove(plugin_file);
-                except:
-                    pass;
+            for (plugin_type, _, plugin_name) in pkg_plugins:
+                for suffix in ['.py', '.pyc']:
+                    plugin_file = os.path.join(ansible_dir, plugin_type , plugin_name + suffix);
+                    try:
+                        os.unlink(plugin_file);
+                    except:
+                        pass;
+                    try:
+                        os.remove(plugin_file);
+                    except:
+                        pass;
         return;
 
 
@@ -242,5 +250,11 @@ setup(
     },
     keywords=pkg_keywords,
     install_requires=pkg_requires,
+    entry_points={
+        'console_scripts': [
+            'tpmstore-snapshot = tpmstore.snapshot:main',
+            'tpmstore-agent = tpmstore.agent:main',
+        ],
+    },
     cmdclass=cmdclass
 );
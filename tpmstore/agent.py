@@ -0,0 +1,142 @@
+#
+# tpmstore - TeamPasswordManager lookup plugin for Ansible.
+# Copyright (C) 2017 Andreas Hubert
+# See LICENSE.txt for licensing details
+#
+"""Serve tpmstore lookups of all forks and runs from one long-lived process.
+
+The agent keeps its clients to TeamPasswordManager and its cache across
+lookups. While it listens on the socket in TPMSTORE_AGENT, by default
+~/.ansible/tpmstore-agent.sock, the lookup plugin sends its terms there
+instead of calling TeamPasswordManager itself.
+
+    tpmstore-agent --cache-ttl 300 &
+
+The socket is only accessible by the user running the agent, connections
+of other users are refused where the peer can be checked. Every request is
+one JSON line {"terms": [...], "environ": {...}}, answered by one JSON line
+{"result": [...]} or {"error": "..."}. Lookups writing in their own process
+send {"invalidate": {"scope": [...], "password_id": ...}} so the agent
+forgets the results the write could have changed.
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import argparse
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+
+from ansible.errors import AnsibleError
+from ansible.module_utils.six.moves import socketserver
+from tpmstore import tpmstore
+
+# Seconds results are cached by default, lookups can still set cache_ttl
+AGENT_CACHE_TTL = 300
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        if not self.server.trusted(self.request):
+            return
+        for line in self.rfile:
+            self.wfile.write((json.dumps(self.server.answer(line)) + "\n").encode('utf-8'))
+            self.wfile.flush()
+
+
+class Agent(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server answering lookups with LookupModule.lookup."""
+
+    daemon_threads = True
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                raise AnsibleError("tpmstore-agent is already running on {}".format(self.path))
+            except socket.error:
+                # left over by an agent which did not stop cleanly
+                os.unlink(self.path)
+            finally:
+                probe.close()
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, self.path, AgentHandler)
+        finally:
+            os.umask(umask)
+        os.chmod(self.path, 0o600)
+
+    @staticmethod
+    def trusted(sock):
+        """True if the peer runs as the same user, or can not be checked."""
+        if not hasattr(socket, 'SO_PEERCRED'):
+            return True
+        credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        (_, uid, _) = struct.unpack('3i', credentials)
+        return uid == os.getuid()
+
+    @staticmethod
+    def answer(line):
+        """Run the lookup of one request line, return the answer."""
+        try:
+            request = json.loads(line.decode('utf-8'))
+            if 'invalidate' in request:
+                tpmstore.invalidate_scope(tuple(request['invalidate']['scope']), request['invalidate'].get('password_id'))
+                return {'result': None}
+            environ = dict(os.environ)
+            environ.update(request.get('environ') or {})
+            return {'result': tpmstore.LookupModule().lookup(request['terms'], environ)}
+        except AnsibleError as e:
+            return {'error': str(e)}
+        except Exception as e:
+            return {'error': "{}: {}".format(type(e).__name__, e)}
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve tpmstore lookups of all Ansible forks and runs over a Unix socket.")
+    parser.add_argument('--socket', default=tpmstore.agent_socket() or tpmstore.AGENT_SOCKET,
+                        help="Unix socket to listen on, default TPMSTORE_AGENT or " + tpmstore.AGENT_SOCKET)
+    parser.add_argument('--cache-ttl', type=float, default=float(os.environ.get('TPMSTORE_CACHE_TTL', AGENT_CACHE_TTL)),
+                        help="seconds results are cached if a lookup does not say otherwise")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.environ['TPMSTORE_CACHE_TTL'] = str(args.cache_ttl)
+    tpmstore.AGENT_SERVING = True
+    try:
+        agent = Agent(args.socket)
+    except (AnsibleError, OSError, socket.error) as e:
+        print("[ERROR] {}".format(e), file=sys.stderr)
+        return 1
+    try:
+        # the socket is removed in any case
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print("[INFO] tpmstore-agent listening on {}".format(agent.path))
+        sys.stdout.flush()
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        agent.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
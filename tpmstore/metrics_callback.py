@@ -0,0 +1,41 @@
+#
+# tpmstore - TeamPasswordManager lookup plugin for Ansible.
+# Copyright (C) 2017 Andreas Hubert
+# See LICENSE.txt for licensing details
+#
+# Heavy imports are deferred, see tpmstore.import_tpm()
+from ansible.plugins.callback import CallbackBase
+import os
+"""
+DOCUMENTATION:
+    callback: tpmstore_metrics
+    callback_type: aggregate
+    requirements:
+      - whitelist in configuration
+      - TPMSTORE_METRICS set to a writable path
+    short_description: Prints a summary of the tpmstore lookups at the end of the run.
+    description:
+      - The tpmstore lookup appends one JSON line per lookup to the file in TPMSTORE_METRICS,
+        with timings, round trips, cache hits and payload sizes, but no names or values.
+      - At the end of the playbook this callback prints a table of the lookups of this run.
+"""
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'tpmstore_metrics'
+    CALLBACK_NEEDS_WHITELIST = True
+
+    def v2_playbook_on_stats(self, stats):
+        path = os.environ.get('TPMSTORE_METRICS')
+        if not path:
+            return
+        from tpmstore import tpmstore
+        # forked workers record the playbook process as their run
+        records = tpmstore.read_metrics(path, run=tpmstore.SharedCache.run_id())
+        if not records:
+            return
+        self._display.banner("TPMSTORE LOOKUPS")
+        for line in tpmstore.summarize_metrics(records):
+            self._display.display(line)
@@ -0,0 +1,169 @@
+#
+# tpmstore - TeamPasswordManager lookup plugin for Ansible.
+# Copyright (C) 2017 Andreas Hubert
+# See LICENSE.txt for licensing details
+#
+"""Export entries of TeamPasswordManager into an encrypted snapshot file.
+
+The lookup reads the file with snapshot=<path> or TPMSTORE_SNAPSHOT and
+answers name=, search= and id= lookups without any network call. The file
+is encrypted with the TeamPasswordManager password, which is read from
+TPMSTORE_PASSWORD or prompted for.
+
+    tpmstore-snapshot --url https://tpm.example.com --user ansible --project 4 --search tags:prod tpm.snap
+
+With --update an existing snapshot is synced: the listings are paged
+through again and only entries with a changed updated_on are shown.
+Entries which disappeared are kept as tombstones for TOMBSTONE_TTL seconds.
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import argparse
+import getpass
+import os
+import sys
+import time
+
+from ansible.errors import AnsibleError
+from tpmstore import tpmstore
+
+# Seconds a deleted entry is remembered as deleted
+TOMBSTONE_TTL = 30 * 24 * 3600
+
+
+def list_entries(tpmurl, tpmuser, tpmpass, projects=(), searches=(), reason=None):
+    """Return (listed, searches) of the given projects and searches.
+
+    listed maps IDs to entries as listed, searches maps normalized searches
+    to the IDs they found.
+    """
+    tpmstore.import_tpm()
+    listed = {}
+    found = {}
+    tpmconn = tpmstore.CLIENTS.acquire(tpmurl, tpmuser, tpmpass, reason)
+    try:
+        for project_id in projects:
+            for entry in tpmconn.list_passwords_of_project(project_id):
+                listed[entry['id']] = entry
+        for search in searches:
+            match = tpmconn.list_passwords_search(search)
+            found[tpmstore.normalize_search(search)] = [entry['id'] for entry in match]
+            for entry in match:
+                listed[entry['id']] = entry
+    finally:
+        tpmstore.CLIENTS.release(tpmconn, tpmurl, tpmuser, tpmpass, reason)
+    return (listed, found)
+
+
+def collect(tpmurl, tpmuser, tpmpass, projects=(), searches=(), reason=None, workers=tpmstore.BATCH_WORKERS):
+    """Return (entries, searches) of the given projects and searches.
+
+    entries maps IDs to full entries, searches maps normalized searches to
+    the IDs they found. Entries which can not be shown are left out.
+    """
+    (listed, found) = list_entries(tpmurl, tpmuser, tpmpass, projects, searches, reason)
+    return (show_all(tpmurl, tpmuser, tpmpass, sorted(listed), reason, workers), found)
+
+
+def show_all(tpmurl, tpmuser, tpmpass, ids, reason=None, workers=tpmstore.BATCH_WORKERS):
+    """Show the entries ids concurrently, return a dict of ID to entry."""
+    if not ids:
+        return {}
+
+    def show(password_id):
+        tpmconn = tpmstore.CLIENTS.acquire(tpmurl, tpmuser, tpmpass, reason)
+        try:
+            return (password_id, tpmconn.show_password(password_id))
+        except tpmstore.tpm.TPMException as e:
+            print("[WARNING] skipped entry {}: {}".format(password_id, e), file=sys.stderr)
+            return (password_id, None)
+        finally:
+            tpmstore.CLIENTS.release(tpmconn, tpmurl, tpmuser, tpmpass, reason)
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(workers, len(ids)))
+    try:
+        return dict((password_id, entry) for (password_id, entry) in pool.map(show, ids) if entry is not None)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def export(path, tpmurl, tpmuser, tpmpass, projects=(), searches=(), reason=None, workers=tpmstore.BATCH_WORKERS):
+    """Write the snapshot of projects and searches to path, return the number of entries."""
+    (entries, found) = collect(tpmurl, tpmuser, tpmpass, projects, searches, reason, workers)
+    meta = {'created': time.time(), 'projects': list(projects), 'searches': list(searches)}
+    tpmstore.write_snapshot(path, tpmpass, entries, found, meta)
+    return len(entries)
+
+
+def sync(path, tpmurl, tpmuser, tpmpass, projects=None, searches=None, reason=None, workers=tpmstore.BATCH_WORKERS):
+    """Bring the snapshot at path up to date, return (unchanged, fetched, deleted) numbers of entries.
+
+    projects and searches default to the ones of the snapshot.
+    """
+    snapshot = tpmstore.Snapshot(path, tpmpass)
+    meta = snapshot.meta
+    projects = meta.get('projects', []) if projects is None else projects
+    searches = meta.get('searches', []) if searches is None else searches
+    versions = dict((password_id, updated_on) for (password_id, updated_on) in meta.get('entries', []))
+    (listed, found) = list_entries(tpmurl, tpmuser, tpmpass, projects, searches, reason)
+    entries = {}
+    changed = []
+    for (password_id, entry) in listed.items():
+        updated_on = entry.get('updated_on')
+        if updated_on is not None and versions.get(password_id) == updated_on:
+            entries[password_id] = snapshot.get('password', password_id)
+        else:
+            changed.append(password_id)
+    entries.update(show_all(tpmurl, tpmuser, tpmpass, sorted(changed), reason, workers))
+    now = time.time()
+    tombstones = dict((password_id, deleted) for (password_id, deleted) in meta.get('tombstones', [])
+                      if now - deleted < TOMBSTONE_TTL and password_id not in listed)
+    deleted = [password_id for password_id in versions if password_id not in listed]
+    for password_id in deleted:
+        tombstones[password_id] = now
+    meta = {'created': meta.get('created'), 'synced': now, 'projects': list(projects), 'searches': list(searches),
+            'tombstones': sorted([password_id, time_deleted] for (password_id, time_deleted) in tombstones.items())}
+    tpmstore.write_snapshot(path, tpmpass, entries, found, meta)
+    return (len(listed) - len(changed), len(changed), len(deleted))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export TeamPasswordManager entries into an encrypted snapshot file.")
+    parser.add_argument('path', help="snapshot file to write")
+    parser.add_argument('--url', required=True, help="URL to TeamPasswordManager")
+    parser.add_argument('--user', required=True, help="TeamPasswordManager user")
+    parser.add_argument('--project', type=int, action='append', default=[], help="ID of a project to export, can be repeated")
+    parser.add_argument('--search', action='append', default=[], help="search to export, can be repeated")
+    parser.add_argument('--reason', help="unlock reason for locked entries")
+    parser.add_argument('--workers', type=int, default=tpmstore.BATCH_WORKERS, help="entries shown at the same time")
+    parser.add_argument('--update', action='store_true',
+                        help="sync an existing snapshot, only changed entries are fetched, projects and searches default to the ones of the snapshot")
+    args = parser.parse_args(argv)
+    if not args.project and not args.search and not (args.update and os.path.exists(args.path)):
+        parser.error("at least one --project or --search is required")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # the except clause below needs tpm
+    tpmstore.import_tpm()
+    tpmpass = os.environ.get('TPMSTORE_PASSWORD') or getpass.getpass("TeamPasswordManager password: ")
+    try:
+        if args.update and os.path.exists(args.path):
+            (unchanged, fetched, deleted) = sync(args.path, args.url, args.user, tpmpass, args.project or None,
+                                                 args.search or None, args.reason, args.workers)
+            print("[INFO] synced {}: {} unchanged, {} fetched, {} deleted entries".format(args.path, unchanged, fetched, deleted))
+        else:
+            count = export(args.path, args.url, args.user, tpmpass, args.project, args.search, args.reason, args.workers)
+            print("[INFO] wrote {} entries to {}".format(count, args.path))
+    except (AnsibleError, tpmstore.tpm.TPMException, tpmstore.tpm.TpmApiv4.ConfigError) as e:
+        print("[ERROR] {}".format(e), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+# Make coding more python3-ish
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# Throughput and latency of LookupModule.run against a local TPM stand-in.
+#
+# Runs as part of the tests with small numbers, for real measurements run it
+# directly and scale it with environment variables:
+#
+#   TPMSTORE_BENCH_LOOKUPS=2000 TPMSTORE_BENCH_LATENCY=0.02 PYTHONPATH=. python tpmstore/tests/test_benchmark.py
+
+import os
+import time
+
+from ansible.compat.tests import unittest
+from ansible.compat.tests.mock import patch
+
+from tpmstore.tpmstore import LookupModule
+from tpmstore import tpmstore
+from tpm_server import FakeTpm, TpmServer
+from logging import getLogger
+
+log = getLogger(__name__)
+
+LOOKUPS = int(os.environ.get('TPMSTORE_BENCH_LOOKUPS', 50))
+LATENCY = float(os.environ.get('TPMSTORE_BENCH_LATENCY', 0))
+ENTRIES = int(os.environ.get('TPMSTORE_BENCH_ENTRIES', 200))
+PAGE_SIZE = int(os.environ.get('TPMSTORE_BENCH_PAGE_SIZE', 20))
+
+
+def percentile(durations, fraction):
+    ordered = sorted(durations)
+    return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+
+class BenchResult(object):
+
+    def __init__(self, name, durations, requests):
+        self.name = name
+        self.durations = durations
+        self.requests = requests
+
+    @property
+    def per_second(self):
+        return len(self.durations) / sum(self.durations)
+
+    def __str__(self):
+        return "{:<24} {:>6} lookups {:>9.1f}/s  p50 {:>8.2f}ms  p99 {:>8.2f}ms  {:>6} requests".format(
+            self.name, len(self.durations), self.per_second, percentile(self.durations, 0.5) * 1000,
+            percentile(self.durations, 0.99) * 1000, self.requests)
+
+
+def bench(name, server, terms_list):
+    """Run one lookup per terms in terms_list, return a BenchResult."""
+    lookup = LookupModule()
+    requests = server.tpm.requests
+    durations = []
+    for terms in terms_list:
+        start = time.time()
+        lookup.run([server.url, 'tpmuser', 'tpmpass'] + terms)
+        durations.append(time.time() - start)
+    return BenchResult(name, durations, server.tpm.requests - requests)
+
+
+def reset_plugin():
+    tpmstore.CLIENTS.clear()
+    tpmstore.RESULTS.clear()
+    tpmstore.MISSES.clear()
+    tpmstore.PROJECT_INDEXES.clear()
+
+
+SCENARIOS = [
+    ('single lookups', lambda i: ['name=entry{}'.format(i % ENTRIES + 1)]),
+    ('repeated lookups', lambda i: ['name=entry1']),
+    ('repeated lookups cached', lambda i: ['name=entry1', 'cache_ttl=60']),
+    ('tag searches', lambda i: ['search=tags:entry{}'.format(i % ENTRIES + 1), 'return_value=username']),
+    ('create', lambda i: ['name=new{}-{}'.format(os.getpid(), i), 'create=True', 'project_id=1', 'password=random']),
+    ('update', lambda i: ['name=entry{}'.format(i % ENTRIES + 1), 'create=True', 'password=random']),
+]
+
+
+def run_benchmarks(lookups=LOOKUPS):
+    results = []
+    # measure the plugin, not a tpmstore-agent which might be running
+    with TpmServer(FakeTpm(entries=ENTRIES, page_size=PAGE_SIZE, latency=LATENCY)) as server, \
+            patch.object(tpmstore.display, 'display'), patch.dict(os.environ, {'TPMSTORE_AGENT': ''}):
+        for (name, terms) in SCENARIOS:
+            reset_plugin()
+            results.append(bench(name, server, [terms(i) for i in range(lookups)]))
+    reset_plugin()
+    return results
+
+
+class TestBenchmark(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.results = dict((result.name, result) for result in run_benchmarks())
+        for result in cls.results.values():
+            log.info(str(result))
+
+    def test_all_scenarios_ran(self):
+        for (name, _) in SCENARIOS:
+            self.assertEqual(len(self.results[name].durations), LOOKUPS)
+
+    def test_round_trips(self):
+        # search and show_password
+        self.assertEqual(self.results['single lookups'].requests, 2 * LOOKUPS)
+        # the tag search listing carries the username
+        self.assertEqual(self.results['tag searches'].requests, LOOKUPS)
+        # search, generate_password and create_password
+        self.assertEqual(self.results['create'].requests, 3 * LOOKUPS)
+        # search, show_password, generate_password and update_password
+        self.assertEqual(self.results['update'].requests, 4 * LOOKUPS)
+
+    def test_cache_saves_round_trips(self):
+        self.assertEqual(self.results['repeated lookups cached'].requests, 2)
+
+
+if __name__ == '__main__':
+    for result in run_benchmarks():
+        print(result)
@@ -5,25 +5,87 @@ __metaclass__ = type
 from argparse import ArgumentParser
 
 from ansible.compat.tests import unittest
-from ansible.compat.tests.mock import patch
+from ansible.compat.tests.mock import Mock, patch
 
 from ansible.errors import AnsibleError
 from ansible.module_utils import six
 from tpmstore.tpmstore import LookupModule
+from tpmstore import tpmstore
 from tpm import TpmApiv4
 from tpm import TPMException
 from logging import getLogger
+import json
+import os
+import shutil
 import site
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 from os.path import islink
 
 log = getLogger(__name__)
 
+
+def disable_agent(test):
+    """Keep the lookups of test in this process, even with a tpmstore-agent running."""
+    environ = patch.dict(os.environ, {'TPMSTORE_AGENT': ''})
+    environ.start()
+    test.addCleanup(environ.stop)
+
+
+class TpmServerTestCase(unittest.TestCase):
+    """Runs lookups against a TpmServer with the entries of a FakeTpm."""
+
+    entries = 10
+    page_size = 20
+
+    def setUp(self):
+        disable_agent(self)
+        self.lookup_plugin = LookupModule()
+        tpmstore.CLIENTS.clear()
+        self.addCleanup(tpmstore.CLIENTS.clear)
+        self.server = self.start_server()
+        display = patch.object(tpmstore.display, 'display')
+        self.display_mock = display.start()
+        self.addCleanup(display.stop)
+
+    def start_server(self):
+        """Start a TpmServer stopped after the test, return it."""
+        from tpm_server import FakeTpm, TpmServer
+        server = TpmServer(FakeTpm(entries=self.entries, page_size=self.page_size)).__enter__()
+        self.addCleanup(server.__exit__, None, None, None)
+        return server
+
+    def lookup(self, *terms):
+        return self.lookup_plugin.run([self.server.url, 'tpmuser', 'tpmpass'] + list(terms))
+
+
+class MockedTpmTestCase(unittest.TestCase):
+    """Runs lookups against TpmApiv4 clients whose API methods the tests patch."""
+
+    def setUp(self):
+        disable_agent(self)
+        self.lookup_plugin = LookupModule()
+        patcher = patch('tpm.TpmApiv4.__init__', return_value=None)
+        self.tpm_init_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        tpmstore.CLIENTS.clear()
+        self.addCleanup(tpmstore.CLIENTS.clear)
+        tpmstore.RESULTS.clear()
+        self.addCleanup(tpmstore.RESULTS.clear)
+
+
 class TestPluginQueries(unittest.TestCase):
 
     def setUp(self):
+        disable_agent(self)
         self.lookup_plugin = LookupModule()
         self.patcher = patch('tpm.TpmApiv4.__init__', return_value=None)
         self.tpm_init_mock = self.patcher.start()
+        tpmstore.CLIENTS.clear()
 
     def tearDown(self):
         self.patcher.stop()
@@ -108,6 +170,39 @@ class TestPluginQueries(unittest.TestCase):
         result = self.lookup_plugin.run(plugin_args)
         self.assertEqual(result[0], 'bar')
 
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[{'id': 42, 'username': 'bar', 'name': '1result'}])
+    @patch('tpm.TpmApiv4.show_password', return_value={'id': 42, 'password': 'foobar', 'username': 'bar'})
+    def test_listed_return_value_skips_show(self, mock_show, mock_search):
+        plugin_args = ['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result', 'return_value=username']
+        result = self.lookup_plugin.run(plugin_args)
+        self.assertEqual(result, ['bar'])
+        self.assertEqual(mock_show.call_count, 0)
+
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[{'id': 42, 'username': 'bar', 'notes_snippet': 'n'}])
+    @patch('tpm.TpmApiv4.show_password', return_value={'id': 42, 'password': 'foobar', 'notes': 'notes'})
+    def test_unlisted_return_value_needs_show(self, mock_show, mock_search):
+        for (return_value, expected) in [('password', 'foobar'), ('notes', 'notes')]:
+            plugin_args = ['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result', 'return_value={}'.format(return_value)]
+            self.assertEqual(self.lookup_plugin.run(plugin_args), [expected])
+        self.assertEqual(mock_show.call_count, 2)
+
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[{'id': 42, 'username': 'bar'}])
+    @patch('tpm.TpmApiv4.show_password', return_value={'id': 42, 'password': 'foobar', 'username': 'bar',
+                                                        'access_info': 'ssh://bar@host'})
+    def test_multiple_return_values(self, mock_show, mock_search):
+        plugin_args = ['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result', 'return_value=username, password,access_info']
+        result = self.lookup_plugin.run(plugin_args)
+        self.assertEqual(result, [{'username': 'bar', 'password': 'foobar', 'access_info': 'ssh://bar@host'}])
+        self.assertEqual(mock_show.call_count, 1)
+        result = self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result', 'return_value=*'])
+        self.assertEqual(result, [mock_show.return_value])
+
+    def test_empty_return_value(self):
+        for return_value in ('return_value=', 'return_value=,', 'return_value= , '):
+            with self.assertRaises(AnsibleError) as context:
+                self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result', return_value])
+            self.assertTrue("return_value needs at least one field" in str(context.exception))
+
     @patch('tpm.TpmApiv4.show_password', return_value={'id': 73, 'name': 'A new Entry'})
     @patch('tpm.TpmApiv4.create_password', return_value={'id': 73})
     @patch('tpm.TpmApiv4.generate_password', return_value={'password': 'random secret'})
@@ -186,9 +281,1295 @@ class TestPluginQueries(unittest.TestCase):
         self.assertEqual(mock_update_pass.call_args[0][1].get('email'), email)
 
 
+class TestClientRegistry(MockedTpmTestCase):
+
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[{'id': 42}])
+    @patch('tpm.TpmApiv4.show_password', return_value={'id': 42, 'password': 'foobar'})
+    def test_client_reused_across_lookups(self, mock_show, mock_search):
+        for _ in range(3):
+            result = self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result'])
+            self.assertEqual(result, ['foobar'])
+        self.assertEqual(self.tpm_init_mock.call_count, 1)
+        self.assertEqual(len(tpmstore.CLIENTS), 1)
+
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[{'id': 42}])
+    @patch('tpm.TpmApiv4.show_password', return_value={'id': 42, 'password': 'foobar'})
+    def test_client_not_shared_between_credentials(self, mock_show, mock_search):
+        self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result'])
+        self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'other', 'name=1result'])
+        self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result', 'reason=to unlock'])
+        self.assertEqual(self.tpm_init_mock.call_count, 3)
+
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[{'id': 42}])
+    @patch('tpm.TpmApiv4.show_password', return_value={'id': 42, 'password': 'foobar'})
+    def test_idle_client_evicted(self, mock_show, mock_search):
+        self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result'])
+        with patch('time.time', return_value=time.time() + tpmstore.CLIENT_IDLE_TIMEOUT + 1):
+            self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result'])
+        self.assertEqual(self.tpm_init_mock.call_count, 2)
+
+
+class TestResultCache(MockedTpmTestCase):
+
+    def setUp(self):
+        super(TestResultCache, self).setUp()
+        tpmstore.MISSES.clear()
+        self.addCleanup(tpmstore.MISSES.clear)
+
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[{'id': 42}])
+    @patch('tpm.TpmApiv4.show_password', return_value={'id': 42, 'password': 'foobar'})
+    def test_cached_lookup_skips_api(self, mock_show, mock_search):
+        for search in ['name=1result', 'name=1result', 'search=name:[1result] ']:
+            result = self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', search, 'cache_ttl=60'])
+            self.assertEqual(result, ['foobar'])
+        self.assertEqual(mock_search.call_count, 1)
+        self.assertEqual(mock_show.call_count, 1)
+        self.assertEqual(tpmstore.RESULTS.stats()['hits'], 4)
+
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[{'id': 42}])
+    @patch('tpm.TpmApiv4.show_password', return_value={'id': 42, 'password': 'foobar'})
+    def test_cache_expires(self, mock_show, mock_search):
+        self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result', 'cache_ttl=60'])
+        with patch('time.time', return_value=time.time() + 61):
+            self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result', 'cache_ttl=60'])
+        self.assertEqual(mock_search.call_count, 2)
+
+    def wait_for_refresh(self):
+        deadline = time.time() + 5
+        while tpmstore.REVALIDATING and time.time() < deadline:
+            time.sleep(0.01)
+
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[{'id': 42}])
+    @patch('tpm.TpmApiv4.show_password', return_value={'id': 42, 'password': 'foobar'})
+    def test_stale_while_revalidate(self, mock_show, mock_search):
+        terms = ['name=1result', 'cache_ttl=0.05', 'stale_ttl=60']
+        self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass'] + terms)
+        time.sleep(0.1)
+        mock_show.return_value = {'id': 42, 'password': 'changed'}
+        # the expired value is returned, the refresh runs in the background
+        self.assertEqual(self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass'] + terms), ['foobar'])
+        self.wait_for_refresh()
+        self.assertEqual(mock_show.call_count, 2)
+        self.assertEqual(self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass'] + terms), ['changed'])
+        self.assertEqual(mock_show.call_count, 2)
+
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[{'id': 42}])
+    @patch('tpm.TpmApiv4.show_password', return_value={'id': 42, 'password': 'foobar'})
+    def test_locked_entries_must_be_fresh(self, mock_show, mock_search):
+        terms = ['name=1result', 'cache_ttl=0.05', 'stale_ttl=60', 'reason=deploy']
+        self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass'] + terms)
+        time.sleep(0.1)
+        mock_show.return_value = {'id': 42, 'password': 'changed'}
+        self.assertEqual(self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass'] + terms), ['changed'])
+        self.assertFalse(tpmstore.REVALIDATING)
+
+    def test_stale_values_expire(self):
+        cache = tpmstore.ResultCache()
+        cache.set('key', 'value', 0.05, 0.1)
+        self.assertEqual(cache.lookup('key', stale=True), ('value', False))
+        time.sleep(0.07)
+        self.assertEqual(cache.lookup('key'), (None, False))
+        self.assertEqual(cache.lookup('key', stale=True), ('value', True))
+        time.sleep(0.1)
+        self.assertEqual(cache.lookup('key', stale=True), (None, False))
+        self.assertEqual(len(cache), 0)
+
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[{'id': 42}])
+    @patch('tpm.TpmApiv4.show_password', return_value={'id': 42, 'password': 'foobar'})
+    @patch('tpm.TpmApiv4.update_password')
+    def test_update_invalidates_cache(self, mock_update, mock_show, mock_search):
+        self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result', 'cache_ttl=60'])
+        self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result', 'cache_ttl=60',
+                                'create=True', 'password=new'])
+        self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result', 'cache_ttl=60'])
+        self.assertEqual(mock_update.call_count, 1)
+        self.assertEqual(mock_search.call_count, 2)
+        # the update compares with the current entry, not the cached one
+        self.assertEqual(mock_show.call_count, 3)
+
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[])
+    def test_misses_remembered(self, mock_search):
+        for _ in range(3):
+            with self.assertRaises(AnsibleError) as context:
+                self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=missing', 'negative_ttl=30'])
+            self.assertTrue("Found no match for: missing" in str(context.exception))
+        self.assertEqual(mock_search.call_count, 1)
+
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[])
+    @patch('tpm.TpmApiv4.create_password', return_value={'id': 73})
+    def test_create_forgets_misses(self, mock_create, mock_search):
+        with self.assertRaises(AnsibleError):
+            self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=missing', 'negative_ttl=30'])
+        self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=missing', 'negative_ttl=30',
+                                'create=True', 'project_id=4', 'password=secret'])
+        mock_search.return_value = [{'id': 73}]
+        with patch('tpm.TpmApiv4.show_password', return_value={'id': 73, 'password': 'secret'}):
+            result = self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=missing', 'negative_ttl=30'])
+        self.assertEqual(result, ['secret'])
+        self.assertEqual(mock_search.call_count, 3)
+
+    def test_lru_bound(self):
+        cache = tpmstore.ResultCache(maxsize=2)
+        for key in ['a', 'b', 'c']:
+            cache.set(key, key, 60)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('c'), 'c')
+
+    def test_invalid_ttl_exception(self):
+        exception_error = "cache_ttl has to be a number of seconds and not: soon"
+        with self.assertRaises(AnsibleError) as context:
+            self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result', 'cache_ttl=soon'])
+        self.assertTrue(exception_error in str(context.exception))
+
+
+class TestSharedCache(MockedTpmTestCase):
+
+    def setUp(self):
+        super(TestSharedCache, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'cache', 'tpmstore.db')
+        tpmstore.SHARED_CACHES.clear()
+        self.addCleanup(tpmstore.SHARED_CACHES.clear)
+
+    def lookup(self, tpmpass='tpmass'):
+        # every lookup starts with an empty in-process cache, like a new fork
+        tpmstore.RESULTS.clear()
+        return self.lookup_plugin.run(['https://foo.bar', 'tpmuser', tpmpass, 'name=1result', 'cache_ttl=60',
+                                       'shared_cache={}'.format(self.path)])
+
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[{'id': 42}])
+    @patch('tpm.TpmApiv4.show_password', return_value={'id': 42, 'password': 'foobar'})
+    def test_shared_between_forks(self, mock_show, mock_search):
+        self.assertEqual(self.lookup(), ['foobar'])
+        self.assertEqual(self.lookup(), ['foobar'])
+        self.assertEqual(mock_search.call_count, 1)
+        self.assertEqual(mock_show.call_count, 1)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[{'id': 42}])
+    @patch('tpm.TpmApiv4.show_password', return_value={'id': 42, 'password': 'foobar'})
+    def test_encrypted_at_rest(self, mock_show, mock_search):
+        self.lookup()
+        with open(self.path, 'rb') as f:
+            content = f.read()
+        self.assertFalse(b'foobar' in content)
+        self.assertFalse(b'1result' in content)
+
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[{'id': 42}])
+    @patch('tpm.TpmApiv4.show_password', return_value={'id': 42, 'password': 'foobar'})
+    def test_shared_with_forked_workers(self, mock_show, mock_search):
+        import multiprocessing
+        context = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+        # written by the playbook process, as the vars plugin does
+        self.lookup()
+        queue = context.Queue()
+        worker = context.Process(target=lambda: queue.put((self.lookup(), mock_search.call_count)))
+        worker.start()
+        worker.join(10)
+        self.assertEqual(queue.get(timeout=1), (['foobar'], 1))
+
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[{'id': 42}])
+    @patch('tpm.TpmApiv4.show_password', return_value={'id': 42, 'password': 'foobar'})
+    def test_other_run_can_not_read(self, mock_show, mock_search):
+        self.lookup()
+        with patch.dict(os.environ, {'TPMSTORE_RUN_ID': 'another run'}):
+            tpmstore.SHARED_CACHES.clear()
+            self.lookup()
+        self.lookup(tpmpass='other')
+        self.assertEqual(mock_search.call_count, 3)
+
+
+def search_by_name(search):
+    """Fake search answering name:[entryN] with the entry N."""
+    name = search[len('name:['):-1]
+    if name.startswith('entry'):
+        return [{'id': int(name[len('entry'):])}]
+    return []
+
+
+def show_by_id(password_id):
+    return {'id': password_id, 'password': 'secret{}'.format(password_id)}
+
+
+class TestBatchLookup(MockedTpmTestCase):
+
+    @patch('tpm.TpmApiv4.list_passwords_search', side_effect=search_by_name)
+    @patch('tpm.TpmApiv4.show_password', side_effect=show_by_id)
+    def test_several_names_in_order(self, mock_show, mock_search):
+        result = self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass',
+                                         'name=entry3', 'name=entry1', 'name=entry2', 'name=entry1'])
+        self.assertEqual(result, ['secret3', 'secret1', 'secret2', 'secret1'])
+        # duplicates are only resolved once
+        self.assertEqual(mock_search.call_count, 3)
+
+    @patch('tpm.TpmApiv4.list_passwords_search', side_effect=search_by_name)
+    @patch('tpm.TpmApiv4.show_password', side_effect=show_by_id)
+    def test_list_and_dict_of_names(self, mock_show, mock_search):
+        result = self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', ['entry1', 'entry2']])
+        self.assertEqual(result, ['secret1', 'secret2'])
+        result = self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', {'db': 'entry1', 'web': 'entry2'}])
+        self.assertEqual(result, [{'db': 'secret1', 'web': 'secret2'}])
+
+    @patch('tpm.TpmApiv4.list_passwords_search', side_effect=search_by_name)
+    @patch('tpm.TpmApiv4.show_password', side_effect=show_by_id)
+    def test_dict_of_names_not_mixed(self, mock_show, mock_search):
+        terms = ['https://foo.bar', 'tpmuser', 'tpmass']
+        result = self.lookup_plugin.run(terms + [{'db': 'entry1'}, {'web': 'entry2'}])
+        self.assertEqual(result, [{'db': 'secret1', 'web': 'secret2'}])
+        six.assertRaisesRegex(self, AnsibleError, 'can not be combined with name=', self.lookup_plugin.run,
+                              terms + ['name=entry1', {'db': 'entry2'}])
+        six.assertRaisesRegex(self, AnsibleError, 'can not be combined with name=', self.lookup_plugin.run,
+                              terms + [['entry1'], {'db': 'entry2'}])
+        six.assertRaisesRegex(self, AnsibleError, 'key "db" is given more than once', self.lookup_plugin.run,
+                              terms + [{'db': 'entry1'}, {'db': 'entry2'}])
+        self.assertEqual(mock_show.call_count, 2)
+
+    @patch('tpm.TpmApiv4.list_passwords_search', side_effect=search_by_name)
+    @patch('tpm.TpmApiv4.show_password', side_effect=show_by_id)
+    def test_error_policies(self, mock_show, mock_search):
+        terms = ['https://foo.bar', 'tpmuser', 'tpmass', 'name=entry1', 'name=missing']
+        with self.assertRaises(AnsibleError) as context:
+            self.lookup_plugin.run(terms + ['on_error=strict'])
+        self.assertTrue('Found no match for: missing' in str(context.exception))
+        self.assertEqual(self.lookup_plugin.run(terms + ['on_error=ignore']), ['secret1', None])
+        with patch.object(tpmstore.display, 'warning') as mock_warning:
+            self.assertEqual(self.lookup_plugin.run(terms + ['on_error=warn']), ['secret1', None])
+        self.assertTrue('missing' in mock_warning.call_args[0][0])
+
+    def test_batch_can_not_create(self):
+        exception_error = "create=True can only be used with a single entry."
+        with self.assertRaises(AnsibleError) as context:
+            self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=entry1', 'name=entry2', 'create=True'])
+        self.assertTrue(exception_error in str(context.exception))
+
+
+def project_pages(path):
+    """Fake paged listing of project 4 with 3 pages of 2 entries."""
+    if path == 'projects/4/passwords/count.json':
+        return {'num_items': 6, 'num_pages': 3, 'num_items_per_page': 2}
+    page = int(path.split('/')[-1].split('.')[0])
+    return [{'id': i, 'name': 'entry{}'.format(i), 'username': 'user{}'.format(i)}
+            for i in range(page * 2 - 1, page * 2 + 1)]
+
+
+class TestPrefetchProject(MockedTpmTestCase):
+
+    def setUp(self):
+        super(TestPrefetchProject, self).setUp()
+        tpmstore.PROJECT_INDEXES.clear()
+        self.addCleanup(tpmstore.PROJECT_INDEXES.clear)
+
+    @patch('tpm.TpmApiv4.get', side_effect=project_pages)
+    @patch('tpm.TpmApiv4.list_passwords_search', side_effect=search_by_name)
+    @patch('tpm.TpmApiv4.show_password', side_effect=show_by_id)
+    def test_lookups_answered_from_index(self, mock_show, mock_search, mock_get):
+        for i in range(1, 7):
+            result = self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=entry{}'.format(i),
+                                             'prefetch_project=4', 'return_value=username'])
+            self.assertEqual(result, ['user{}'.format(i)])
+        self.assertEqual(mock_search.call_count, 0)
+        self.assertEqual(mock_show.call_count, 0)
+        # count and 3 pages
+        self.assertEqual(mock_get.call_count, 4)
+        result = self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=entry3', 'prefetch_project=4'])
+        self.assertEqual(result, ['secret3'])
+
+    @patch('tpm.TpmApiv4.get', side_effect=project_pages)
+    @patch('tpm.TpmApiv4.list_passwords_search', side_effect=search_by_name)
+    @patch('tpm.TpmApiv4.show_password', side_effect=show_by_id)
+    def test_name_outside_project_is_searched(self, mock_show, mock_search, mock_get):
+        result = self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=entry42', 'prefetch_project=4'])
+        self.assertEqual(result, ['secret42'])
+        self.assertEqual(mock_search.call_count, 1)
+
+    @patch('tpm.TpmApiv4.get', side_effect=project_pages)
+    @patch('tpm.TpmApiv4.list_passwords_search', side_effect=search_by_name)
+    @patch('tpm.TpmApiv4.show_password', side_effect=show_by_id)
+    def test_loaded_once_with_shared_cache(self, mock_show, mock_search, mock_get):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(tpmstore.SHARED_CACHES.clear)
+        for i in range(1, 7):
+            # every lookup starts without an index, like a new fork
+            tpmstore.PROJECT_INDEXES.clear()
+            tpmstore.SHARED_CACHES.clear()
+            result = self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=entry{}'.format(i),
+                                             'prefetch_project=4', 'return_value=username',
+                                             'shared_cache={}'.format(os.path.join(tmpdir, 'tpmstore.db'))])
+            self.assertEqual(result, ['user{}'.format(i)])
+        self.assertEqual(mock_get.call_count, 4)
+        self.assertEqual(mock_search.call_count, 0)
+
+    def test_only_one_fork_claims_loading(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache = tpmstore.SharedCache(os.path.join(tmpdir, 'tpmstore.db'))
+        th = Mock(tpmurl='https://foo.bar', tpmuser='tpmuser', tpmpass='tpmass', scope='scope', environ={})
+        self.assertTrue(cache.claim(th, 'project-load', '4', 60))
+        self.assertFalse(cache.claim(th, 'project-load', '4', 60))
+        cache.discard(th, 'project-load', '4')
+        self.assertTrue(cache.claim(th, 'project-load', '4', 60))
+
+    @patch('tpm.TpmApiv4.get', side_effect=TPMException("forbidden"))
+    @patch('tpm.TpmApiv4.list_passwords_search', side_effect=search_by_name)
+    @patch('tpm.TpmApiv4.show_password', side_effect=show_by_id)
+    def test_failed_prefetch_falls_back_to_search(self, mock_show, mock_search, mock_get):
+        with patch.object(tpmstore.display, 'warning'):
+            result = self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=entry1', 'prefetch_project=4'])
+        self.assertEqual(result, ['secret1'])
+        self.assertEqual(mock_search.call_count, 1)
+
+
+class TestIdAddressing(MockedTpmTestCase):
+
+    def setUp(self):
+        super(TestIdAddressing, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'ids.json')
+        tpmstore.ID_CACHES.clear()
+        self.addCleanup(tpmstore.ID_CACHES.clear)
+
+    @patch('tpm.TpmApiv4.list_passwords_search')
+    @patch('tpm.TpmApiv4.show_password', side_effect=show_by_id)
+    def test_id_skips_search(self, mock_show, mock_search):
+        result = self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'id=42'])
+        self.assertEqual(result, ['secret42'])
+        self.assertEqual(mock_search.call_count, 0)
+        self.assertEqual(mock_show.call_count, 1)
+
+    def test_invalid_id_exception(self):
+        exception_error = "id has to be a number and not: foo"
+        with self.assertRaises(AnsibleError) as context:
+            self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'id=foo'])
+        self.assertTrue(exception_error in str(context.exception))
+
+    @patch('tpm.TpmApiv4.list_passwords_search', side_effect=search_by_name)
+    @patch('tpm.TpmApiv4.show_password', side_effect=lambda i: dict(show_by_id(i), name='entry{}'.format(i)))
+    def test_id_cache_persists_across_runs(self, mock_show, mock_search):
+        terms = ['https://foo.bar', 'tpmuser', 'tpmass', 'name=entry7', 'id_cache={}'.format(self.path)]
+        self.assertEqual(self.lookup_plugin.run(list(terms)), ['secret7'])
+        # a new run only reads the file
+        tpmstore.ID_CACHES.clear()
+        self.assertEqual(self.lookup_plugin.run(list(terms)), ['secret7'])
+        self.assertEqual(mock_search.call_count, 1)
+        self.assertEqual(mock_show.call_count, 2)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    @patch('tpm.TpmApiv4.list_passwords_search', side_effect=search_by_name)
+    @patch('tpm.TpmApiv4.show_password', side_effect=show_by_id)
+    def test_renamed_entry_searched_again(self, mock_show, mock_search):
+        tpmstore.get_id_cache(self.path).set('https://foo.bar', 'entry7', 99)
+        result = self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=entry7', 'id_cache={}'.format(self.path)])
+        self.assertEqual(result, ['secret7'])
+        self.assertEqual(mock_search.call_count, 1)
+        self.assertEqual(tpmstore.get_id_cache(self.path).get('https://foo.bar', 'entry7'), 7)
+
+
+class TestSingleFlight(MockedTpmTestCase):
+
+    def setUp(self):
+        super(TestSingleFlight, self).setUp()
+        tpmstore.FLIGHTS.coalesced = 0
+
+    def test_concurrent_lookups_coalesced(self):
+        release = threading.Event()
+
+        def slow_search(search):
+            release.wait(5)
+            return [{'id': 42}]
+
+        results = []
+        with patch('tpm.TpmApiv4.list_passwords_search', side_effect=slow_search) as mock_search, \
+                patch('tpm.TpmApiv4.show_password', return_value={'id': 42, 'password': 'foobar'}):
+            threads = [threading.Thread(target=lambda: results.append(self.lookup_plugin.run(
+                ['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result']))) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            # wait until all lookups wait for the first search
+            deadline = time.time() + 5
+            while tpmstore.FLIGHTS.coalesced < 4 and time.time() < deadline:
+                time.sleep(0.01)
+            release.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(results, [['foobar']] * 5)
+        self.assertEqual(mock_search.call_count, 1)
+
+    def test_error_shared_with_waiting_callers(self):
+        flights = tpmstore.SingleFlight()
+        release = threading.Event()
+        errors = []
+
+        def failing():
+            release.wait(5)
+            raise TPMException("down")
+
+        def call():
+            try:
+                flights.do('key', failing)
+            except TPMException as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        deadline = time.time() + 5
+        while flights.coalesced < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 3)
+
+
+class TestMetrics(MockedTpmTestCase):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.records = []
+        tpmstore.add_metrics_hook(self.records.append)
+        self.addCleanup(tpmstore.METRICS_HOOKS.remove, self.records.append)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[{'id': 42}])
+    @patch('tpm.TpmApiv4.show_password', return_value={'id': 42, 'password': 'foobar'})
+    def test_lookup_recorded(self, mock_show, mock_search):
+        self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result', 'cache_ttl=60'])
+        self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result', 'cache_ttl=60'])
+        self.assertEqual([record['lookup'] for record in self.records], ['name', 'name'])
+        self.assertEqual(self.records[0]['round_trips'], 2)
+        self.assertEqual(sorted(self.records[0]['calls']), ['list_passwords_search', 'show_password'])
+        self.assertGreater(self.records[0]['calls']['show_password']['bytes'], 0)
+        self.assertEqual(self.records[1]['round_trips'], 0)
+        self.assertEqual(self.records[1]['cache'], {'memory': 2})
+
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[])
+    def test_failed_lookup_recorded(self, mock_search):
+        self.assertRaises(AnsibleError, self.lookup_plugin.run, ['https://foo.bar', 'tpmuser', 'tpmass', 'name=0result'])
+        self.assertEqual(self.records[0]['error'], 'AnsibleError')
+
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[{'id': 42}])
+    @patch('tpm.TpmApiv4.show_password', return_value={'id': 42, 'password': 'foobar'})
+    def test_jsonl_without_secrets(self, mock_show, mock_search):
+        path = os.path.join(self.tmpdir, 'metrics.jsonl')
+        with patch.dict(os.environ, {'TPMSTORE_METRICS': path, 'TPMSTORE_RUN_ID': 'run1'}):
+            self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result'])
+            self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'id=42'])
+        with open(path) as f:
+            content = f.read()
+        for secret in ('foobar', '1result', 'tpmass', 'tpmuser'):
+            self.assertNotIn(secret, content)
+        records = tpmstore.read_metrics(path, run='run1')
+        self.assertEqual([record['lookup'] for record in records], ['name', 'id'])
+        summary = tpmstore.summarize_metrics(records)
+        self.assertIn('lookups: 2, failed: 0', summary[-2])
+        self.assertTrue(any(line.startswith('show_password ') and ' 2 ' in line for line in summary))
+        self.assertEqual(tpmstore.read_metrics(path, run='run2'), [])
+
+
+class TestProfiling(MockedTpmTestCase):
+
+    def setUp(self):
+        super(TestProfiling, self).setUp()
+        tpmstore.PROFILERS.clear()
+        self.addCleanup(tpmstore.PROFILERS.clear)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    @patch('tpm.TpmApiv4.list_passwords_search', return_value=[{'id': 42}])
+    @patch('tpm.TpmApiv4.show_password', return_value={'id': 42, 'password': 'foobar'})
+    def test_profile_aggregated_per_process(self, mock_show, mock_search):
+        import pstats
+        self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result', 'profile=' + self.tmpdir])
+        with patch.dict(os.environ, {'TPMSTORE_PROFILE': self.tmpdir}):
+            self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result'])
+        prefix = os.path.join(self.tmpdir, 'tpmstore-{}'.format(os.getpid()))
+        stats = pstats.Stats(prefix + '.prof')
+        self.assertEqual([calls[0] for (func, calls) in stats.stats.items() if func[2] == 'initiate_search'], [2])
+        with open(prefix + '.jsonl') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([record['lookup'] for record in records], ['name', 'name'])
+        if sys.version_info >= (3, 4):
+            self.assertGreater(records[0]['peak_bytes'], 0)
+
+    def test_no_profile_by_default(self):
+        self.assertIsNone(tpmstore.get_profiler(['https://foo.bar', 'tpmuser', 'tpmass', 'name=1result']))
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        disable_agent(self)
+        self.lookup_plugin = LookupModule()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'tpm.snap')
+        tpmstore.SNAPSHOTS.clear()
+        entries = {42: {'id': 42, 'name': 'entry42', 'username': 'root', 'password': 'foobar'},
+                   73: {'id': 73, 'name': 'entry73', 'username': 'admin', 'password': 'barfoo'}}
+        tpmstore.write_snapshot(self.path, 'tpmass', entries, {'tags:db': [73]}, {'projects': [4], 'searches': ['tags:db']})
+
+    def tearDown(self):
+        tpmstore.SNAPSHOTS.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def lookup(self, *terms):
+        return self.lookup_plugin.run(['https://foo.bar', 'tpmuser', 'tpmass'] + list(terms))
+
+    @patch('tpm.TpmApiv4.__init__')
+    def test_lookups_without_network(self, mock_init):
+        self.assertEqual(self.lookup('name=entry42', 'snapshot=' + self.path), ['foobar'])
+        self.assertEqual(self.lookup('search=tags:db', 'return_value=username', 'snapshot=' + self.path), ['admin'])
+        with patch.dict(os.environ, {'TPMSTORE_SNAPSHOT': self.path}):
+            self.assertEqual(self.lookup('id=73'), ['barfoo'])
+        self.assertEqual(mock_init.call_count, 0)
+
+    def test_file_is_encrypted(self):
+        with open(self.path, 'rb') as f:
+            content = f.read()
+        for secret in (b'foobar', b'entry42', b'root', b'tags:db'):
+            self.assertNotIn(secret, content)
+        self.assertEqual(oct(os.stat(self.path).st_mode & 0o777), oct(0o600))
+
+    def test_missing_entries(self):
+        six.assertRaisesRegex(self, AnsibleError, 'Found no match', self.lookup, 'name=entry1', 'snapshot=' + self.path)
+        six.assertRaisesRegex(self, AnsibleError, 'not part of the snapshot', self.lookup, 'search=tags:web', 'snapshot=' + self.path)
+        six.assertRaisesRegex(self, AnsibleError, 'not part of the snapshot', self.lookup, 'id=1', 'snapshot=' + self.path)
+
+    def test_wrong_password(self):
+        six.assertRaisesRegex(self, AnsibleError, 'not written with this password', self.lookup_plugin.run,
+                                ['https://foo.bar', 'tpmuser', 'wrong', 'name=entry42', 'snapshot=' + self.path])
+
+    def test_create_refused(self):
+        six.assertRaisesRegex(self, AnsibleError, 'not possible while reading from a snapshot', self.lookup,
+                                'name=entry42', 'create=True', 'password=random', 'snapshot=' + self.path)
+
+    def test_multiple_with_failing_entry(self):
+        entries = {42: {'id': 42, 'name': 'entry42', 'password': 'foobar'}, 73: {'id': 73, 'name': 'entry73', 'password': 'barfoo'}}
+        tpmstore.write_snapshot(self.path, 'tpmass', entries, {'tags:all': [42, 73]}, {})
+        show_password = tpmstore.TermsHost.show_password
+
+        def failing_show(th, password_id, tpmconn=None):
+            if password_id == 42:
+                raise AnsibleError("Entry with ID 42 is not part of the snapshot")
+            return show_password(th, password_id, tpmconn)
+
+        with patch.object(tpmstore.TermsHost, 'show_password', failing_show):
+            self.assertEqual(self.lookup('search=tags:all', 'multiple=True', 'on_error=ignore', 'snapshot=' + self.path),
+                             ['barfoo'])
+            six.assertRaisesRegex(self, AnsibleError, 'ID 42 is not part', self.lookup,
+                                  'search=tags:all', 'multiple=True', 'snapshot=' + self.path)
+
+    def test_export(self):
+        from tpmstore import snapshot
+        from tpm_server import FakeTpm, TpmServer
+        tpmstore.CLIENTS.clear()
+        with TpmServer(FakeTpm(entries=20, projects=2, page_size=5)) as server:
+            count = snapshot.export(self.path, server.url, 'tpmuser', 'tpmpass', projects=[1], searches=['tags:group3'])
+            requests = server.tpm.requests
+            # the even entries of project 1 and entry3 and entry13 of the search
+            self.assertEqual(count, 12)
+            self.assertEqual(self.lookup_plugin.run([server.url, 'tpmuser', 'tpmpass', 'name=entry13', 'snapshot=' + self.path]),
+                             ['secret13'])
+            self.assertEqual(server.tpm.requests, requests)
+        tpmstore.CLIENTS.clear()
+
+    def test_delta_sync(self):
+        from tpmstore import snapshot
+        from tpm_server import FakeTpm, TpmServer
+        tpmstore.CLIENTS.clear()
+        with TpmServer(FakeTpm(entries=20, projects=2, page_size=5)) as server:
+            snapshot.export(self.path, server.url, 'tpmuser', 'tpmpass', projects=[1])
+            server.tpm.passwords[4].update({'password': 'changed', 'updated_on': '2030-01-01 00:00:00'})
+            del server.tpm.passwords[6]
+            requests = server.tpm.requests
+            self.assertEqual(snapshot.sync(self.path, server.url, 'tpmuser', 'tpmpass'), (8, 1, 1))
+            # two pages of the project listing and one show_password
+            self.assertEqual(server.tpm.requests - requests, 3)
+            self.assertEqual(self.lookup_plugin.run([server.url, 'tpmuser', 'tpmpass', 'name=entry4', 'snapshot=' + self.path]),
+                             ['changed'])
+            self.assertEqual(self.lookup_plugin.run([server.url, 'tpmuser', 'tpmpass', 'name=entry8', 'snapshot=' + self.path]),
+                             ['secret8'])
+            six.assertRaisesRegex(self, AnsibleError, 'was deleted', self.lookup_plugin.run,
+                                  [server.url, 'tpmuser', 'tpmpass', 'id=6', 'snapshot=' + self.path])
+            six.assertRaisesRegex(self, AnsibleError, 'Found no match', self.lookup_plugin.run,
+                                  [server.url, 'tpmuser', 'tpmpass', 'name=entry6', 'snapshot=' + self.path])
+            # the tombstone survives the next sync
+            self.assertEqual(snapshot.sync(self.path, server.url, 'tpmuser', 'tpmpass'), (9, 0, 0))
+            six.assertRaisesRegex(self, AnsibleError, 'was deleted', self.lookup_plugin.run,
+                                  [server.url, 'tpmuser', 'tpmpass', 'id=6', 'snapshot=' + self.path])
+        tpmstore.CLIENTS.clear()
+
+    def test_update_with_wrong_password(self):
+        # a fresh process, tpm is not imported yet
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        process = subprocess.Popen([sys.executable, '-m', 'tpmstore.snapshot', '--url', 'http://127.0.0.1:9', '--user', 'tpmuser',
+                                    '--update', self.path], env=dict(os.environ, PYTHONPATH=root, TPMSTORE_PASSWORD='wrong'),
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (_, stderr) = process.communicate()
+        self.assertEqual(process.returncode, 1)
+        # warnings printed on import, e.g. by cryptography, come first
+        self.assertTrue(stderr.decode('utf-8').splitlines()[-1].startswith('[ERROR] '), stderr)
+
+
+class TestKeepAlive(TpmServerTestCase):
+
+    def test_lookups_share_one_connection(self):
+        for i in range(1, 6):
+            self.assertEqual(self.lookup('name=entry{}'.format(i)), ['secret{}'.format(i)])
+        self.assertEqual(self.server.tpm.requests, 10)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_connections_closed_with_client(self):
+        self.lookup('name=entry1')
+        tpmstore.CLIENTS.clear()
+        self.lookup('name=entry2')
+        self.assertEqual(self.server.connections, 2)
+
+    def test_certificates_verified(self):
+        import requests
+        send = requests.Session.request
+        verify = []
+
+        def record_verify(session, *args, **kwargs):
+            verify.append(kwargs.get('verify'))
+            return send(session, *args, **kwargs)
+
+        with patch('requests.Session.request', record_verify):
+            self.lookup('name=entry1')
+        self.assertEqual(verify, [True, True])
+
+    def test_forked_worker_connects_anew(self):
+        self.lookup('name=entry1')
+        with patch('os.getpid', return_value=os.getpid() + 1):
+            self.lookup('name=entry2')
+        self.assertEqual(self.server.connections, 2)
+
+
+class TestUnchangedUpdates(TpmServerTestCase):
+
+    def test_no_write_without_changes(self):
+        updated_on = self.server.tpm.passwords[1]['updated_on'] = '2000-01-01 00:00:00'
+        self.assertEqual(self.lookup('name=entry1', 'create=True', 'password=secret1', 'username=user1',
+                                     'tags=group1, bench,entry1', 'project_id=1'), ['secret1'])
+        # search and show_password only
+        self.assertEqual(self.server.tpm.requests, 2)
+        self.assertEqual(self.server.tpm.passwords[1]['updated_on'], updated_on)
+        self.display_mock.assert_called_with('Entry "entry1" with ID "1" is unchanged')
+
+    def test_write_with_changes(self):
+        self.lookup('name=entry1', 'create=True', 'password=secret1', 'username=root')
+        self.assertEqual(self.server.tpm.requests, 3)
+        self.assertEqual(self.server.tpm.passwords[1]['username'], 'root')
+
+    def test_changed_fields(self):
+        entry = {'name': 'entry', 'password': 'foo', 'notes': None, 'tags': 'a,b', 'project': {'id': 4}}
+        self.assertEqual(tpmstore.changed_fields(entry, {'name': 'entry', 'notes': '', 'tags': 'b, a', 'project_id': '4'}), [])
+        self.assertEqual(sorted(tpmstore.changed_fields(entry, {'password': 'bar', 'tags': 'a', 'project_id': '5'})),
+                         ['password', 'project_id', 'tags'])
+
+
+class TestLocalPasswords(TpmServerTestCase):
+
+    def setUp(self):
+        super(TestLocalPasswords, self).setUp()
+        tpmstore.POLICIES.clear()
+        self.addCleanup(tpmstore.POLICIES.clear)
+
+    def test_no_generate_password_call(self):
+        (password,) = self.lookup('name=entry1', 'create=True', 'password=random', 'password_generator=local',
+                                  'password_length=12', 'password_classes=lower,digits', 'password_exclude=l1o0')
+        self.assertEqual(self.server.tpm.passwords[1]['password'], password)
+        self.assertEqual(len(password), 12)
+        self.assertTrue(all(char in 'abcdefghijkmnpqrstuvwxyz23456789' for char in password))
+        # search, show_password and update_password
+        self.assertEqual(self.server.tpm.requests, 3)
+        self.assertEqual(self.server.tpm.generated, 0)
+
+    def test_exclude_with_equal_sign(self):
+        (password,) = self.lookup('name=entry1', 'create=True', 'password=random', 'password_generator=local',
+                                  'password_length=40', 'password_classes=symbols', 'password_exclude=lIO01=')
+        self.assertEqual(self.server.tpm.passwords[1]['password'], password)
+        self.assertNotIn('=', password)
+
+    def test_policy_inferred_once(self):
+        with patch.dict(os.environ, {'TPMSTORE_PASSWORD_GENERATOR': 'local', 'TPMSTORE_PASSWORD_POLICY': 'tpm'}):
+            passwords = [self.lookup('name=entry{}'.format(i), 'create=True', 'password=random')[0] for i in range(1, 4)]
+        self.assertEqual(self.server.tpm.generated, 1)
+        # like generated1, ten lower case letters and a digit
+        for password in passwords:
+            self.assertEqual(len(password), 10)
+            self.assertTrue(any(char.isdigit() for char in password))
+            self.assertTrue(all(char.islower() or char.isdigit() for char in password))
+
+    def test_every_class_used(self):
+        for _ in range(50):
+            password = tpmstore.generate_local_password(4)
+            for alphabet in tpmstore.PASSWORD_CLASSES.values():
+                self.assertTrue(any(char in alphabet for char in password))
+
+    def test_invalid_policy(self):
+        six.assertRaisesRegex(self, AnsibleError, 'at least 4', tpmstore.generate_local_password, 3)
+        six.assertRaisesRegex(self, AnsibleError, 'can only contain', tpmstore.generate_local_password, 8, ['hex'])
+        six.assertRaisesRegex(self, AnsibleError, 'can only be tpm or local', self.lookup, 'name=entry1',
+                              'password_generator=foo')
+
+
+class TestRequestScheduler(TpmServerTestCase):
+
+    def setUp(self):
+        super(TestRequestScheduler, self).setUp()
+        tpmstore.SCHEDULERS.clear()
+        self.addCleanup(tpmstore.SCHEDULERS.clear)
+        backoff = patch.object(tpmstore, 'BACKOFF', 0.01)
+        backoff.start()
+        self.addCleanup(backoff.stop)
+
+    def test_retries_temporary_failures(self):
+        self.server.tpm.failures = [(503, None), (502, None), (429, {'Retry-After': '0.1'})]
+        start = time.time()
+        self.assertEqual(self.lookup('name=entry1'), ['secret1'])
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        self.assertEqual(self.server.tpm.requests, 5)
+
+    def test_gives_up_after_retries(self):
+        self.server.tpm.failures = [(503, None)] * 3
+        six.assertRaisesRegex(self, AnsibleError, 'HTTP 503', self.lookup, 'name=entry1', 'retries=2')
+        self.assertEqual(self.server.tpm.requests, 3)
+
+    def test_create_only_retried_after_429(self):
+        # search and generate_password pass, create_password is rejected
+        self.server.tpm.failures = [None, None, (429, None)]
+        self.assertEqual(self.lookup('name=new1', 'create=True', 'project_id=1', 'password=random'), ['generated1'])
+        self.assertEqual(self.server.tpm.requests, 4)
+        self.server.tpm.failures = [None, None, (502, None)]
+        six.assertRaisesRegex(self, AnsibleError, 'HTTP 502', self.lookup, 'name=new2', 'create=True', 'project_id=1',
+                              'password=random')
+        self.assertEqual(self.server.tpm.requests, 7)
+        self.assertEqual(len(self.server.tpm.passwords), 11)
+
+    def test_retries_refused_connection(self):
+        import requests
+        send = requests.Session.request
+        calls = []
+
+        def refuse_first(session, *args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                raise requests.exceptions.ConnectionError('Connection refused')
+            return send(session, *args, **kwargs)
+
+        with patch('requests.Session.request', refuse_first):
+            self.assertEqual(self.lookup('name=entry1'), ['secret1'])
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self.server.tpm.requests, 2)
+
+    def test_refused_create_not_retried(self):
+        import requests
+        send = requests.Session.request
+
+        def refuse_post(session, method, *args, **kwargs):
+            if method == 'POST':
+                raise requests.exceptions.ConnectionError('Connection refused')
+            return send(session, method, *args, **kwargs)
+
+        with patch('requests.Session.request', refuse_post):
+            six.assertRaisesRegex(self, AnsibleError, 'Connection error', self.lookup, 'name=new1', 'create=True',
+                                  'project_id=1', 'password=random')
+        self.assertEqual(len(self.server.tpm.passwords), 10)
+
+    def test_rate_limit(self):
+        start = time.time()
+        for _ in range(3):
+            self.lookup('name=entry1', 'rate_limit=5')
+        # 6 requests, a burst of 5 and one waiting for a token
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+    def test_rate_limit_shared_between_forks(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(tpmstore.SHARED_CACHES.clear)
+        shared_cache = 'shared_cache={}'.format(os.path.join(tmpdir, 'tpmstore.db'))
+        start = time.time()
+        for _ in range(3):
+            # every fork starts with a scheduler of its own
+            tpmstore.SCHEDULERS.clear()
+            self.lookup('name=entry1', 'rate_limit=4', shared_cache)
+        # 6 requests, a burst of 4 and two waiting for a token
+        self.assertGreaterEqual(time.time() - start, 0.4)
+
+    def test_in_flight_shared_between_forks(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'tpmstore.db')
+        th = Mock(tpmurl=self.server.url, tpmuser='tpmuser', tpmpass='tpmpass', scope='scope', environ={})
+        first = tpmstore.SharedLimits(tpmstore.SharedCache(path), th, 0, 1)
+        other = tpmstore.SharedLimits(tpmstore.SharedCache(path), th, 0, 1)
+        slot = first.acquire()
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(other.acquire()))
+        thread.daemon = True
+        thread.start()
+        time.sleep(0.2)
+        self.assertEqual(acquired, [])
+        first.release(slot)
+        thread.join(5)
+        self.assertEqual(acquired, [0])
+
+    def test_invalid_rate_limit(self):
+        six.assertRaisesRegex(self, AnsibleError, 'rate_limit has to be a number of requests per second', self.lookup,
+                              'name=entry1', 'rate_limit=fast')
+
+    def test_retry_after_date(self):
+        from email.utils import formatdate
+        response = Mock(headers={'Retry-After': formatdate(time.time() + 10, usegmt=True)})
+        self.assertAlmostEqual(tpmstore.RequestScheduler.retry_after(response), 10, delta=1.5)
+        self.assertEqual(tpmstore.RequestScheduler.retry_after(Mock(headers={})), None)
+
+
+class TestDeferredWrites(TpmServerTestCase):
+
+    def test_writes_deduplicated(self):
+        passwords = [self.lookup('name=entry1', 'create=True', 'password=random', 'username=user{}'.format(i),
+                                 'defer_writes=True') for i in range(3)]
+        self.assertEqual(passwords, [['generated1']] * 3)
+        # only generate_password and the search checking the entry exists so far
+        self.assertEqual(self.server.tpm.requests, 2)
+        self.assertEqual(len(tpmstore.WRITES), 1)
+        # the read applies the write: search, show and update, then search and show of the read
+        self.assertEqual(self.lookup('name=entry1', 'return_value=username,password'),
+                         [{'username': 'user2', 'password': 'generated1'}])
+        self.assertEqual(self.server.tpm.requests, 7)
+        self.assertEqual(len(tpmstore.WRITES), 0)
+
+    def test_results_per_entry(self):
+        with patch.dict(os.environ, {'TPMSTORE_DEFER_WRITES': 'True'}):
+            self.lookup('name=new', 'create=True', 'project_id=1', 'password=secret')
+            self.lookup('name=entry2', 'create=True', 'tags=changed')
+        # the search checking entry2 exists, it has no project_id to be created with
+        self.assertEqual(self.server.tpm.requests, 1)
+        results = tpmstore.WRITES.flush()
+        self.assertEqual(list(results.items()), [('new', (('created', 11), None)), ('entry2', (('updated', 2), None))])
+        self.assertEqual(self.server.tpm.passwords[11]['password'], 'secret')
+        self.assertEqual(self.server.tpm.passwords[2]['tags'], 'changed')
+
+    def test_missing_project_id_raised_when_deferred(self):
+        six.assertRaisesRegex(self, AnsibleError, 'project_id is mandatory', self.lookup, 'name=missing', 'create=True',
+                              'password=secret', 'defer_writes=True')
+        self.assertEqual(len(tpmstore.WRITES), 0)
+
+    def test_failed_write_raised_at_read_back(self):
+        self.lookup('name=entry3', 'create=True', 'password=secret', 'defer_writes=True')
+        # search and show pass, the update is rejected
+        self.server.tpm.failures = [None, None, (403, {})]
+        six.assertRaisesRegex(self, AnsibleError, 'Deferred write of "entry3" failed', self.lookup, 'name=entry3')
+        self.assertEqual(self.server.tpm.passwords[3]['password'], 'secret3')
+
+    def test_write_by_id(self):
+        self.assertEqual(self.lookup('id=2', 'create=True', 'password=by-id', 'defer_writes=True'), ['by-id'])
+        self.assertEqual(self.server.tpm.requests, 0)
+        # show and update, without a search, then the show of the read
+        self.assertEqual(self.lookup('id=2'), ['by-id'])
+        self.assertEqual(self.server.tpm.requests, 3)
+        self.assertEqual(len(tpmstore.WRITES), 0)
+
+    def test_flushed_when_worker_exits(self):
+        import multiprocessing
+        context = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+        worker = context.Process(target=self.lookup, args=('name=entry4', 'create=True', 'password=forked',
+                                                           'defer_writes=True'))
+        worker.start()
+        worker.join(10)
+        self.assertEqual(worker.exitcode, 0)
+        self.assertEqual(self.server.tpm.passwords[4]['password'], 'forked')
+        self.assertEqual(len(tpmstore.WRITES), 0)
+
+    def test_forked_workers_write_one_password(self):
+        import multiprocessing
+        context = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(tpmstore.SHARED_CACHES.clear)
+        shared_cache = 'shared_cache={}'.format(os.path.join(tmpdir, 'tpmstore.db'))
+        queue = context.Queue()
+
+        def worker(username):
+            queue.put(self.lookup('name=entry5', 'create=True', 'password=random', 'username={}'.format(username),
+                                  'defer_writes=True', shared_cache)[0])
+
+        with patch.dict(os.environ, {'TPMSTORE_RUN_ID': 'forked workers'}):
+            workers = [context.Process(target=worker, args=('user{}'.format(i),)) for i in range(3)]
+            for process in workers:
+                process.start()
+            for process in workers:
+                process.join(10)
+                self.assertEqual(process.exitcode, 0)
+            passwords = [queue.get(timeout=1) for _ in workers]
+            self.assertEqual(passwords, [passwords[0]] * 3)
+            self.assertEqual(self.server.tpm.passwords[5]['password'], passwords[0])
+            # a later fork of the run gets the same password
+            self.assertEqual(self.lookup('name=entry5', 'create=True', 'password=random', 'defer_writes=True',
+                                         shared_cache), [passwords[0]])
+            tpmstore.WRITES.flush()
+
+
+class TestVarsPlugin(TpmServerTestCase):
+
+    entries = 20
+
+    def setUp(self):
+        from ansible.inventory.data import InventoryData
+        from ansible.parsing.dataloader import DataLoader
+        from tpmstore import vars_plugin
+        super(TestVarsPlugin, self).setUp()
+        self.vars_plugin = vars_plugin
+        vars_plugin.RESOLVERS.clear()
+        self.addCleanup(vars_plugin.RESOLVERS.clear)
+        self.addCleanup(tpmstore.RESULTS.clear)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.loader = DataLoader()
+        self.inventory = InventoryData()
+        self.inventory.add_group('web')
+        for i in range(1, 6):
+            self.inventory.add_host('entry{}'.format(i), 'web' if i % 2 else None)
+        self.inventory.reconcile_inventory()
+        self.write_config({'tpmurl': self.server.url, 'tpmuser': 'tpmuser', 'tpmpass': 'tpmpass',
+                           'options': {'cache_ttl': 60},
+                           'hosts': {'ansible_password': '{host}',
+                                     'ansible_user': {'name': '{host}', 'return_value': 'username'}},
+                           'groups': {'web': {'web_password': {'search': 'tags:entry3'}}}})
+
+    def write_config(self, config):
+        with open(os.path.join(self.tempdir, 'tpmstore.yml'), 'w') as f:
+            json.dump(config, f)
+
+    def get_vars(self, entity):
+        return self.vars_plugin.VarsModule().get_vars(self.loader, self.tempdir, [entity])
+
+    def test_host_and_group_vars(self):
+        self.assertEqual(self.get_vars(self.inventory.hosts['entry1']),
+                         {'ansible_password': 'secret1', 'ansible_user': 'user1'})
+        self.assertEqual(self.get_vars(self.inventory.groups['web']), {'web_password': 'secret3'})
+        self.assertEqual(self.get_vars(self.inventory.groups['all']), {})
+
+    def test_inventory_resolved_once(self):
+        self.get_vars(self.inventory.hosts['entry1'])
+        # a search and a show per host, the username is in the cached search listing,
+        # the group only searches, its entry is shown for entry3 already
+        self.assertEqual(self.server.tpm.requests, 5 * 2 + 1)
+        for i in range(1, 6):
+            self.assertEqual(self.get_vars(self.inventory.hosts['entry{}'.format(i)])['ansible_password'], 'secret{}'.format(i))
+        self.get_vars(self.inventory.groups['web'])
+        self.assertEqual(self.server.tpm.requests, 5 * 2 + 1)
+
+    def test_added_host_resolved(self):
+        self.get_vars(self.inventory.hosts['entry1'])
+        self.inventory.add_host('entry7')
+        self.inventory.reconcile_inventory()
+        self.assertEqual(self.get_vars(self.inventory.hosts['entry7'])['ansible_user'], 'user7')
+
+    def test_on_error(self):
+        from ansible.parsing.dataloader import DataLoader
+        self.inventory.add_host('unknown')
+        self.inventory.reconcile_inventory()
+        six.assertRaisesRegex(self, AnsibleError, 'name=unknown failed: Found no match for: unknown',
+                              self.get_vars, self.inventory.hosts['entry1'])
+        self.vars_plugin.RESOLVERS.clear()
+        self.loader = DataLoader()
+        self.write_config({'tpmurl': self.server.url, 'tpmuser': 'tpmuser', 'tpmpass': 'tpmpass', 'on_error': 'ignore',
+                           'hosts': {'ansible_password': '{host}'}})
+        self.assertEqual(self.get_vars(self.inventory.hosts['unknown']), {})
+        self.assertEqual(self.get_vars(self.inventory.hosts['entry2']), {'ansible_password': 'secret2'})
+
+    def test_invalid_placeholder(self):
+        self.write_config({'tpmurl': self.server.url, 'tpmuser': 'tpmuser', 'tpmpass': 'tpmpass',
+                           'hosts': {'ansible_password': {'search': 'tags:{group}'}}})
+        six.assertRaisesRegex(self, AnsibleError, "invalid placeholder 'group' in spec .*tags:{group}.*only {host}",
+                              self.get_vars, self.inventory.hosts['entry1'])
+        self.vars_plugin.RESOLVERS.clear()
+        self.assertRaises(AnsibleError, self.vars_plugin.spec_terms, 'entry {}', host='entry1')
+
+    def test_shared_cache_read_by_forked_workers(self):
+        import multiprocessing
+        context = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+        shared_cache = os.path.join(self.tempdir, 'tpmstore.db')
+        self.addCleanup(tpmstore.SHARED_CACHES.clear)
+        self.write_config({'tpmurl': self.server.url, 'tpmuser': 'tpmuser', 'tpmpass': 'tpmpass',
+                           'options': {'cache_ttl': 60, 'shared_cache': shared_cache},
+                           'hosts': {'ansible_password': '{host}'}})
+        # the vars plugin runs in the playbook process
+        self.get_vars(self.inventory.hosts['entry1'])
+        requests = self.server.tpm.requests
+
+        def worker():
+            # a worker of the play, without the caches of the playbook process
+            tpmstore.RESULTS.clear()
+            queue.put(self.lookup('name=entry2', 'cache_ttl=60', 'shared_cache={}'.format(shared_cache)))
+
+        queue = context.Queue()
+        process = context.Process(target=worker)
+        process.start()
+        process.join(10)
+        self.assertEqual(queue.get(timeout=1), ['secret2'])
+        self.assertEqual(self.server.tpm.requests, requests)
+
+    def test_without_config(self):
+        os.remove(os.path.join(self.tempdir, 'tpmstore.yml'))
+        self.assertEqual(self.get_vars(self.inventory.hosts['entry1']), {})
+        self.assertEqual(self.server.tpm.requests, 0)
+
+
+class TestMultipleMatches(TpmServerTestCase):
+
+    entries = 100
+    page_size = 10
+
+    def test_all_matches_in_order(self):
+        self.assertEqual(self.lookup('search=tags:bench', 'multiple=True'), ['secret{}'.format(i) for i in range(1, 101)])
+        # count, 10 pages and a show per entry
+        self.assertEqual(self.server.tpm.requests, 1 + 10 + 100)
+
+    def test_projection_from_listing(self):
+        self.assertEqual(self.lookup('search=tags:group3', 'multiple=True', 'return_value=name,username'),
+                         [{'name': 'entry{}'.format(i), 'username': 'user{}'.format(i)} for i in range(3, 101, 10)])
+        self.assertEqual(self.server.tpm.requests, 1 + 1)
+
+    def test_limit(self):
+        self.assertEqual(self.lookup('search=tags:bench', 'multiple=True', 'limit=15'), ['secret{}'.format(i) for i in range(1, 16)])
+        self.assertEqual(self.server.tpm.requests, 1 + 2 + 15)
+
+    def test_no_match(self):
+        self.assertEqual(self.lookup('search=tags:nothing', 'multiple=True'), [])
+
+    def test_several_matches_without_multiple(self):
+        six.assertRaisesRegex(self, AnsibleError, 'more then one match .*: tags:group3', self.lookup, 'search=tags:group3')
+
+    def test_on_error(self):
+        # count and page, then the first show fails
+        self.server.tpm.failures = [None, None, (404, {})]
+        self.assertEqual(len(self.lookup('search=tags:group3', 'multiple=True', 'on_error=ignore')), 9)
+        self.server.tpm.failures = [None, None, (404, {})]
+        six.assertRaisesRegex(self, AnsibleError, 'tpmstore: ', self.lookup, 'search=tags:group3', 'multiple=True')
+
+
+class TestAgent(TpmServerTestCase):
+
+    def setUp(self):
+        from tpmstore import agent
+        super(TestAgent, self).setUp()
+        tpmstore.RESULTS.clear()
+        self.addCleanup(tpmstore.RESULTS.clear)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'agent.sock')
+        self.agent = agent.Agent(self.path)
+        thread = threading.Thread(target=self.agent.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.agent.server_close)
+        self.addCleanup(self.agent.shutdown)
+        self.records = []
+        tpmstore.add_metrics_hook(self.records.append)
+        self.addCleanup(tpmstore.METRICS_HOOKS.remove, self.records.append)
+        environ = patch.dict(os.environ, {'TPMSTORE_AGENT': self.path})
+        environ.start()
+        self.addCleanup(environ.stop)
+
+    def test_lookup_through_agent(self):
+        with patch.dict(os.environ, {'TPMSTORE_CACHE_TTL': '60'}):
+            self.assertEqual(self.lookup('name=entry1'), ['secret1'])
+            self.assertEqual(self.lookup('name=entry1'), ['secret1'])
+        self.assertEqual(self.server.tpm.requests, 2)
+        self.assertEqual([record['lookup'] for record in self.records if record['pid'] == os.getpid()].count('agent'), 2)
+
+    def test_socket_private(self):
+        import stat
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+
+    def test_errors_raised(self):
+        six.assertRaisesRegex(self, AnsibleError, 'Found no match for: missing', self.lookup, 'name=missing')
+
+    def test_writes_through_agent(self):
+        self.assertEqual(self.lookup('name=entry2', 'create=True', 'password=changed'), ['changed'])
+        self.assertEqual(self.server.tpm.passwords[2]['password'], 'changed')
+
+    def test_deferred_writes_stay_local(self):
+        self.lookup('name=entry3', 'create=True', 'password=later', 'defer_writes=True')
+        self.assertEqual(len(tpmstore.WRITES), 1)
+        tpmstore.WRITES.flush()
+        self.assertEqual(self.server.tpm.passwords[3]['password'], 'later')
+
+    def test_fallback_without_agent(self):
+        self.agent.shutdown()
+        self.agent.server_close()
+        self.assertEqual(self.lookup('name=entry4'), ['secret4'])
+        with patch.dict(os.environ, {'TPMSTORE_AGENT': os.path.join(self.tmpdir, 'missing.sock')}):
+            self.assertEqual(self.lookup('name=entry5'), ['secret5'])
+        self.assertNotIn('agent', [record['lookup'] for record in self.records])
+
+    def start_agent_process(self):
+        """Replace the agent thread by an agent process, return its socket."""
+        self.agent.shutdown()
+        self.agent.server_close()
+        path = os.path.join(self.tmpdir, 'process.sock')
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        env = dict(os.environ, PYTHONPATH=root)
+        process = subprocess.Popen([sys.executable, '-m', 'tpmstore.agent', '--socket', path, '--cache-ttl', '60'],
+                                   env=env, stdout=subprocess.PIPE)
+        self.addCleanup(process.wait)
+        self.addCleanup(process.terminate)
+        process.stdout.readline()
+        process.stdout.close()
+        return path
+
+    def test_cache_shared_across_processes(self):
+        path = self.start_agent_process()
+        with patch.dict(os.environ, {'TPMSTORE_AGENT': path}):
+            for _ in range(3):
+                self.assertEqual(self.lookup('name=entry6'), ['secret6'])
+                tpmstore.RESULTS.clear()
+        self.assertEqual(self.server.tpm.requests, 2)
+
+    def test_deferred_write_invalidates_agent_cache(self):
+        path = self.start_agent_process()
+        with patch.dict(os.environ, {'TPMSTORE_AGENT': path}):
+            self.assertEqual(self.lookup('name=entry3'), ['secret3'])
+            self.lookup('name=entry3', 'create=True', 'password=rotated', 'defer_writes=True')
+            # applied and read back in this process
+            self.assertEqual(self.lookup('name=entry3'), ['rotated'])
+            # read through the agent again
+            self.assertEqual(self.lookup('name=entry3'), ['rotated'])
+        self.assertEqual([record['lookup'] for record in self.records].count('agent'), 2)
+
+    def test_read_back_applies_deferred_writes(self):
+        path = self.start_agent_process()
+        with patch.dict(os.environ, {'TPMSTORE_AGENT': path}):
+            self.lookup('name=entry3', 'create=True', 'password=deferred', 'defer_writes=True')
+            self.assertEqual(self.lookup('name=entry3'), ['deferred'])
+            self.assertEqual(len(tpmstore.WRITES), 0)
+            # nothing pending, reads go to the agent again
+            self.assertEqual(self.lookup('name=entry7'), ['secret7'])
+        self.assertEqual([record['lookup'] for record in self.records].count('agent'), 1)
+
+    def test_agent_process_removes_socket(self):
+        path = self.start_agent_process()
+        self.doCleanups()
+        self.assertFalse(os.path.exists(path))
+
+
+class TestFailover(TpmServerTestCase):
+
+    def setUp(self):
+        super(TestFailover, self).setUp()
+        tpmstore.ENDPOINTS.clear()
+        self.addCleanup(tpmstore.ENDPOINTS.clear)
+        self.primary = self.server
+        self.replica = self.start_server()
+
+    def lookup(self, *terms):
+        return self.lookup_plugin.run(['{},{}'.format(self.primary.url, self.replica.url), 'tpmuser', 'tpmpass',
+                                       'retries=0'] + list(terms))
+
+    def test_read_fails_over(self):
+        self.primary.tpm.failures = [(503, {})]
+        self.assertEqual(self.lookup('name=entry1'), ['secret1'])
+        self.assertEqual(tpmstore.ENDPOINTS[self.primary.url].failures, 1)
+        # the replica is healthy, the failed primary is tried last
+        self.assertEqual(self.lookup('name=entry2'), ['secret2'])
+        self.assertEqual(self.primary.tpm.requests, 1)
+
+    def test_refused_connection_fails_over(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        dead_url = 'http://127.0.0.1:{}'.format(sock.getsockname()[1])
+        sock.close()
+        terms = ['{},{}'.format(dead_url, self.replica.url), 'tpmuser', 'tpmpass', 'retries=0', 'name=entry1']
+        self.assertEqual(self.lookup_plugin.run(terms), ['secret1'])
+        self.assertEqual(tpmstore.ENDPOINTS[dead_url].failures, 1)
+        self.assertEqual(tpmstore.ENDPOINTS[self.replica.url].failures, 0)
+
+    def test_slow_endpoint_fails_over(self):
+        self.primary.tpm.latency = 0.5
+        start = time.time()
+        self.assertEqual(self.lookup('name=entry1', 'timeout=0.1'), ['secret1'])
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(tpmstore.ENDPOINTS[self.primary.url].failures, 1)
+
+    def test_reads_go_to_fastest(self):
+        self.primary.tpm.latency = 0.05
+        for i in range(1, 6):
+            self.assertEqual(self.lookup('name=entry{}'.format(i)), ['secret{}'.format(i)])
+        self.assertEqual(self.primary.tpm.requests, 1)
+        self.assertEqual(self.replica.tpm.requests, 9)
+
+    def test_writes_only_to_primary(self):
+        self.replica.tpm.latency = 0
+        self.primary.tpm.latency = 0.05
+        self.lookup('name=entry1')
+        self.assertEqual(self.lookup('name=entry3', 'create=True', 'password=changed'), ['changed'])
+        self.assertEqual(self.primary.tpm.passwords[3]['password'], 'changed')
+        self.assertEqual(self.replica.tpm.passwords[3]['password'], 'secret3')
+
+    def test_breaker_opens(self):
+        self.primary.tpm.failures = [(503, {})] * 10
+        for _ in range(5):
+            six.assertRaisesRegex(self, AnsibleError, 'HTTP 503|endpoints failed recently',
+                                  self.lookup, 'name=entry4', 'create=True', 'password=changed')
+        self.assertEqual(self.primary.tpm.requests, tpmstore.BREAKER_FAILURES)
+        self.assertEqual(tpmstore.ENDPOINTS[self.primary.url].state(), 'open')
+
+    def test_breaker_half_open(self):
+        self.primary.tpm.failures = [(503, {})] * tpmstore.BREAKER_FAILURES
+        with patch.object(tpmstore, 'BREAKER_COOLDOWN', 0.1):
+            for _ in range(tpmstore.BREAKER_FAILURES):
+                self.assertRaises(AnsibleError, self.lookup, 'name=entry5', 'create=True', 'password=changed')
+            time.sleep(0.15)
+            self.assertEqual(tpmstore.ENDPOINTS[self.primary.url].state(), 'half-open')
+            self.assertEqual(self.lookup('name=entry5', 'create=True', 'password=changed'), ['changed'])
+        self.assertEqual(tpmstore.ENDPOINTS[self.primary.url].state(), 'closed')
+
+
+# Time loading the plugin may take, relative to importing the lookup plugin
+# base of Ansible in the same process. Importing tpm alone takes more.
+IMPORT_TIME_RATIO = 0.25
+IMPORT_TIME_SCRIPT = """
+import sys, time
+start = time.time()
+import ansible.errors, ansible.plugins.lookup
+print(time.time() - start)
+start = time.time()
+import tpmstore.tpmstore
+print(time.time() - start)
+print(",".join(m for m in ('tpm', 'requests', 'cryptography', 'sqlite3', 'multiprocessing.pool') if m in sys.modules))
+"""
+
+
+class TestImportTime(unittest.TestCase):
+
+    def load_plugin(self):
+        """Return the import time of Ansible, of the plugin and the heavy modules it imported."""
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_TIME_SCRIPT]).decode('utf-8').splitlines()
+        return (float(output[0]), float(output[1]), output[2] if len(output) > 2 else '')
+
+    def test_heavy_dependencies_not_imported(self):
+        (_, _, modules) = self.load_plugin()
+        self.assertEqual(modules, '')
+
+    def test_import_time_budget(self):
+        ratio = min(elapsed / baseline for (baseline, elapsed, _) in (self.load_plugin() for _ in range(3)))
+        log.debug("plugin import time: {:.2f} of the Ansible import time".format(ratio))
+        self.assertTrue(ratio < IMPORT_TIME_RATIO,
+                        "loading the plugin took {:.2f} of the Ansible import time, budget is {}".format(ratio, IMPORT_TIME_RATIO))
+
+
 class TestExceptions(unittest.TestCase):
 
     def setUp(self):
+        disable_agent(self)
         self.lookup_plugin = LookupModule()
 
     def test_least_arguments_exception(self):
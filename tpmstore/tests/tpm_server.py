@@ -0,0 +1,213 @@
+# Make coding more python3-ish
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import base64
+import json
+import re
+import threading
+import time
+
+from ansible.module_utils.six.moves import BaseHTTPServer, socketserver
+from ansible.module_utils.six.moves.urllib.parse import unquote_plus
+
+API = '/index.php/api/v4/'
+
+
+class FakeTpm(object):
+    """In-memory TeamPasswordManager data behind the stand-in server.
+
+    Entry i is called "entry<i>", lives in project (i % projects) + 1 and
+    carries the tags "bench", "group<i % 10>" and "entry<i>".
+    """
+
+    def __init__(self, entries=100, projects=1, page_size=20, latency=0.0, user='tpmuser', password='tpmpass'):
+        self.page_size = page_size
+        self.latency = latency
+        self.auth = 'Basic ' + base64.b64encode('{}:{}'.format(user, password).encode('utf-8')).decode('ascii')
+        self.passwords = {}
+        self.requests = 0
+        self.generated = 0
+        # (status, headers) answered instead of the next requests, None to answer normally
+        self.failures = []
+        self._lock = threading.Lock()
+        for i in range(1, entries + 1):
+            self.add({'name': 'entry{}'.format(i), 'project_id': (i % projects) + 1,
+                      'username': 'user{}'.format(i), 'password': 'secret{}'.format(i),
+                      'access_info': 'ssh://user{}@host{}'.format(i, i),
+                      'tags': 'bench,group{},entry{}'.format(i % 10, i)})
+
+    def add(self, data):
+        """Create an entry from API data, return its ID."""
+        with self._lock:
+            password_id = len(self.passwords) + 1
+            self.passwords[password_id] = {'id': password_id, 'project_id': int(data.get('project_id', 1))}
+        self.update(password_id, data)
+        return password_id
+
+    def update(self, password_id, data):
+        entry = self.passwords[password_id]
+        for field in ('name', 'username', 'password', 'access_info', 'tags', 'email', 'expiry_date', 'notes'):
+            if field in data:
+                entry[field] = data[field]
+        entry['updated_on'] = time.strftime('%Y-%m-%d %H:%M:%S')
+
+    def full(self, entry):
+        """Entry as returned by show_password."""
+        result = dict((key, value) for (key, value) in entry.items() if key != 'project_id')
+        result['project'] = {'id': entry['project_id'], 'name': 'project{}'.format(entry['project_id'])}
+        result.setdefault('notes', '')
+        return result
+
+    def listed(self, entry):
+        """Entry as returned in listings, without password and notes."""
+        result = self.full(entry)
+        del result['password']
+        result['notes_snippet'] = result.pop('notes')[:20]
+        return result
+
+    def search(self, searchstring):
+        """Entries matching a TeamPasswordManager search string."""
+        match = re.match(r'^(\w+):\[(.*)\]$', searchstring) or re.match(r'^(\w+):(\S+)$', searchstring)
+        entries = sorted(self.passwords.values(), key=lambda entry: entry['id'])
+        if match is None:
+            return [entry for entry in entries if searchstring in entry.get('name', '')]
+        (field, value) = match.groups()
+        if field == 'name':
+            return [entry for entry in entries if entry.get('name') == value]
+        if field == 'tags':
+            return [entry for entry in entries if value in entry.get('tags', '').split(',')]
+        return [entry for entry in entries if entry.get(field) == value]
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, do not wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200, headers=None):
+        body = b'' if data is None else json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for (key, value) in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_page(self, status, headers=None):
+        """Send a plain text error like a proxy or a throttling TeamPasswordManager."""
+        # the request body must not be left in the kept-alive connection
+        self.read_json()
+        body = 'Error {}'.format(status).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        for (key, value) in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+
+    def paged(self, base, entries, page, count):
+        """Send one page of a listing, with a link to the next page like TeamPasswordManager."""
+        tpm = self.server.tpm
+        num_pages = (len(entries) + tpm.page_size - 1) // tpm.page_size
+        if count:
+            return self.send_json({'num_items': len(entries), 'num_pages': num_pages,
+                                   'num_items_per_page': tpm.page_size})
+        page = page or 1
+        items = [tpm.listed(entry) for entry in entries[(page - 1) * tpm.page_size:page * tpm.page_size]]
+        headers = {}
+        if page < num_pages:
+            headers['Link'] = '<http://{}:{}{}{}/page/{}.json>; rel="next"'.format(
+                self.server.server_address[0], self.server.server_address[1], API, base, page + 1)
+        self.send_json(items, headers=headers)
+
+    def handle_request(self, method):
+        tpm = self.server.tpm
+        with tpm._lock:
+            tpm.requests += 1
+            failure = tpm.failures.pop(0) if tpm.failures else None
+        if failure is not None:
+            return self.send_error_page(*failure)
+        if tpm.latency:
+            time.sleep(tpm.latency)
+        if self.headers.get('Authorization') != tpm.auth:
+            return self.send_json({'error': True, 'message': 'Authentication failed'}, 401)
+        path = self.path[len(API):] if self.path.startswith(API) else self.path
+        path = re.sub(r'\.json$', '', path)
+        listing = re.match(r'^(passwords/search/[^/]+|projects/\d+/passwords|passwords)(?:/page/(\d+)|/(count))?$', path)
+        if method == 'GET' and listing:
+            (base, page, count) = listing.groups()
+            if base.startswith('passwords/search/'):
+                entries = tpm.search(unquote_plus(base[len('passwords/search/'):]))
+            elif base.startswith('projects/'):
+                project_id = int(base.split('/')[1])
+                entries = [entry for entry in tpm.search('') if entry['project_id'] == project_id]
+            else:
+                entries = tpm.search('')
+            return self.paged(base, entries, int(page) if page else None, count)
+        show = re.match(r'^passwords/(\d+)$', path)
+        if show and int(show.group(1)) in tpm.passwords:
+            if method == 'GET':
+                return self.send_json(tpm.full(tpm.passwords[int(show.group(1))]))
+            if method == 'PUT':
+                tpm.update(int(show.group(1)), self.read_json())
+                return self.send_json(None, 204)
+        if method == 'POST' and path == 'passwords':
+            return self.send_json({'id': tpm.add(self.read_json())}, 201)
+        if method == 'GET' and path == 'generate_password':
+            with tpm._lock:
+                tpm.generated += 1
+            return self.send_json({'password': 'generated{}'.format(tpm.generated), 'strength': 'good'})
+        self.send_json({'error': True, 'type': 'Not Found', 'message': 'Not found: {}'.format(path)}, 404)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+
+class TpmServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local stand-in for the TeamPasswordManager v4 API.
+
+    Usage::
+
+        with TpmServer(FakeTpm(entries=1000, latency=0.01)) as server:
+            lookup.run([server.url, 'tpmuser', 'tpmpass', 'name=entry1'])
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, tpm=None, host='127.0.0.1'):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, 0), Handler)
+        self.tpm = tpm or FakeTpm()
+        self.url = 'http://{}:{}'.format(host, self.server_address[1])
+        # TCP connections accepted so far
+        self.connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        socketserver.ThreadingMixIn.process_request(self, request, client_address)
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
@@ -6,9 +6,22 @@
 # File: tpmstore.py
 #
 
+# Heavy imports are deferred, see import_tpm()
 from ansible.errors import AnsibleError, AnsibleParserError
 from ansible.plugins.lookup import LookupBase
-import tpm
+from ansible.module_utils import six
+from ansible.module_utils.six.moves.urllib.parse import quote_plus
+from collections import OrderedDict
+import base64
+import copy
+import hashlib
+import hmac
+import json
+import os
+import random
+import struct
+import threading
+import time
 """
 DOCUMENTATION:
     lookup: tpmstore
@@ -22,6 +35,9 @@ DOCUMENTATION:
         tpmurl:
             description:
                 - URL to TeamPasswordManager API. Should always be first parameter.
+                  Several comma separated URLs, e.g. a primary and read replicas, are used with failover. Reads go to
+                  the endpoint with the lowest average latency and fail over to the others, create=True lookups only
+                  use the first URL, the primary. After 3 failures in a row an endpoint is skipped for 30 seconds.
             required: True
         tpmuser:
             description:
@@ -39,10 +55,16 @@ DOCUMENTATION:
         name:
             description:
                 - Name of the entry in TeamPasswordManager. Will search for exact match.
+                  Can be given several times, or as a list or dict of names, to resolve a batch of entries
+                  concurrently. A batch returns the values in the order of the names, a dict returns a dict
+                  with the same keys. Dicts can only be combined with other dicts with different keys.
             required: If 'search' is not set.
         return_value:
             description:
                 - Which fields from found entries should be returned.
+                  A comma separated list of fields, or '*' for all fields, returns a dict of the fields.
+                  Fields the search listing already carries, like username, name, tags, access_info or email,
+                  are returned without fetching the full entry.
             required: False
             default: password
         create:
@@ -50,12 +72,158 @@ DOCUMENTATION:
                 - If False the plugin will only query for a password.
                   If True it will update an existing entry or create a new entry if it does not exists in TeamPasswordManager,
                   in this case project_id will be required.
+                  An update which would not change any field is skipped and reported as unchanged.
             possible values: True, False
             default: False
         reason:
             description:
                 - If an entry is locked, an unlock reason is mandatory.
+        id:
+            description:
+                - ID of the entry in TeamPasswordManager, the entry is shown without searching for it.
+            required: False
+        id_cache:
+            description:
+                - Path to a file mapping entry names to IDs across runs, lookups by name show the cached ID
+                  without searching. Renamed or deleted entries are searched for again.
+                  Can also be set with the environment variable TPMSTORE_ID_CACHE.
+            required: False
+        prefetch_project:
+            description:
+                - ID of a project to load into a local index once. Lookups by name are answered from the index,
+                  names not in the project are still searched for. The index is kept for 5 minutes.
+                  Each fork keeps its own index, with shared_cache the project is loaded once per run
+                  and stored there, without it every fork loads it unless the lookups run in tpmstore-agent.
+            required: False
+        on_error:
+            description:
+                - What to do if an entry of a batch can not be resolved. strict fails the lookup,
+                  warn and ignore return None for the entry, warn also prints a warning.
+            possible values: strict, warn, ignore
+            default: strict
+        batch_workers:
+            description:
+                - Number of entries of a batch resolved at the same time.
+            default: 8
+        multiple:
+            description:
+                - If True the return_value of every entry matching search or name is returned, in the order of the
+                  listing, instead of failing on more than one match. The pages of the listing are fetched concurrently
+                  and entries are shown batch_workers at a time while further pages arrive. Entries which can not be
+                  shown are handled as given by on_error, warn and ignore leave them out.
+            possible values: True, False
+            default: False
+        limit:
+            description:
+                - Maximum number of matches returned with multiple=True, only the pages needed for them are fetched.
+            default: 0 (all matches)
+        cache_ttl:
+            description:
+                - Seconds to keep search and entry results in an in-process cache. Writes with create=True
+                  invalidate the cached results. Can also be set with the environment variable TPMSTORE_CACHE_TTL.
+            required: False
+            default: 0 (no caching)
+        negative_ttl:
+            description:
+                - Seconds to remember searches that found no match, lookups of missing entries do not search again
+                  meanwhile. Creating an entry with create=True forgets them.
+                  Can also be set with the environment variable TPMSTORE_NEGATIVE_TTL.
+            required: False
+            default: 0 (misses are not remembered)
+        stale_ttl:
+            description:
+                - Seconds an expired cached result is still returned, while it is refreshed in the background.
+                  Not used for create=True and for locked entries looked up with a reason, those are always fetched.
+                  Can also be set with the environment variable TPMSTORE_STALE_TTL.
+            required: False
+            default: 0 (expired results are fetched again right away)
+        shared_cache:
+            description:
+                - Path to an encrypted SQLite file all forks on the controller share as cache, entries live for cache_ttl
+                  seconds, misses for negative_ttl seconds. Entries are only readable by the ansible-playbook process
+                  and its forks, or by processes with the same environment variable TPMSTORE_RUN_ID.
+                  Can also be set with the environment variable TPMSTORE_SHARED_CACHE. Requires the python
+                  'cryptography' package.
+            required: False
+        rate_limit:
+            description:
+                - Requests per second sent to TeamPasswordManager, with bursts of as many requests. With shared_cache
+                  the limit holds for all forks of a run together, without it for each fork, which Ansible starts per
+                  task and host, or for all lookups sent to tpmstore-agent.
+                  Can also be set with the environment variable TPMSTORE_RATE_LIMIT.
+            required: False
+            default: 0 (no limit)
+        max_in_flight:
+            description:
+                - Maximum of requests running at the same time. Holds for all forks of a run with shared_cache,
+                  like rate_limit. Can also be set with the environment variable TPMSTORE_MAX_IN_FLIGHT.
+            required: False
+            default: 0 (no limit)
+        retries:
+            description:
+                - Retries of requests failing with 429 or 5xx or without connection, with jittered exponential backoff
+                  or after the time of a Retry-After header. Creating an entry is only retried after 429.
+                  Can also be set with the environment variable TPMSTORE_RETRIES.
+            required: False
+            default: 3
+        timeout:
+            description:
+                - Seconds to wait for TeamPasswordManager to accept the connection and for each answer. A request
+                  running out of time counts as failed connection, it is retried and fails over to the next URL.
+                  0 waits forever. Can also be set with the environment variable TPMSTORE_TIMEOUT.
+            required: False
+            default: 30
+        snapshot:
+            description:
+                - Path to an encrypted snapshot file written by tpmstore-snapshot. name, search and id lookups are
+                  answered from the file without any call to TeamPasswordManager, create=True is refused.
+                  Only exported searches can be used. The file is encrypted with tpmpass.
+                  Can also be set with the environment variable TPMSTORE_SNAPSHOT. Requires the python 'cryptography' package.
+            required: False
+        profile:
+            description:
+                - Directory to write cProfile stats and tracemalloc peak allocations of the lookups to, aggregated per
+                  fork in tpmstore-<pid>.prof and tpmstore-<pid>.jsonl. Only the thread running the lookup is profiled.
+                  Can also be set with the environment variable TPMSTORE_PROFILE.
+            required: False
     options if create=True:
+        password_generator:
+            description:
+                - Where password=random passwords are generated, tpm asks TeamPasswordManager, local generates
+                  them on the controller without a request. Can also be set with the environment variable TPMSTORE_PASSWORD_GENERATOR.
+            possible values: tpm, local
+            default: tpm
+        password_policy:
+            description:
+                - Policy of local passwords. default uses password_length, password_classes and password_exclude.
+                  tpm infers length and character classes not given from one password generated by TeamPasswordManager,
+                  once per process or, with shared_cache, once per run.
+                  Can also be set with the environment variable TPMSTORE_PASSWORD_POLICY.
+            possible values: default, tpm
+            default: default
+        password_length:
+            description:
+                - Length of local passwords.
+            default: 20
+        password_classes:
+            description:
+                - Comma separated character classes of local passwords, every password has at least one character of each.
+            possible values: lower, upper, digits, symbols
+            default: lower,upper,digits,symbols
+        password_exclude:
+            description:
+                - Characters local passwords must not contain, e.g. lIO01.
+        defer_writes:
+            description:
+                - If True the write is queued and the password to be written is returned right away. Writes to the
+                  same entry are merged, password=random generates one password for all of them. The queued writes
+                  of a process are applied concurrently before its next lookup without defer_writes, or when it exits.
+                  Writes failing at exit are only reported as warnings. An entry without project_id must exist
+                  when the write is queued. Each fork queues its own writes, with shared_cache the writes of all
+                  forks of a run to an entry are merged and get the same password=random password.
+                  Can also be set with the environment variable TPMSTORE_DEFER_WRITES.
+            required: False
+            default: False
         project_id:
             description:
                 - If a complete new entry is created, we need to assign it to an existing project in TeamPasswordManager.
@@ -82,6 +250,14 @@ DOCUMENTATION:
         notes:
             description:
                 - Wil update or set the field "notes" for the TeamPasswordManager entry.
+    notes:
+        - Set the environment variable TPMSTORE_METRICS to a file path to append one JSON line per lookup with
+          its duration, API calls, round trips, cache hits and payload sizes. Names, searches and values are
+          never recorded. The tpmstore_metrics callback plugin prints a summary of them at the end of the run.
+        - While tpmstore-agent listens on the Unix socket in TPMSTORE_AGENT, by default ~/.ansible/tpmstore-agent.sock,
+          lookups are sent to it and answered with its clients and cache, which outlive forks and runs. Lookups fall
+          back to calling TeamPasswordManager directly if no agent is running. Deferred writes and profiled lookups
+          always run in the fork. Set TPMSTORE_AGENT to an empty value to never use the agent.
 EXAMPLES:
   vars_prompt:
     - name: "tpmuser"
@@ -92,11 +268,24 @@ EXAMPLES:
       private: yes
   vars:
      tpmurl:   "https://MyTpmHost.example.com"
+     tpmurls:  "https://MyTpmHost.example.com,https://MyTpmReplica.example.com"
+     with_failover: "{{ lookup('tpmstore', tpmurls, tpmuser, tpmpass, 'name=An existing entry name') }}"
      retrieve_password: "{{ lookup('tpmstore', tpmurl, tpmuser, tpmpass, 'name=An existing entry name') }}"
      retrieve_username: "{{ lookup('tpmstore', tpmurl, tpmuser, tpmpass, 'name=An existing entry name', 'return_value=username')}}"
+     retrieve_credentials: "{{ lookup('tpmstore', tpmurl, tpmuser, tpmpass, 'name=An existing entry name', 'return_value=username,password,access_info')}}"
      search_by_tags: "{{ lookup('tpmstore', tpmurl, tpmuser, tpmpass, 'search=tags:sshhost') }}"
+     all_by_tags: "{{ query('tpmstore', tpmurl, tpmuser, tpmpass, 'search=tags:sshhost', 'multiple=True', 'return_value=name,username', 'limit=500') }}"
+     retrieve_by_id: "{{ lookup('tpmstore', tpmurl, tpmuser, tpmpass, 'id=42') }}"
+     from_prefetched_project: "{{ lookup('tpmstore', tpmurl, tpmuser, tpmpass, 'name=An entry in project 4', 'prefetch_project=4') }}"
+     retrieve_batch: "{{ query('tpmstore', tpmurl, tpmuser, tpmpass, 'name=First entry', 'name=Second entry', 'on_error=warn') }}"
+     retrieve_by_alias: "{{ lookup('tpmstore', tpmurl, tpmuser, tpmpass, {'db': 'Database entry', 'web': 'Webserver entry'}) }}"
      retrieve_locked_password: "{{ lookup('tpmstore', tpmurl, tpmuser, tpmpass, 'name=An existing and locked entry name', 'reason=For Auto Deploy by Ansible') }}"
+     cached_password: "{{ lookup('tpmstore', tpmurl, tpmuser, tpmpass, 'name=An existing entry name', 'cache_ttl=300') }}"
+     shared_cached_password: "{{ lookup('tpmstore', tpmurl, tpmuser, tpmpass, 'name=An existing entry name', 'cache_ttl=300', 'shared_cache=~/.ansible/tmp/tpmstore.db') }}"
+     from_snapshot: "{{ lookup('tpmstore', tpmurl, tpmuser, tpmpass, 'name=An existing entry name', 'snapshot=~/.ansible/tpm.snap') }}"
      newrandom_password: "{{ lookup('tpmstore', tpmurl, tpmuser, tpmpass, 'name=An existing entry name', 'create=True', 'password=random') }}"
+     deferred_password: "{{ lookup('tpmstore', tpmurl, tpmuser, tpmpass, 'name=An existing entry name', 'create=True', 'password=random', 'defer_writes=True') }}"
+     local_random_password: "{{ lookup('tpmstore', tpmurl, tpmuser, tpmpass, 'name=An existing entry name', 'create=True', 'password=random', 'password_generator=local', 'password_length=32', 'password_exclude=lIO01') }}"
      updatemore_values: "{{ lookup('tpmstore', tpmurl, tpmuser, tpmpass, 'name=An existing entry name', 'create=True', 'password=random', 'username=root', 'access_info=ssh://root@host', 'tags=root,ssh,aws,cloud', 'notes=Created by Ansible') }}"
      completenew_entry: "{{ lookup('tpmstore', tpmurl, tpmuser, tpmpass, 'name=An existing entry name', 'create=True', 'project_id=4', 'password=random', 'username=root', 'access_info=ssh://root@host', 'tags=root,ssh,aws,cloud', 'notes=Created by Ansible') }}"
 
@@ -108,44 +297,1986 @@ RETURN:
     type: lists
 """
 
-try:
-    from __main__ import display
-except ImportError:
-    from ansible.utils.display import Display
-    display = Display()
+# Ansible loads lookup, callback and vars plugins in every worker, so the
+# tpmstore plugins only import what they need to be defined. tpm (with
+# requests), cryptography, sqlite3 and the thread pool are imported when a
+# lookup needs them, the Display of Ansible by LazyDisplay.
+tpm = None
+
+
+def import_tpm():
+    """Import the tpm module on first use."""
+    global tpm
+    if tpm is None:
+        import tpm
+    return tpm
+
+
+class LazyDisplay(object):
+    """Stand-in for the Display of Ansible, looked up on first use."""
+
+    _display = None
+
+    def __getattr__(self, name):
+        if LazyDisplay._display is None:
+            try:
+                from __main__ import display
+            except ImportError:
+                from ansible.utils.display import Display
+                display = Display()
+            LazyDisplay._display = display
+        return getattr(LazyDisplay._display, name)
+
+
+display = LazyDisplay()
+
+class LookupMetrics(object):
+    """Timings, round trips and cache hits of one lookup.
+
+    Only names of API calls, durations, sizes and counters are recorded,
+    never a search string, entry name or value.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.calls = {}
+        self.cache = {}
+        self._lock = threading.Lock()
+
+    def call(self, name, seconds, size, error=False):
+        """Record one API call."""
+        with self._lock:
+            call = self.calls.setdefault(name, {'count': 0, 'seconds': 0.0, 'bytes': 0, 'errors': 0})
+            call['count'] += 1
+            call['seconds'] += seconds
+            call['bytes'] += size
+            call['errors'] += int(error)
+
+    def hit(self, source):
+        """Record a result answered without an API call."""
+        with self._lock:
+            self.cache[source] = self.cache.get(source, 0) + 1
+
+    def record(self, lookup, error=None):
+        """Return the metrics as a JSON serializable dict."""
+        with self._lock:
+            return {
+                'time': self.start,
+                'run': SharedCache.run_id(),
+                'pid': os.getpid(),
+                'lookup': lookup,
+                'seconds': time.time() - self.start,
+                'round_trips': sum(call['count'] for call in self.calls.values()),
+                'calls': copy.deepcopy(self.calls),
+                'cache': dict(self.cache),
+                'error': error,
+            }
+
+
+# Callables getting the record of every lookup, see add_metrics_hook
+METRICS_HOOKS = []
+
+
+def add_metrics_hook(hook):
+    """Call hook(record) after every lookup, e.g. from a callback plugin."""
+    METRICS_HOOKS.append(hook)
+
+
+def emit_metrics(record):
+    """Hand a lookup record to the hooks and append it to TPMSTORE_METRICS."""
+    for hook in METRICS_HOOKS:
+        hook(record)
+    path = os.environ.get('TPMSTORE_METRICS')
+    if path:
+        line = (json.dumps(record, sort_keys=True) + "\n").encode('utf-8')
+        # a single write in append mode, lines of parallel forks do not mix
+        fd = os.open(os.path.expanduser(path), os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0o600)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+
+def read_metrics(path, run=None):
+    """Return the records of a TPMSTORE_METRICS file, only of run if given."""
+    records = []
+    try:
+        with open(os.path.expanduser(path)) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if run is None or record.get('run') == run:
+                    records.append(record)
+    except (IOError, OSError):
+        pass
+    return records
+
+
+def summarize_metrics(records):
+    """Return a summary table of lookup records as list of lines."""
+    calls = {}
+    cache = {}
+    for record in records:
+        for (name, call) in record.get('calls', {}).items():
+            total = calls.setdefault(name, {'count': 0, 'seconds': 0.0, 'bytes': 0, 'errors': 0})
+            for field in total:
+                total[field] += call.get(field, 0)
+        for (source, hits) in record.get('cache', {}).items():
+            cache[source] = cache.get(source, 0) + hits
+    lines = ["{:<24} {:>7} {:>10} {:>9} {:>11} {:>7}".format('call', 'count', 'total s', 'avg ms', 'bytes', 'errors')]
+    for (name, call) in sorted(calls.items()):
+        lines.append("{:<24} {:>7} {:>10.3f} {:>9.2f} {:>11} {:>7}".format(
+            name, call['count'], call['seconds'], call['seconds'] / call['count'] * 1000, call['bytes'], call['errors']))
+    lookup_seconds = sum(record.get('seconds', 0) for record in records)
+    lines.append("lookups: {}, failed: {}, lookup time: {:.3f}s, round trips: {}".format(
+        len(records), len([record for record in records if record.get('error')]), lookup_seconds,
+        sum(call['count'] for call in calls.values())))
+    lines.append("cache hits: {}".format(", ".join("{} {}".format(source, hits) for (source, hits) in sorted(cache.items()))
+                                         or "none"))
+    return lines
+
+
+class LookupProfiler(object):
+    """cProfile and tracemalloc around the lookups of one process.
+
+    The cProfile stats of all lookups of the process are aggregated in
+    tpmstore-<pid>.prof, every lookup appends its duration, peak allocation
+    and top allocation sites to tpmstore-<pid>.jsonl.
+    """
+
+    TOP_ALLOCATIONS = 5
+
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+        self.stats = None
+        self._busy = threading.Lock()
+        self._profile = None
+        self._tracing = False
+        self._start = None
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o700)
+
+    def path(self, suffix):
+        return os.path.join(self.directory, 'tpmstore-{}.{}'.format(os.getpid(), suffix))
+
+    def start(self):
+        """Start profiling, False if another lookup of the process is profiled already."""
+        # cProfile only sees the calling thread, concurrent lookups are not profiled
+        if not self._busy.acquire(False):
+            return False
+        import cProfile
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+        self._tracing = tracemalloc is not None and not tracemalloc.is_tracing()
+        if self._tracing:
+            tracemalloc.start()
+        self._profile = cProfile.Profile()
+        self._start = time.time()
+        self._profile.enable()
+        return True
+
+    def stop(self, lookup):
+        """Stop profiling and write the results of the lookup."""
+        self._profile.disable()
+        try:
+            import pstats
+            record = {'time': self._start, 'pid': os.getpid(), 'lookup': lookup,
+                      'seconds': time.time() - self._start}
+            if self._tracing:
+                import tracemalloc
+                record['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                record['top_allocations'] = [
+                    {'site': str(stat.traceback), 'bytes': stat.size, 'count': stat.count}
+                    for stat in tracemalloc.take_snapshot().statistics('lineno')[:self.TOP_ALLOCATIONS]]
+                tracemalloc.stop()
+            if self.stats is None:
+                self.stats = pstats.Stats(self._profile)
+            else:
+                self.stats.add(self._profile)
+            self.stats.dump_stats(self.path('prof'))
+            with open(self.path('jsonl'), 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+        finally:
+            self._profile = None
+            self._busy.release()
+
+
+PROFILERS = {}
+
+
+def get_profiler(terms):
+    """Return the profiler of the process if profiling is asked for, else None."""
+    directory = os.environ.get('TPMSTORE_PROFILE')
+    for term in terms:
+        if isinstance(term, six.string_types) and term.startswith('profile='):
+            directory = term[len('profile='):]
+    if not directory:
+        return None
+    # forked workers get their own profiler
+    key = (directory, os.getpid())
+    if key not in PROFILERS:
+        PROFILERS[key] = LookupProfiler(directory)
+    return PROFILERS[key]
+
+
+# Default requests per second to TeamPasswordManager, 0 for no limit
+RATE_LIMIT = 0
+# Default maximum of requests at the same time, 0 for no limit
+MAX_IN_FLIGHT = 0
+# Default retries of failed requests
+RETRIES = 3
+# Seconds of the first backoff, doubled for every retry up to MAX_BACKOFF
+BACKOFF = 0.5
+MAX_BACKOFF = 30
+# Statuses worth a retry, 429 means the request was not processed at all
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Calls which can be repeated without changing the result
+IDEMPOTENT_CALLS = ('get', 'list_passwords_search', 'list_passwords_of_project', 'show_password',
+                    'generate_password', 'update_password')
+
+
+def connection_failed(tpmconn, error):
+    """True if error means no response came back, the connection was refused, dropped or timed out."""
+    if tpmconn.req is not None or not isinstance(error, tpm.TPMException):
+        return False
+    # tpm raises inside its except clause without chaining, and py2 keeps
+    # no __context__, so fall back on the message tpm gives these errors.
+    import requests
+    return (isinstance(getattr(error, '__context__', None), requests.exceptions.RequestException) or
+            str(error).startswith('Connection error for '))
+
+
+class RequestScheduler(object):
+    """Rate limit, concurrency cap and retries for TeamPasswordManager calls.
+
+    A token bucket lets rate requests per second pass, a semaphore caps the
+    requests in flight. Both only hold for this process, calls given
+    SharedLimits are limited together with the other forks instead. Failed
+    calls are retried with jittered exponential backoff, or after the time
+    a Retry-After header asks for, which pauses all calls of the scheduler.
+    Calls which are not idempotent are only retried if the server rejected
+    them with 429.
+    """
+
+    def __init__(self, rate=RATE_LIMIT, max_in_flight=MAX_IN_FLIGHT):
+        self.rate = float(rate)
+        self.tokens = max(self.rate, 1.0)
+        self.paused_until = 0
+        self.retried = 0
+        self._refilled = time.time()
+        self._lock = threading.Lock()
+        self._in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight > 0 else None
+
+    def wait(self, shared=None):
+        """Block until the server may be called again."""
+        while True:
+            with self._lock:
+                now = time.time()
+                delay = self.paused_until - now
+                if delay <= 0 and (self.rate <= 0 or shared is not None):
+                    break
+                if delay <= 0:
+                    self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self._refilled) * self.rate)
+                    self._refilled = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+        if shared is not None:
+            shared.wait()
+
+    def call(self, tpmconn, fn, idempotent, retries=RETRIES, shared=None):
+        """Return fn(), retry it if tpmconn.req shows a temporary failure.
+
+        With shared, the rate and the requests in flight are limited
+        together with the other forks of the run instead of in this process.
+        """
+        attempt = 0
+        while True:
+            self.wait(shared)
+            slot = None
+            if shared is not None:
+                slot = shared.acquire()
+            elif self._in_flight is not None:
+                self._in_flight.acquire()
+            # tells responses of this call from earlier ones
+            tpmconn.req = None
+            try:
+                return fn()
+            except (tpm.TPMException, ValueError) as e:
+                delay = self.retry_delay(tpmconn, e, idempotent, attempt, retries)
+                if delay is None:
+                    status = getattr(tpmconn.req, 'status_code', None)
+                    if isinstance(e, ValueError) and status is not None:
+                        # tpm fails to decode error pages
+                        raise tpm.TPMException("HTTP {} from TeamPasswordManager".format(status))
+                    raise
+            finally:
+                if shared is not None:
+                    shared.release(slot)
+                elif self._in_flight is not None:
+                    self._in_flight.release()
+            attempt += 1
+            with self._lock:
+                self.retried += 1
+            display.vvv("tpmstore: retry {} of {} in {:.2f}s".format(attempt, retries, delay))
+            time.sleep(delay)
+
+    def retry_delay(self, tpmconn, error, idempotent, attempt, retries):
+        """Return seconds to wait before the next attempt, None to give up."""
+        if attempt >= retries:
+            return None
+        response = tpmconn.req
+        if response is None:
+            # no response at all, only retry connection failures
+            if not idempotent or not connection_failed(tpmconn, error):
+                return None
+        elif response.status_code not in RETRY_STATUSES or (not idempotent and response.status_code != 429):
+            return None
+        backoff = min(MAX_BACKOFF, BACKOFF * 2 ** attempt)
+        delay = random.uniform(backoff / 2, backoff)
+        retry_after = self.retry_after(response)
+        if retry_after is not None:
+            delay = retry_after
+            with self._lock:
+                self.paused_until = max(self.paused_until, time.time() + delay)
+        return delay
+
+    @staticmethod
+    def retry_after(response):
+        """Seconds of the Retry-After header of response, None if there is none."""
+        value = response.headers.get('Retry-After') if response is not None else None
+        if not value:
+            return None
+        try:
+            return min(MAX_BACKOFF, max(0.0, float(value)))
+        except ValueError:
+            from email.utils import parsedate_tz, mktime_tz
+            date = parsedate_tz(value)
+            if date is None:
+                return None
+            return min(MAX_BACKOFF, max(0.0, mktime_tz(date) - time.time()))
+
+
+SCHEDULERS = {}
+SCHEDULERS_LOCK = threading.Lock()
+
+
+def get_scheduler(tpmurl, rate, max_in_flight):
+    """Return the scheduler of tpmurl with these limits, one per process."""
+    key = (tpmurl, rate, max_in_flight)
+    with SCHEDULERS_LOCK:
+        if key not in SCHEDULERS:
+            SCHEDULERS[key] = RequestScheduler(rate, max_in_flight)
+        return SCHEDULERS[key]
+
+
+# Seconds an unused client stays in the pool before it gets closed
+CLIENT_IDLE_TIMEOUT = 300
+# Maximum of idle clients kept per (tpmurl, tpmuser, reason)
+CLIENT_POOL_SIZE = 8
+# Maximum of keep-alive connections per client session
+CONNECTION_POOL_SIZE = 10
+
+
+PooledTpmApiv4 = None
+
+
+def pooled_client_class():
+    """Return the client class of the pool, defined once tpm is imported."""
+    global PooledTpmApiv4
+    if PooledTpmApiv4 is not None:
+        return PooledTpmApiv4
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    class PooledTpmApiv4(tpm.TpmApiv4):
+        """TpmApiv4 sending its requests over a keep-alive session with a timeout.
+
+        tpm 5 keeps a session per client, older versions call requests.get
+        and friends, which connect anew for every request. The session keeps
+        up to CONNECTION_POOL_SIZE connections open, so later requests and
+        lookups skip the TCP and TLS handshake. Certificates are verified
+        unless tpm was told otherwise.
+        """
+
+        def __init__(self, url, **kwargs):
+            super(PooledTpmApiv4, self).__init__(url, **kwargs)
+            self.req = None
+            # seconds to wait for a connection and for each response, None waits forever
+            self.timeout = None
+            if getattr(self, 'session', None) is None:
+                self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=CONNECTION_POOL_SIZE)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+
+        def request(self, path, action, data=''):
+            """Send a request like TpmApi.request does, on the session."""
+            if path.startswith(self.base_url):
+                path = quote_plus(path[len(self.base_url):], safe='/')
+            if not path.startswith(self.api):
+                path = self.api + path
+            url = self.base_url + path
+            headers = dict(self.headers)
+            if self.unlock_reason:
+                headers['X-Unlock-Reason'] = self.unlock_reason
+            try:
+                self.req = self.session.request(action.upper(), url, headers=headers, auth=(self.username, self.password),
+                                                data=json.dumps(data) if data else None,
+                                                verify=getattr(self, 'verify', True), timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                raise tpm.TPMException("Connection error for " + str(e))
+            if self.req.content == b'':
+                return None
+            try:
+                result = self.req.json()
+            except ValueError as e:
+                if self.req.status_code == 403:
+                    raise tpm.TPMException(url + " forbidden")
+                if self.req.status_code == 404:
+                    raise tpm.TPMException(url + " not found")
+                raise ValueError('{}: {} {}'.format(e, self.req.url, self.req.text))
+            if isinstance(result, dict) and result.get('error'):
+                raise tpm.TPMException(result['message'])
+            return result
+
+    return PooledTpmApiv4
+
+
+class ClientRegistry(object):
+    """Process wide pool of authenticated TeamPasswordManager clients.
+
+    Clients are keyed by URL, user, password and unlock reason, so a lookup
+    only ever gets a client authenticated with its own credentials. A client
+    is handed out to one lookup at a time and returned afterwards, idle
+    clients are closed after CLIENT_IDLE_TIMEOUT seconds.
+    """
+
+    def __init__(self, idle_timeout=CLIENT_IDLE_TIMEOUT, pool_size=CLIENT_POOL_SIZE):
+        self.idle_timeout = idle_timeout
+        self.pool_size = pool_size
+        self._idle = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(tpmurl, tpmuser, tpmpass, unlock_reason=None):
+        """Return the pool key, the password is only kept as a hash."""
+        digest = hashlib.sha256(str(tpmpass).encode('utf-8')).hexdigest()
+        return (tpmurl, tpmuser, digest, unlock_reason)
+
+    def acquire(self, tpmurl, tpmuser, tpmpass, unlock_reason=None):
+        """Return a warm client or create a new one."""
+        key = self.key(tpmurl, tpmuser, tpmpass, unlock_reason)
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked workers must not talk over the connections of their parent
+                self._idle = {}
+                self._pid = os.getpid()
+            self._evict_idle(time.time())
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()[1]
+        client_class = pooled_client_class()
+        if unlock_reason is not None:
+            return client_class(tpmurl, username=tpmuser, password=tpmpass, unlock_reason=unlock_reason)
+        return client_class(tpmurl, username=tpmuser, password=tpmpass)
+
+    def release(self, client, tpmurl, tpmuser, tpmpass, unlock_reason=None):
+        """Give a client back to the pool for later lookups.
+
+        Clients failing a call are not given back, their connection may be
+        broken, they are dropped and a later lookup creates a new one.
+        """
+        key = self.key(tpmurl, tpmuser, tpmpass, unlock_reason)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append((time.time(), client))
+                return
+        self._close(client)
+
+    def clear(self):
+        """Close and forget all idle clients."""
+        with self._lock:
+            clients = [client for idle in self._idle.values() for (_, client) in idle]
+            self._idle = {}
+        for client in clients:
+            self._close(client)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(idle) for idle in self._idle.values())
+
+    def _evict_idle(self, now):
+        for key in list(self._idle):
+            fresh = [(used, client) for (used, client) in self._idle[key] if now - used < self.idle_timeout]
+            for (used, client) in self._idle[key]:
+                if now - used >= self.idle_timeout:
+                    self._close(client)
+            if fresh:
+                self._idle[key] = fresh
+            else:
+                del self._idle[key]
+
+    @staticmethod
+    def _close(client):
+        session = getattr(client, 'session', None)
+        if session is not None:
+            session.close()
+
+
+CLIENTS = ClientRegistry()
+
+# Failures in a row after which an endpoint is skipped
+BREAKER_FAILURES = 3
+# Seconds a failing endpoint is skipped before one call may try it again
+BREAKER_COOLDOWN = 30
+# Weight of the latest call in the average latency of an endpoint
+LATENCY_WEIGHT = 0.3
+# Default seconds to wait for an endpoint to connect and to answer, 0 waits forever
+TIMEOUT = 30
+
+
+class EndpointHealth(object):
+    """Average latency and circuit breaker of one TeamPasswordManager URL.
+
+    After BREAKER_FAILURES failures in a row the breaker opens and the
+    endpoint is skipped for BREAKER_COOLDOWN seconds. Then one call may
+    try it again, a success closes the breaker, a failure opens it again.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.latency = None
+        self.failures = 0
+        self.open_until = 0
+        self._lock = threading.Lock()
+
+    def state(self):
+        """Return closed, open or half-open."""
+        with self._lock:
+            if self.failures < BREAKER_FAILURES:
+                return 'closed'
+            return 'open' if time.time() < self.open_until else 'half-open'
+
+    def probe(self):
+        """Claim the one call trying a half-open endpoint, False if another call has it."""
+        with self._lock:
+            now = time.time()
+            if now < self.open_until:
+                return False
+            self.open_until = now + BREAKER_COOLDOWN
+            return True
+
+    def succeeded(self, seconds):
+        with self._lock:
+            self.failures = 0
+            self.open_until = 0
+            if self.latency is None:
+                self.latency = seconds
+            else:
+                self.latency = LATENCY_WEIGHT * seconds + (1 - LATENCY_WEIGHT) * self.latency
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= BREAKER_FAILURES:
+                self.open_until = time.time() + BREAKER_COOLDOWN
+
+
+ENDPOINTS = {}
+ENDPOINTS_LOCK = threading.Lock()
+
+
+def get_endpoint(url):
+    """Return the health of url, shared by all lookups of the process."""
+    with ENDPOINTS_LOCK:
+        if url not in ENDPOINTS:
+            ENDPOINTS[url] = EndpointHealth(url)
+        return ENDPOINTS[url]
+
+
+def endpoint_failed(client, error):
+    """True if error means the endpoint is unreachable, slow or failing, not that the request is wrong."""
+    if client.req is None:
+        return connection_failed(client, error)
+    return client.req.status_code in RETRY_STATUSES
+
+
+class FailoverClient(object):
+    """Stand-in for the client of one URL, spreading the calls over several URLs.
+
+    Calls go to the endpoint with the fewest recent failures and the lowest
+    average latency, a half-open endpoint is tried first once its cooldown
+    is over. An endpoint failing a call is skipped for the next one. With
+    write set, only the first URL, the primary, is used.
+    """
+
+    def __init__(self, tpmurls, tpmuser, tpmpass, unlock_reason=None, write=False, timeout=None):
+        self.tpmurls = tpmurls[:1] if write else tpmurls
+        self.credentials = (tpmuser, tpmpass, unlock_reason)
+        self.timeout = timeout
+        self.req = None
+        # fails right away for invalid URLs
+        self.clients = dict((url, self.acquire(url)) for url in self.tpmurls)
+
+    def acquire(self, url):
+        """Borrow a client of url from the pool."""
+        client = CLIENTS.acquire(url, *self.credentials)
+        client.timeout = self.timeout
+        return client
+
+    def endpoints(self):
+        """Return the endpoints to try in order, without open ones."""
+        healths = [(get_endpoint(url), index) for (index, url) in enumerate(self.tpmurls)]
+        half_open = [endpoint for (endpoint, _) in healths if endpoint.state() == 'half-open']
+        closed = sorted([(endpoint.failures, endpoint.latency or 0.0, index, endpoint) for (endpoint, index) in healths
+                         if endpoint.state() == 'closed'], key=lambda item: item[:3])
+        return half_open + [item[3] for item in closed]
+
+    def call(self, method, *args):
+        error = None
+        for endpoint in self.endpoints():
+            if endpoint.state() == 'half-open' and not endpoint.probe():
+                continue
+            client = self.clients.get(endpoint.url) or self.acquire(endpoint.url)
+            self.clients[endpoint.url] = client
+            client.req = None
+            start = time.time()
+            try:
+                result = getattr(client, method)(*args)
+            except (tpm.TPMException, ValueError) as e:
+                self.req = client.req
+                if not endpoint_failed(client, e):
+                    endpoint.succeeded(time.time() - start)
+                    raise
+                endpoint.failed()
+                # not released, see ClientRegistry.release
+                del self.clients[endpoint.url]
+                display.vvv("tpmstore: {} failed, trying the next endpoint: {}".format(endpoint.url, e))
+                error = e
+                continue
+            self.req = client.req
+            endpoint.succeeded(time.time() - start)
+            return result
+        if error is not None:
+            raise error
+        raise tpm.TPMException("All TeamPasswordManager endpoints failed recently, next try in at most {}s".format(BREAKER_COOLDOWN))
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return lambda *args: self.call(method, *args)
+
+    def release(self):
+        """Return the clients of the endpoints to the pool."""
+        for (url, client) in self.clients.items():
+            CLIENTS.release(client, url, *self.credentials)
+        self.clients = {}
+
+# Default lifetime of cached results in seconds, 0 disables the cache
+CACHE_TTL = 0
+# Maximum of results kept in the cache
+CACHE_MAXSIZE = 512
+# Default seconds an expired result is still returned while it is refreshed, 0 disables it
+STALE_TTL = 0
+
+
+class ResultCache(object):
+    """Bounded LRU cache with a time to live for TeamPasswordManager responses.
+
+    Keys are tuples whose first element is the client scope (see
+    ClientRegistry.key), so credentials never share cached results.
+    """
+
+    def __init__(self, maxsize=CACHE_MAXSIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return a copy of the cached value or None."""
+        return self.lookup(key)[0]
+
+    def lookup(self, key, stale=False):
+        """Return (copy of the cached value, True if it expired) or (None, False).
+
+        Expired values are only returned with stale=True and within the
+        grace period they were stored with.
+        """
+        with self._lock:
+            item = self._data.get(key)
+            now = time.time()
+            if item is not None and item[0] + item[2] < now:
+                del self._data[key]
+                item = None
+            if item is None or (item[0] < now and not stale):
+                self.misses += 1
+                return (None, False)
+            # mark as most recently used
+            del self._data[key]
+            self._data[key] = item
+            self.hits += 1
+            return (copy.deepcopy(item[1]), item[0] < now)
+
+    def set(self, key, value, ttl, grace=0):
+        """Store value for ttl seconds, and grace seconds more as stale value."""
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl, copy.deepcopy(value), max(grace, 0))
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, predicate):
+        """Drop all keys for which predicate(key) is true."""
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self):
+        """Drop all entries and reset the counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return hit/miss counters and the current size."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+RESULTS = ResultCache()
+# Default lifetime of remembered searches without a match, 0 disables it
+NEGATIVE_TTL = 0
+MISSES = ResultCache()
+
+
+class SingleFlight(object):
+    """Coalesce concurrent identical calls into one.
+
+    The first caller of a key runs the call, everybody else calling with
+    the same key meanwhile waits for and shares its result or exception.
+    """
+
+    class Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, on_coalesced=None):
+        """Return fn(), or the result of the running call for key."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self.Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            if on_coalesced is not None:
+                on_coalesced()
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+FLIGHTS = SingleFlight()
+# Keys with a refresh running in the background
+REVALIDATING = set()
+REVALIDATING_LOCK = threading.Lock()
+
+
+def revalidate(key, fn):
+    """Run fn in a background thread, unless a refresh of key is running already."""
+    with REVALIDATING_LOCK:
+        if key in REVALIDATING:
+            return False
+        REVALIDATING.add(key)
+
+    def refresh():
+        try:
+            fn()
+        except Exception as e:
+            # the stale value stays until its grace period ends
+            display.vvv("tpmstore: background refresh failed: {}".format(e))
+        finally:
+            with REVALIDATING_LOCK:
+                REVALIDATING.discard(key)
+
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+    return True
+
+
+# Seconds a deferred write is kept in the shared cache, so forks deferring
+# the same entry later in the run merge into it
+WRITE_TTL = 3600
+# Seconds other forks wait for the one applying a write to the same entry
+WRITE_CLAIM_TTL = 60
+
+
+class WriteQueue(object):
+    """Deferred create=True writes, one per entry name or ID and client scope.
+
+    Later writes to a pending entry are merged into it, a generated password
+    is reused. The writes are applied concurrently when a lookup of the scope
+    reads or writes without deferring, or when the process exits. Results are
+    reported in the order the entries were first deferred.
+
+    Each process queues its own writes. With a shared cache the merged
+    fields of all forks are kept there too, forks use the password the
+    first one generated and apply their writes one at a time, so the forks
+    after the first find the entry unchanged.
+    """
+
+    def __init__(self):
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._defer_lock = threading.Lock()
+        self._registered = None
+
+    def defer(self, th):
+        """Queue the write of th, return the password it will write."""
+        # forked workers must not apply the writes of their parent
+        key = (os.getpid(), th.scope, th.target)
+        random_password = getattr(th, 'password', None) == "random"
+        with self._defer_lock:
+            with self._lock:
+                pending = self._pending.get(key)
+            known = dict(pending.new_entry) if pending is not None else {}
+            if th.shared_cache:
+                known.update(th.shared_cache.get(th, 'write', th.target) or {})
+            if pending is None:
+                self.validate(th, known)
+            if random_password and 'password' in known:
+                # all writers of the entry get the same new password
+                th.password = known['password']
+                th.new_entry['password'] = known['password']
+            else:
+                th.generate_password()
+            if th.shared_cache:
+                shared = th.shared_cache.update(th, 'write', th.target,
+                                                lambda entry: self.merge(entry, th.new_entry, random_password), WRITE_TTL)
+                if random_password:
+                    # another fork may have generated one meanwhile
+                    th.password = shared['password']
+                    th.new_entry['password'] = shared['password']
+            with self._lock:
+                pending = self._pending.get(key)
+                if pending is None:
+                    self._pending[key] = th
+                    self.register()
+                else:
+                    pending.new_entry.update(th.new_entry)
+                    for attribute in ('password', 'project_id'):
+                        if hasattr(th, attribute):
+                            setattr(pending, attribute, getattr(th, attribute))
+        display.vvv("tpmstore: deferred write of {}".format(th.target))
+        return getattr(th, 'password', None)
+
+    @staticmethod
+    def validate(th, known):
+        """Raise the errors the write is bound to fail with when it is applied."""
+        if hasattr(th, 'password_id') or not hasattr(th, 'name') or 'project_id' in th.new_entry or 'project_id' in known:
+            return
+        try:
+            match = th.find_name(th.name, th.tpmconn)
+        except tpm.TPMException as e:
+            raise AnsibleError(e)
+        if len(match) < 1:
+            raise AnsibleError("To create a complete new entry, project_id is mandatory.")
+        if len(match) > 1:
+            raise AnsibleError("Found more then one match for the entry, please be more specific: {}".format(th.name))
+
+    @staticmethod
+    def merge(entry, new_entry, random_password):
+        """Return the fields deferred for an entry with new_entry added."""
+        entry = entry or {}
+        new_entry = dict(new_entry)
+        if random_password and 'password' in entry:
+            del new_entry['password']
+        entry.update(new_entry)
+        return entry
+
+    @staticmethod
+    def apply(th):
+        """Apply one deferred write with the fields all forks deferred for the entry."""
+        cache = th.shared_cache
+        if not cache:
+            return th.apply_write()
+        while not cache.claim(th, 'write-apply', th.target, WRITE_CLAIM_TTL):
+            time.sleep(0.1)
+        try:
+            shared = cache.get(th, 'write', th.target) or {}
+            th.new_entry.update(shared)
+            for attribute in ('password', 'project_id'):
+                if attribute in shared:
+                    setattr(th, attribute, shared[attribute])
+            return th.apply_write()
+        finally:
+            cache.discard(th, 'write-apply', th.target)
+
+    @staticmethod
+    def forget(th):
+        """Drop the fields deferred for the entry of th, after a write that was not deferred."""
+        if th.shared_cache:
+            th.shared_cache.discard(th, 'write', th.target)
+
+    def register(self):
+        """Flush at exit, forked workers do not run atexit handlers."""
+        if self._registered == os.getpid():
+            return
+        self._registered = os.getpid()
+        import atexit
+        from multiprocessing import util
+        atexit.register(self.flush)
+        util.Finalize(self, self.flush, exitpriority=10)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def pending(self):
+        """True if this process has writes waiting."""
+        with self._lock:
+            return any(key[0] == os.getpid() for key in self._pending)
+
+    def flush(self, scope=None, names=None):
+        """Apply the pending writes of scope, or all, and report their results.
+
+        Results are keyed by entry name, or "ID <id>" for writes by ID. Raise
+        the error of a failed write to one of names, warn about the others.
+        """
+        with self._lock:
+            writes = [(key, th) for (key, th) in self._pending.items()
+                      if key[0] == os.getpid() and (scope is None or key[1] == scope)]
+            for (key, _) in writes:
+                del self._pending[key]
+        if not writes:
+            return OrderedDict()
+
+        def apply_write(th):
+            try:
+                return (self.apply(th), None)
+            except AnsibleError as e:
+                return (None, e)
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(BATCH_WORKERS, len(writes)))
+        try:
+            results = OrderedDict(zip([th.target for (_, th) in writes], pool.map(apply_write, [th for (_, th) in writes])))
+        finally:
+            pool.close()
+            pool.join()
+        failed = None
+        for (name, (written, error)) in results.items():
+            if error is None:
+                display.display('tpmstore: deferred write {} entry "{}" with ID {}'.format(written[0], name, written[1]))
+            elif names and name in names and failed is None:
+                failed = AnsibleError('Deferred write of "{}" failed: {}'.format(name, error))
+            else:
+                display.warning('tpmstore: deferred write of "{}" failed: {}'.format(name, error))
+        if failed is not None:
+            raise failed
+        return results
+
+
+WRITES = WriteQueue()
+
+
+class SharedCache(object):
+    """Encrypted SQLite cache shared by all forks on the controller.
+
+    Every value is encrypted with a key derived from the TeamPasswordManager
+    password and the run id, so the file is useless without both. The run id
+    defaults to the ansible-playbook process, see run_id, and can be set with
+    TPMSTORE_RUN_ID. Keys are stored as HMACs, names of entries never appear
+    in the file.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self._conn = None
+        self._pid = None
+        self._ciphers = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def run_id(environ=None):
+        """Return the id the ansible-playbook process and all its workers share.
+
+        Workers are multiprocessing children of the playbook process, which
+        runs the vars plugins itself, so the run is the pid of the process
+        that started this one, or of this one if it is the top process.
+        """
+        environ = os.environ if environ is None else environ
+        if environ.get('TPMSTORE_RUN_ID'):
+            return environ['TPMSTORE_RUN_ID']
+        import multiprocessing
+        return str(getattr(multiprocessing.current_process(), '_parent_pid', None) or os.getpid())
+
+    def connection(self):
+        """Return the SQLite connection of this process, create the file if needed."""
+        # connections must not be shared with forked children
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            os.close(os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600))
+            import sqlite3
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS results ("
+                         "scope TEXT, kind TEXT, item TEXT, expires REAL, value BLOB, "
+                         "PRIMARY KEY (scope, kind, item))")
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+            self._ciphers = {}
+        return self._conn
+
+    def cipher(self, th):
+        """Return (fernet, hmac key) for the credentials and run of th."""
+        (tpmurl, tpmuser, tpmpass) = (th.tpmurl, th.tpmuser, th.tpmpass)
+        try:
+            from cryptography.fernet import Fernet
+        except ImportError:
+            raise AnsibleError("The shared cache requires the python 'cryptography' package.")
+        salt = "{}|{}|{}".format(self.run_id(th.environ), tpmurl, tpmuser).encode('utf-8')
+        ident = hashlib.sha256(salt + str(tpmpass).encode('utf-8')).hexdigest()
+        if ident not in self._ciphers:
+            secret = hashlib.pbkdf2_hmac('sha256', str(tpmpass).encode('utf-8'), salt, 10000, 64)
+            self._ciphers[ident] = (Fernet(base64.urlsafe_b64encode(secret[:32])), secret[32:])
+        return self._ciphers[ident]
+
+    @staticmethod
+    def _digest(hmac_key, value):
+        return hmac.new(hmac_key, repr(value).encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def get(self, th, kind, item):
+        """Return the decrypted value or None."""
+        (fernet, hmac_key) = self.cipher(th)
+        with self._lock:
+            row = self.connection().execute(
+                "SELECT value FROM results WHERE scope=? AND kind=? AND item=? AND expires>?",
+                (self._digest(hmac_key, th.scope), kind, self._digest(hmac_key, item), time.time())).fetchone()
+        return self._decrypt(fernet, row)
+
+    @staticmethod
+    def _decrypt(fernet, row):
+        if row is None:
+            return None
+        from cryptography.fernet import InvalidToken
+        try:
+            return json.loads(fernet.decrypt(bytes(row[0])).decode('utf-8'))
+        except (InvalidToken, ValueError):
+            # written by another run or corrupted, treat as a miss
+            return None
+
+    def set(self, th, kind, item, value, ttl):
+        """Store value encrypted for ttl seconds."""
+        if ttl <= 0:
+            return
+        (fernet, hmac_key) = self.cipher(th)
+        import sqlite3
+        token = fernet.encrypt(json.dumps(value).encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            conn = self.connection()
+            # a single transaction, readers never see a partial write
+            with conn:
+                conn.execute("DELETE FROM results WHERE expires<=?", (now,))
+                conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                             (self._digest(hmac_key, th.scope), kind, self._digest(hmac_key, item),
+                              now + ttl, sqlite3.Binary(token)))
+
+    def update(self, th, kind, item, change, ttl):
+        """Replace the value by change(value), None if there is none, and return it.
+
+        No other fork reads or writes the file until the new value is stored,
+        so change must not wait for anything.
+        """
+        (fernet, hmac_key) = self.cipher(th)
+        import sqlite3
+        key = (self._digest(hmac_key, th.scope), kind, self._digest(hmac_key, item))
+        now = time.time()
+        with self._lock:
+            conn = self.connection()
+            # the DELETE takes the write lock, so no other fork changes the value in between
+            with conn:
+                conn.execute("DELETE FROM results WHERE expires<=?", (now,))
+                row = conn.execute("SELECT value FROM results WHERE scope=? AND kind=? AND item=?", key).fetchone()
+                value = change(self._decrypt(fernet, row))
+                token = fernet.encrypt(json.dumps(value).encode('utf-8'))
+                conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", key + (now + ttl, sqlite3.Binary(token)))
+        return value
+
+    def claim(self, th, kind, item, ttl):
+        """Store a marker for ttl seconds, True if there was none.
+
+        Of several forks claiming the same item at once, only one gets True.
+        """
+        (fernet, hmac_key) = self.cipher(th)
+        import sqlite3
+        token = fernet.encrypt(json.dumps(True).encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            conn = self.connection()
+            # the DELETE takes the write lock, so no other fork inserts in between
+            with conn:
+                conn.execute("DELETE FROM results WHERE expires<=?", (now,))
+                cursor = conn.execute("INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?, ?)",
+                                      (self._digest(hmac_key, th.scope), kind, self._digest(hmac_key, item),
+                                       now + ttl, sqlite3.Binary(token)))
+            return cursor.rowcount == 1
+
+    def discard(self, th, kind, item):
+        """Drop one value or marker."""
+        (fernet, hmac_key) = self.cipher(th)
+        with self._lock:
+            conn = self.connection()
+            with conn:
+                conn.execute("DELETE FROM results WHERE scope=? AND kind=? AND item=?",
+                             (self._digest(hmac_key, th.scope), kind, self._digest(hmac_key, item)))
+
+    def invalidate(self, th, password_id=None):
+        """Drop all searches, misses and project listings of the scope and the entry password_id."""
+        (fernet, hmac_key) = self.cipher(th)
+        with self._lock:
+            conn = self.connection()
+            with conn:
+                conn.execute("DELETE FROM results WHERE scope=? AND (kind IN ('search', 'miss', 'project') OR "
+                             "(kind='password' AND item=?))",
+                             (self._digest(hmac_key, th.scope), self._digest(hmac_key, password_id)))
+
+
+SHARED_CACHES = {}
+
+
+def get_shared_cache(path):
+    """Return the SharedCache for path, one per process and file."""
+    path = os.path.expanduser(path)
+    if path not in SHARED_CACHES:
+        SHARED_CACHES[path] = SharedCache(path)
+    return SHARED_CACHES[path]
+
+
+# Seconds the token bucket of a run is kept in the shared cache after its last request
+BUCKET_TTL = 3600
+# Seconds a request holds its slot at most, the slots of forks dying mid request expire
+SLOT_TTL = 60
+
+
+class SharedLimits(object):
+    """rate_limit and max_in_flight for all forks of a run, kept in the shared cache.
+
+    Ansible forks a worker per task and host, a limit per process would let
+    each of them send a full burst. The forks take their tokens from one
+    bucket in the shared cache, and each request holds one of max_in_flight
+    slots claimed there.
+    """
+
+    def __init__(self, cache, th, rate, max_in_flight):
+        self.cache = cache
+        self.th = th
+        self.rate = float(rate)
+        self.max_in_flight = max_in_flight
+
+    def take(self, bucket):
+        """Return the bucket with one token taken, or with the delay until there is one."""
+        now = time.time()
+        burst = max(self.rate, 1.0)
+        if bucket is None:
+            bucket = {'tokens': burst, 'refilled': now}
+        tokens = min(burst, bucket['tokens'] + max(0.0, now - bucket['refilled']) * self.rate)
+        if tokens >= 1:
+            return {'tokens': tokens - 1, 'refilled': now, 'delay': 0}
+        return {'tokens': tokens, 'refilled': now, 'delay': (1 - tokens) / self.rate}
+
+    def wait(self):
+        """Block until the run may send the next request."""
+        if self.rate <= 0:
+            return
+        while True:
+            delay = self.cache.update(self.th, 'rate', self.th.tpmurl, self.take, BUCKET_TTL)['delay']
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def acquire(self):
+        """Block until a slot is free, return it."""
+        if self.max_in_flight <= 0:
+            return None
+        while True:
+            for slot in range(self.max_in_flight):
+                if self.cache.claim(self.th, 'in-flight', (self.th.tpmurl, slot), SLOT_TTL):
+                    return slot
+            time.sleep(0.05)
+
+    def release(self, slot):
+        """Free a slot returned by acquire."""
+        if slot is not None:
+            self.cache.discard(self.th, 'in-flight', (self.th.tpmurl, slot))
+
+
+# Where the value of a field comes from, "search" for fields already in the
+# search listing, "show" for fields only show_password returns. Fields not
+# listed here are always taken from show_password.
+FIELD_SOURCES = {
+    'id': 'search',
+    'name': 'search',
+    'project': 'search',
+    'tags': 'search',
+    'access_info': 'search',
+    'username': 'search',
+    'email': 'search',
+    'expiry_date': 'search',
+    'expiry_status': 'search',
+    'archived': 'search',
+    'favorite': 'search',
+    'num_files': 'search',
+    'locked': 'search',
+    'external_sharing': 'search',
+    'updated_on': 'search',
+    'password': 'show',
+    'notes': 'show',
+    'custom_field1': 'show',
+    'custom_field2': 'show',
+}
+
+# Seconds a prefetched project index is used before it gets loaded again
+PREFETCH_TTL = 300
+# Seconds other forks wait for the one loading a project into the shared cache
+PREFETCH_CLAIM_TTL = 60
+
+
+class ProjectIndex(object):
+    """Index by name and ID of the listed entries of one project.
+
+    Pages are added as they arrive, lookups wait only until their name
+    shows up or the index is complete.
+    """
+
+    def __init__(self, project_id):
+        self.project_id = project_id
+        self.created = time.time()
+        self.complete = False
+        self.error = None
+        self.by_name = {}
+        self.by_id = {}
+        self._cond = threading.Condition()
+
+    def add(self, entries):
+        """Add one page of listed entries."""
+        with self._cond:
+            for entry in entries:
+                self.by_name.setdefault(entry.get('name'), []).append(entry)
+                self.by_id[entry.get('id')] = entry
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        """Mark the index as complete, error if loading failed."""
+        with self._cond:
+            self.complete = True
+            self.error = error
+            self._cond.notify_all()
+
+    def lookup(self, name):
+        """Return the entries called name, empty if the project has none."""
+        with self._cond:
+            while name not in self.by_name and not self.complete:
+                self._cond.wait()
+            return list(self.by_name.get(name, []))
+
+    def expired(self):
+        return self.error is not None or time.time() - self.created > PREFETCH_TTL
+
+
+PROJECT_INDEXES = {}
+PROJECT_INDEXES_LOCK = threading.Lock()
+
+
+def prefetch_project(th, project_id):
+    """Return the index of project_id, start loading it if there is none.
+
+    The number of pages is requested first, then the pages are fetched
+    concurrently and added to the index in the order they arrive.
+
+    The index only lives in this process. With a shared cache the complete
+    listing is stored there too, the first fork loads it and the others
+    wait for it. Without one every fork loads the project itself, unless
+    the lookups run in tpmstore-agent.
+    """
+    key = (th.scope, project_id)
+    with PROJECT_INDEXES_LOCK:
+        index = PROJECT_INDEXES.get(key)
+        if index is not None and not index.expired():
+            return index
+        index = PROJECT_INDEXES[key] = ProjectIndex(project_id)
+
+    def get(path):
+        tpmconn = th.acquire()
+        result = th.api(tpmconn, 'get', path)
+        th.release(tpmconn)
+        return result
+
+    def fetch_page(page):
+        return get('projects/{}/passwords/page/{}.json'.format(project_id, page)) or []
+
+    def fetch():
+        count = get('projects/{}/passwords/count.json'.format(project_id)) or {}
+        pages = range(1, int(count.get('num_pages', 0)) + 1)
+        listing = []
+        if pages:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(th.batch_workers, len(pages)))
+            try:
+                for entries in pool.imap_unordered(fetch_page, pages):
+                    index.add(entries)
+                    listing.extend(entries)
+            finally:
+                pool.close()
+        return listing
+
+    def load_shared(cache):
+        # wait while another fork loads the project, load it if none does
+        while True:
+            listing = cache.get(th, 'project', project_id)
+            if listing is not None:
+                index.add(listing)
+                return
+            if cache.claim(th, 'project-load', project_id, PREFETCH_CLAIM_TTL):
+                break
+            time.sleep(0.1)
+        try:
+            cache.set(th, 'project', project_id, fetch(), PREFETCH_TTL)
+        finally:
+            cache.discard(th, 'project-load', project_id)
+
+    def load():
+        try:
+            if th.shared_cache:
+                load_shared(th.shared_cache)
+            else:
+                fetch()
+            index.finish()
+        except Exception as e:
+            display.warning("tpmstore: prefetch of project {} failed: {}".format(project_id, e))
+            index.finish(e)
+
+    loader = threading.Thread(target=load)
+    loader.daemon = True
+    loader.start()
+    return index
+
+
+class IdCache(object):
+    """Mapping of entry names to IDs, kept in a JSON file across runs.
+
+    Only URLs, names and IDs are stored. A mapping is a hint: the entry it
+    points to is checked to still carry the name and forgotten otherwise.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self._ids = None
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write(self, ids):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        # write to a temporary file first, other forks read the file anytime
+        tmp = "{}.{}.tmp".format(self.path, os.getpid())
+        fd = os.open(tmp, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(ids, f)
+        os.rename(tmp, self.path)
+
+    @staticmethod
+    def key(tpmurl, name):
+        return "{}|{}".format(tpmurl, name)
+
+    def get(self, tpmurl, name):
+        """Return the cached ID of name or None."""
+        with self._lock:
+            if self._ids is None:
+                self._ids = self._read()
+            return self._ids.get(self.key(tpmurl, name))
+
+    def set(self, tpmurl, name, password_id):
+        """Remember password_id for name, None forgets the name."""
+        key = self.key(tpmurl, name)
+        with self._lock:
+            if self._ids is not None and self._ids.get(key) == password_id:
+                return
+            # merge with what other processes wrote in the meantime
+            self._ids = self._read()
+            if password_id is None:
+                self._ids.pop(key, None)
+            else:
+                self._ids[key] = password_id
+            try:
+                self._write(self._ids)
+            except (IOError, OSError) as e:
+                display.warning("tpmstore: can not write ID cache {}: {}".format(self.path, e))
+
+
+ID_CACHES = {}
+
+
+def get_id_cache(path):
+    """Return the IdCache for path, one per process and file."""
+    path = os.path.expanduser(path)
+    if path not in ID_CACHES:
+        ID_CACHES[path] = IdCache(path)
+    return ID_CACHES[path]
+
+
+# Iterations of the key derivation of snapshot files
+SNAPSHOT_KDF_ITERATIONS = 100000
+SNAPSHOT_MAGIC = b'TPMSNAP1'
+# HMAC of kind and item, offset and length of the record
+SNAPSHOT_INDEX_ENTRY = struct.Struct('>32sQQ')
+
+
+def snapshot_keys(tpmpass, salt, iterations):
+    """Return (fernet, hmac key) of a snapshot file."""
+    try:
+        from cryptography.fernet import Fernet
+    except ImportError:
+        raise AnsibleError("Snapshots require the python 'cryptography' package.")
+    secret = hashlib.pbkdf2_hmac('sha256', str(tpmpass).encode('utf-8'), salt, iterations, 64)
+    return (Fernet(base64.urlsafe_b64encode(secret[:32])), secret[32:])
+
+
+def write_snapshot(path, tpmpass, entries, searches, meta):
+    """Write an encrypted snapshot file.
+
+    entries maps IDs to full entries as returned by show_password, searches
+    maps normalized searches to lists of IDs. meta can list deleted entries as
+    [ID, time] pairs in 'tombstones'. The file is laid out as
+
+        magic | header length | JSON header | sorted index | records
+
+    every record is a Fernet token of its own and the index holds the HMAC of
+    kind and item of the record, so neither names nor searches can be read
+    without tpmpass. Readers mmap the file and bisect the index.
+    """
+    salt = os.urandom(16)
+    (fernet, hmac_key) = snapshot_keys(tpmpass, salt, SNAPSHOT_KDF_ITERATIONS)
+    names = {}
+    for entry in entries.values():
+        names.setdefault(entry.get('name'), []).append(entry.get('id'))
+    meta = dict(meta)
+    # versions of the entries for the next delta sync
+    meta['entries'] = sorted([password_id, entry.get('updated_on')] for (password_id, entry) in entries.items())
+    records = [('meta', '', meta)]
+    records.extend(('password', password_id, entry) for (password_id, entry) in entries.items())
+    records.extend(('tombstone', password_id, deleted) for (password_id, deleted) in meta.get('tombstones', []))
+    records.extend(('name', name, sorted(ids)) for (name, ids) in names.items())
+    records.extend(('search', search, ids) for (search, ids) in searches.items())
+    tokens = sorted((Snapshot.digest(hmac_key, kind, item), fernet.encrypt(json.dumps(value).encode('utf-8')))
+                    for (kind, item, value) in records)
+    header = json.dumps({'version': 1, 'salt': base64.b64encode(salt).decode('ascii'),
+                         'iterations': SNAPSHOT_KDF_ITERATIONS, 'count': len(tokens),
+                         'check': fernet.encrypt(SNAPSHOT_MAGIC).decode('ascii')}).encode('utf-8')
+    offset = len(SNAPSHOT_MAGIC) + 4 + len(header) + len(tokens) * SNAPSHOT_INDEX_ENTRY.size
+    index = []
+    for (digest, token) in tokens:
+        index.append(SNAPSHOT_INDEX_ENTRY.pack(digest, offset, len(token)))
+        offset += len(token)
+    path = os.path.expanduser(path)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    fd = os.open(tmp, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC + struct.pack('>I', len(header)) + header)
+        f.write(b''.join(index))
+        for (_, token) in tokens:
+            f.write(token)
+    # readers keep their mapping of the old file
+    os.rename(tmp, path)
+
+
+class Snapshot(object):
+    """Read only view of a snapshot file written by write_snapshot."""
+
+    def __init__(self, path, tpmpass):
+        import mmap
+        self.path = os.path.expanduser(path)
+        try:
+            with open(self.path, 'rb') as f:
+                self.stat = os.fstat(f.fileno())
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as e:
+            raise AnsibleError("Can not read snapshot {}: {}".format(self.path, e))
+        if self._map[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise AnsibleError("{} is not a tpmstore snapshot.".format(self.path))
+        start = len(SNAPSHOT_MAGIC) + 4
+        (length,) = struct.unpack('>I', self._map[len(SNAPSHOT_MAGIC):start])
+        header = json.loads(self._map[start:start + length].decode('utf-8'))
+        self.count = header['count']
+        self._index = start + length
+        (self._fernet, self._hmac_key) = snapshot_keys(tpmpass, base64.b64decode(header['salt']), header['iterations'])
+        from cryptography.fernet import InvalidToken
+        try:
+            self._fernet.decrypt(header['check'].encode('ascii'))
+        except InvalidToken:
+            raise AnsibleError("Snapshot {} was not written with this password.".format(self.path))
+        self.meta = self.get('meta', '')
+
+    @staticmethod
+    def digest(hmac_key, kind, item):
+        return hmac.new(hmac_key, "{}:{}".format(kind, item).encode('utf-8'), hashlib.sha256).digest()
+
+    def get(self, kind, item):
+        """Return the record of kind and item or None."""
+        digest = self.digest(self._hmac_key, kind, item)
+        size = SNAPSHOT_INDEX_ENTRY.size
+        (low, high) = (0, self.count)
+        while low < high:
+            middle = (low + high) // 2
+            position = self._index + middle * size
+            (key, offset, length) = SNAPSHOT_INDEX_ENTRY.unpack(self._map[position:position + size])
+            if key == digest:
+                return json.loads(self._fernet.decrypt(self._map[offset:offset + length]).decode('utf-8'))
+            if key < digest:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def changed(self):
+        """True if the file got replaced since it was opened."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return (stat.st_ino, stat.st_mtime) != (self.stat.st_ino, self.stat.st_mtime)
+
+
+class SnapshotClient(object):
+    """Answers the TeamPasswordManager calls of a lookup from a snapshot."""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def list_passwords_search(self, searchstring):
+        # find_name searches for name:[<name>]
+        if searchstring.startswith('name:[') and searchstring.endswith(']'):
+            ids = self.snapshot.get('name', searchstring[len('name:['):-1]) or []
+        else:
+            ids = self.snapshot.get('search', normalize_search(searchstring))
+            if ids is None:
+                raise AnsibleError('Search "{}" is not part of the snapshot {}.'.format(searchstring, self.snapshot.path))
+        return [self.show_password(password_id) for password_id in ids]
+
+    def show_password(self, password_id):
+        entry = self.snapshot.get('password', password_id)
+        if entry is None:
+            if self.snapshot.get('tombstone', password_id) is not None:
+                raise AnsibleError("Entry with ID {} was deleted from TeamPasswordManager.".format(password_id))
+            raise AnsibleError("Entry with ID {} is not part of the snapshot {}.".format(password_id, self.snapshot.path))
+        return entry
+
+
+SNAPSHOTS = {}
+SNAPSHOTS_LOCK = threading.Lock()
+
+
+def get_snapshot(path, tpmpass):
+    """Return the opened snapshot, once per process, file and password."""
+    key = (os.path.expanduser(path), hashlib.sha256(str(tpmpass).encode('utf-8')).hexdigest())
+    with SNAPSHOTS_LOCK:
+        snapshot = SNAPSHOTS.get(key)
+        if snapshot is None or snapshot.changed():
+            snapshot = SNAPSHOTS[key] = Snapshot(path, tpmpass)
+        return snapshot
+
+
+# Unix socket of tpmstore-agent, TPMSTORE_AGENT overrides it, an empty TPMSTORE_AGENT disables the agent
+AGENT_SOCKET = '~/.ansible/tpmstore-agent.sock'
+# Seconds to wait for the answer of the agent
+AGENT_TIMEOUT = 300
+# True in the tpmstore-agent process, which has nobody to tell about its writes
+AGENT_SERVING = False
+# Environment variables the agent uses from its client
+AGENT_ENVIRON = ('TPMSTORE_CACHE_TTL', 'TPMSTORE_NEGATIVE_TTL', 'TPMSTORE_STALE_TTL', 'TPMSTORE_RATE_LIMIT',
+                 'TPMSTORE_MAX_IN_FLIGHT', 'TPMSTORE_RETRIES', 'TPMSTORE_TIMEOUT', 'TPMSTORE_PASSWORD_GENERATOR',
+                 'TPMSTORE_PASSWORD_POLICY', 'TPMSTORE_SHARED_CACHE', 'TPMSTORE_ID_CACHE', 'TPMSTORE_SNAPSHOT')
+
+
+def agent_socket():
+    """Return the path of the agent socket, None if the agent is disabled."""
+    path = os.environ.get('TPMSTORE_AGENT', AGENT_SOCKET)
+    return os.path.expanduser(path) if path else None
+
+
+def ask_agent(terms):
+    """Return the result of the lookup from tpmstore-agent, None if it has to run in this process.
+
+    Deferred writes, profiled lookups and any lookup while this process has
+    deferred writes waiting always run in this process, which applies the
+    writes first. Reads also run here if the agent is not running or fails
+    to answer, writes only if the agent could not be reached.
+    """
+    path = agent_socket()
+    if path is None or os.environ.get('TPMSTORE_PROFILE') or os.environ.get('TPMSTORE_DEFER_WRITES') == 'True':
+        return None
+    if WRITES.pending():
+        return None
+    if any(isinstance(term, six.string_types) and term.split('=')[0] in ('profile', 'defer_writes') for term in terms):
+        return None
+    try:
+        # the password is only sent to a socket of our own
+        if os.stat(path).st_uid != os.getuid():
+            return None
+        environ = dict((key, os.environ[key]) for key in AGENT_ENVIRON if key in os.environ)
+        # the agent shares the shared cache entries of this run
+        environ['TPMSTORE_RUN_ID'] = SharedCache.run_id()
+        request = (json.dumps({'terms': terms, 'environ': environ}) + "\n").encode('utf-8')
+    except (OSError, TypeError, ValueError):
+        return None
+    import socket
+    metrics = LookupMetrics()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(AGENT_TIMEOUT)
+    try:
+        try:
+            sock.connect(path)
+        except (OSError, socket.error):
+            return None
+        try:
+            sock.sendall(request)
+            answer = json.loads(sock.makefile('rb').readline().decode('utf-8'))
+        except (OSError, socket.error, ValueError) as e:
+            if 'create=True' in terms:
+                raise AnsibleError("tpmstore-agent failed during a write, it might have been applied: {}".format(e))
+            display.vvv("tpmstore: agent failed, looking up directly: {}".format(e))
+            return None
+    finally:
+        sock.close()
+    metrics.hit('agent')
+    if METRICS_HOOKS or os.environ.get('TPMSTORE_METRICS'):
+        emit_metrics(metrics.record('agent', 'AnsibleError' if 'error' in answer else None))
+    if 'error' in answer:
+        raise AnsibleError(answer['error'])
+    return answer['result']
+
+
+def invalidate_agent(scope, password_id=None):
+    """Tell tpmstore-agent to forget the results a write in this process could have changed."""
+    path = agent_socket()
+    if path is None or AGENT_SERVING:
+        return
+    import socket
+    request = (json.dumps({'invalidate': {'scope': list(scope), 'password_id': password_id}}) + "\n").encode('utf-8')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(AGENT_TIMEOUT)
+    try:
+        if os.stat(path).st_uid != os.getuid():
+            return
+        sock.connect(path)
+        sock.sendall(request)
+        sock.makefile('rb').readline()
+    except (OSError, socket.error) as e:
+        display.vvv("tpmstore: agent not told about the write: {}".format(e))
+    finally:
+        sock.close()
+
+
+def invalidate_scope(scope, password_id=None):
+    """Forget the results of scope in this process a write to password_id could have changed.
+
+    Any search of the scope might match a created or updated entry, so all
+    of them are dropped together with the entry itself.
+    """
+    RESULTS.invalidate(lambda key: key[0] == scope and
+                       (key[1] == 'search' or (key[1] == 'password' and key[2] == password_id)))
+    MISSES.invalidate(lambda key: key[0] == scope)
+    with PROJECT_INDEXES_LOCK:
+        for key in [key for key in PROJECT_INDEXES if key[0] == scope]:
+            del PROJECT_INDEXES[key]
+
+
+# Default number of threads resolving the entries of a batch lookup
+BATCH_WORKERS = 8
+# Possible values for on_error
+ERROR_POLICIES = ('strict', 'warn', 'ignore')
+
+
+def normalize_search(search):
+    """Collapse whitespace so equivalent searches share a cache key."""
+    return " ".join(search.split())
+
+
+# Character classes of generated passwords, quotes and backslashes are left out
+PASSWORD_CLASSES = OrderedDict([
+    ('lower', 'abcdefghijklmnopqrstuvwxyz'),
+    ('upper', 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'),
+    ('digits', '0123456789'),
+    ('symbols', '!#$%&()*+,-./:;<=>?@[]^_{|}~'),
+])
+PASSWORD_LENGTH = 20
+# Seconds a policy inferred from TeamPasswordManager is kept in the shared cache
+POLICY_TTL = 3600
+# Policies inferred from TeamPasswordManager, per client scope
+POLICIES = {}
+
+
+def generate_local_password(length=PASSWORD_LENGTH, classes=tuple(PASSWORD_CLASSES), exclude=''):
+    """Return a random password with at least one character of every class."""
+    try:
+        from secrets import choice, SystemRandom
+    except ImportError:
+        from random import SystemRandom
+        choice = SystemRandom().choice
+    alphabets = []
+    for name in classes:
+        if name not in PASSWORD_CLASSES:
+            raise AnsibleError("password_classes can only contain {} and not: {}".format(", ".join(PASSWORD_CLASSES), name))
+        alphabet = "".join(char for char in PASSWORD_CLASSES[name] if char not in exclude)
+        if not alphabet:
+            raise AnsibleError("password_exclude leaves no characters of class {}".format(name))
+        alphabets.append(alphabet)
+    if not alphabets:
+        raise AnsibleError("password_classes needs at least one character class.")
+    if length < len(alphabets):
+        raise AnsibleError("password_length has to be at least {} for {} character classes.".format(len(alphabets), len(alphabets)))
+    password = [choice(alphabet) for alphabet in alphabets]
+    everything = "".join(alphabets)
+    password.extend(choice(everything) for _ in range(length - len(alphabets)))
+    SystemRandom().shuffle(password)
+    return "".join(password)
+
+
+def infer_password_policy(sample):
+    """Return (length, classes) of a password generated by TeamPasswordManager."""
+    classes = [name for (name, alphabet) in PASSWORD_CLASSES.items() if any(char in alphabet for char in sample)]
+    return (len(sample), classes or list(PASSWORD_CLASSES))
+
+
+def changed_fields(entry, new_entry):
+    """Return the fields of new_entry which differ from the full entry."""
+    changed = []
+    for (field, value) in new_entry.items():
+        if field == 'project_id':
+            current = (entry.get('project') or {}).get('id')
+        else:
+            current = entry.get(field)
+        if field == 'tags':
+            # the order and spacing of tags does not matter
+            (current, value) = [sorted(tag.strip() for tag in (tags or '').split(',') if tag.strip())
+                                for tags in (current, value)]
+        elif current is None:
+            current = ''
+        if six.text_type(current) != six.text_type(value):
+            changed.append(field)
+    return changed
+
 
 class TermsHost(object):
     
-    def __init__(self, terms):
+    def __init__(self, terms, metrics=None, environ=None):
+        import_tpm()
+        self.metrics = metrics or LookupMetrics()
+        # the agent looks up with the environment of its client
+        self.environ = os.environ if environ is None else environ
         # We need at least 4 parameters: api-url, api-user, api-password, entry name
         if len(terms) < 4:
             raise AnsibleError("At least 4 arguments required.")
         # Fill the mandatory values
         self.tpmurl=terms.pop(0)
+        # several comma separated URLs, the first one is the primary
+        self.tpmurls = [url.strip() for url in self.tpmurl.split(",") if url.strip()] or [self.tpmurl]
+        self.tpmurl = self.tpmurls[0]
         self.tpmuser=terms.pop(0)
         self.tpmpass=terms.pop(0)
         self.work_on_terms(terms)
         self.verify_values()
-        self.match = self.initiate_search()
-    
+        self.set_defaults()
+        # reads and immediate writes see the deferred writes
+        if not (self.create and self.defer_writes):
+            WRITES.flush(self.scope, self.names or [self.target])
+        if self.batch:
+            self.match = None
+        else:
+            self.match = self.initiate_search()
+
+    @property
+    def batch(self):
+        """True if more than one entry is requested."""
+        return len(self.names) > 1 or self.aliases is not None or self.names_from_list
+
     def verify_values(self):
         """Verify the correctness of all the values."""
         # verify if either search or name is set
-        if not hasattr(self, 'name') and not hasattr(self, 'search'):
+        if not hasattr(self, 'name') and not hasattr(self, 'search') and not hasattr(self, 'password_id'):
             raise AnsibleError('Either "name" or "search" have to be set.')
-            
+        if self.batch:
+            if self.create:
+                raise AnsibleError("create=True can only be used with a single entry.")
+            if hasattr(self, 'search'):
+                raise AnsibleError('"search" can not be combined with several names.')
+            if self.multiple:
+                raise AnsibleError("multiple=True can not be combined with several names.")
+            # every name needs the key its value is returned under
+            if self.aliases is not None and len(self.aliases) != len(self.names):
+                raise AnsibleError("A dict of names can not be combined with name= or a list of names.")
+        if self.multiple and self.create:
+            raise AnsibleError("multiple=True can not be combined with create=True.")
+        if self.on_error not in ERROR_POLICIES:
+            raise AnsibleError("on_error can only be one of {} and not: {}".format(", ".join(ERROR_POLICIES), self.on_error))
+        if hasattr(self, 'return_value') and self.fields == []:
+            raise AnsibleError("return_value needs at least one field or '*' and not: {}".format(self.return_value))
+
+    def set_defaults(self):
+        """Set the defaults of all optional values."""
+        # set default return_value to 'password'
+        if not hasattr(self, 'return_value'):
+            self.return_value = 'password'
+        if not hasattr(self, 'cache_ttl'):
+            self.cache_ttl = self.to_seconds('TPMSTORE_CACHE_TTL', self.environ.get('TPMSTORE_CACHE_TTL', CACHE_TTL))
+        if not hasattr(self, 'negative_ttl'):
+            self.negative_ttl = self.to_seconds('TPMSTORE_NEGATIVE_TTL', self.environ.get('TPMSTORE_NEGATIVE_TTL', NEGATIVE_TTL))
+        if not hasattr(self, 'stale_ttl'):
+            self.stale_ttl = self.to_seconds('TPMSTORE_STALE_TTL', self.environ.get('TPMSTORE_STALE_TTL', STALE_TTL))
+        if not hasattr(self, 'rate_limit'):
+            self.rate_limit = self.to_rate('TPMSTORE_RATE_LIMIT', self.environ.get('TPMSTORE_RATE_LIMIT', RATE_LIMIT))
+        if not hasattr(self, 'max_in_flight'):
+            self.max_in_flight = self.to_count('TPMSTORE_MAX_IN_FLIGHT', self.environ.get('TPMSTORE_MAX_IN_FLIGHT', MAX_IN_FLIGHT))
+        if not hasattr(self, 'retries'):
+            self.retries = self.to_count('TPMSTORE_RETRIES', self.environ.get('TPMSTORE_RETRIES', RETRIES))
+        if not hasattr(self, 'timeout'):
+            self.timeout = self.to_seconds('TPMSTORE_TIMEOUT', self.environ.get('TPMSTORE_TIMEOUT', TIMEOUT))
+        self.scheduler = get_scheduler(self.tpmurl, self.rate_limit, self.max_in_flight)
+        if not hasattr(self, 'password_generator'):
+            self.password_generator = self.environ.get('TPMSTORE_PASSWORD_GENERATOR', 'tpm')
+        if not hasattr(self, 'password_policy_source'):
+            self.password_policy_source = self.environ.get('TPMSTORE_PASSWORD_POLICY', 'default')
+        if self.password_generator not in ("tpm", "local"):
+            raise AnsibleError("password_generator can only be tpm or local and not: {}".format(self.password_generator))
+        if self.password_policy_source not in ("default", "tpm"):
+            raise AnsibleError("password_policy can only be default or tpm and not: {}".format(self.password_policy_source))
+        if not hasattr(self, 'password_length'):
+            self.password_length = None
+        if not hasattr(self, 'password_classes'):
+            self.password_classes = None
+        if not hasattr(self, 'password_exclude'):
+            self.password_exclude = ''
+        if not hasattr(self, 'defer_writes'):
+            self.defer_writes = self.to_bool('TPMSTORE_DEFER_WRITES', self.environ.get('TPMSTORE_DEFER_WRITES', 'False'))
+        if not hasattr(self, 'shared_cache'):
+            self.shared_cache = self.environ.get('TPMSTORE_SHARED_CACHE')
+        if self.shared_cache:
+            self.shared_cache = get_shared_cache(self.shared_cache)
+        self.limits = None
+        if self.shared_cache and (self.rate_limit > 0 or self.max_in_flight > 0):
+            self.limits = SharedLimits(self.shared_cache, self, self.rate_limit, self.max_in_flight)
+        if not hasattr(self, 'id_cache'):
+            self.id_cache = self.environ.get('TPMSTORE_ID_CACHE')
+        if self.id_cache:
+            self.id_cache = get_id_cache(self.id_cache)
+        if not hasattr(self, 'snapshot'):
+            self.snapshot = self.environ.get('TPMSTORE_SNAPSHOT')
+        if self.snapshot:
+            if self.create:
+                raise AnsibleError("create=True is not possible while reading from a snapshot.")
+            self.snapshot = get_snapshot(self.snapshot, self.tpmpass)
+            # the snapshot is local already, nothing to cache
+            self.cache_ttl = 0
+            self.negative_ttl = 0
+            self.shared_cache = None
+            self.id_cache = None
+            self.prefetch_project = None
+            self.scheduler = None
+        # entries shown during this lookup
+        self.shown = {}
+
     def work_on_terms(self, terms):
         """Collect all the terms."""
         self.create = False
         self.new_entry = {}
+        self.names = []
+        self.aliases = None
+        self.names_from_list = False
+        self.prefetch_project = None
+        self.on_error = 'strict'
+        self.batch_workers = BATCH_WORKERS
+        self.multiple = False
+        self.limit = 0
         for term in terms:
-            if "=" in term:
-                (key, value) = term.split("=")
+            # several names at once, as list or as dict of alias: name
+            if isinstance(term, dict):
+                self.aliases = self.aliases or []
+                for (alias, name) in term.items():
+                    if alias in self.aliases:
+                        raise AnsibleError('The key "{}" is given more than once.'.format(alias))
+                    self.aliases.append(alias)
+                    self.names.append(name)
+                    self.name = name
+            elif isinstance(term, (list, tuple)):
+                self.names_from_list = True
+                for name in term:
+                    self.names.append(name)
+                    self.name = name
+            elif "=" in term:
+                # values like password_exclude can contain "=" themselves
+                (key, value) = term.split("=", 1)
                 # entry name is mandatory
                 if key == "name":
                     # get entry
                     self.name = value
+                    self.names.append(value)
                     self.new_entry.update({'name': self.name})
+                if key == "on_error":
+                    self.on_error = value
+                if key == "batch_workers":
+                    try:
+                        self.batch_workers = max(1, int(value))
+                    except ValueError:
+                        raise AnsibleError("batch_workers has to be a number and not: {}".format(value))
                 if key == 'search':
                     self.search = value
                 if key == 'return_value':
@@ -182,76 +2313,614 @@ class TermsHost(object):
                     self.new_entry.update({'notes': self.notes})
                 if key == "reason":
                     self.unlock_reason = value
+                if key == "cache_ttl":
+                    self.cache_ttl = self.to_seconds(key, value)
+                if key == "negative_ttl":
+                    self.negative_ttl = self.to_seconds(key, value)
+                if key == "stale_ttl":
+                    self.stale_ttl = self.to_seconds(key, value)
+                if key == "password_generator":
+                    self.password_generator = value
+                if key == "password_policy":
+                    self.password_policy_source = value
+                if key == "password_length":
+                    self.password_length = self.to_count(key, value)
+                if key == "password_classes":
+                    self.password_classes = [name.strip() for name in value.split(",") if name.strip()]
+                if key == "password_exclude":
+                    self.password_exclude = value
+                if key == "defer_writes":
+                    self.defer_writes = self.to_bool(key, value)
+                if key == "multiple":
+                    self.multiple = self.to_bool(key, value)
+                if key == "limit":
+                    self.limit = self.to_count(key, value)
+                if key == "rate_limit":
+                    self.rate_limit = self.to_rate(key, value)
+                if key in ("max_in_flight", "retries"):
+                    setattr(self, key, self.to_count(key, value))
+                if key == "timeout":
+                    self.timeout = self.to_seconds(key, value)
+                if key == "prefetch_project":
+                    self.prefetch_project = value
+                if key == "id":
+                    try:
+                        self.password_id = int(value)
+                    except ValueError:
+                        raise AnsibleError("id has to be a number and not: {}".format(value))
+                if key == "id_cache":
+                    self.id_cache = value
+                if key == "shared_cache":
+                    self.shared_cache = value
+                if key == "snapshot":
+                    self.snapshot = value
                 # project_id is mandatory if no entry exists and create == True
                 if key == "project_id":
                     self.project_id = value
                     self.new_entry.update({'project_id': self.project_id})
 
+    @staticmethod
+    def to_seconds(key, value):
+        """Convert a term value into a number of seconds."""
+        try:
+            return float(value)
+        except ValueError:
+            raise AnsibleError("{} has to be a number of seconds and not: {}".format(key, value))
+
+    @staticmethod
+    def to_rate(key, value):
+        """Convert a term value into a number of requests per second."""
+        try:
+            return float(value)
+        except ValueError:
+            raise AnsibleError("{} has to be a number of requests per second and not: {}".format(key, value))
+
+    @staticmethod
+    def to_bool(key, value):
+        """Convert a term value of True or False."""
+        if value not in ("True", "False"):
+            raise AnsibleError("{} can only be True or False and not: {}".format(key, value))
+        return value == "True"
+
+    @staticmethod
+    def to_count(key, value):
+        """Convert a term value into a number of at least 0."""
+        try:
+            return max(0, int(value))
+        except ValueError:
+            raise AnsibleError("{} has to be a number and not: {}".format(key, value))
+
+    @property
+    def scope(self):
+        """Cache scope of this lookup, same as its client pool key."""
+        return ClientRegistry.key(self.tpmurl, self.tpmuser, self.tpmpass, getattr(self, 'unlock_reason', None))
+
     def initiate_search(self):
-        # format the search to get an exact result for name
-        if hasattr(self, 'search'):
-            search = self.search
+        self.tpmconn = self.acquire()
+        # deferred writes search when they are applied
+        if self.create and self.defer_writes:
+            return None
+        # all matches are streamed by resolve_matches
+        if self.multiple:
+            return None
+        # the ID is known, no need to search
+        if hasattr(self, 'password_id'):
+            return [{'id': self.password_id}]
+        try:
+            if hasattr(self, 'search'):
+                return self.find(self.search)
+            return self.find_name(self.name)
+        except tpm.TPMException as e:
+            # not released, see ClientRegistry.release
+            self.tpmconn = None
+            raise AnsibleError(e)
+
+    def acquire(self):
+        """Borrow a client for this lookup from the pool."""
+        if self.snapshot:
+            return SnapshotClient(self.snapshot)
+        try:
+            if len(self.tpmurls) > 1:
+                # writes and the reads they are based on only go to the primary
+                return FailoverClient(self.tpmurls, self.tpmuser, self.tpmpass, getattr(self, 'unlock_reason', None),
+                                      write=self.create, timeout=self.timeout or None)
+            client = CLIENTS.acquire(self.tpmurl, self.tpmuser, self.tpmpass, getattr(self, 'unlock_reason', None))
+            client.timeout = self.timeout or None
+            return client
+        except tpm.TpmApiv4.ConfigError as e:
+            raise AnsibleError("First argument has to be a valid URL to TeamPasswordManager API: {}".format(",".join(self.tpmurls)))
+
+    def release(self, tpmconn):
+        """Return a client borrowed with acquire."""
+        if isinstance(tpmconn, SnapshotClient):
+            return
+        if isinstance(tpmconn, FailoverClient):
+            return tpmconn.release()
+        CLIENTS.release(tpmconn, self.tpmurl, self.tpmuser, self.tpmpass, getattr(self, 'unlock_reason', None))
+
+    def find_name(self, name, tpmconn=None):
+        """Return all entries called name.
+
+        The prefetched project and the ID cache are tried before searching.
+        """
+        if self.prefetch_project is not None:
+            match = prefetch_project(self, self.prefetch_project).lookup(name)
+            if match:
+                self.metrics.hit('prefetch')
+                return match
+        if self.id_cache:
+            password_id = self.id_cache.get(self.tpmurl, name)
+            if password_id is not None:
+                try:
+                    entry = self.show_password(password_id, tpmconn)
+                except tpm.TPMException:
+                    entry = None
+                if entry and entry.get('name') == name:
+                    self.metrics.hit('id_cache')
+                    return [entry]
+                # deleted or renamed
+                self.id_cache.set(self.tpmurl, name, None)
+        match = self.find("name:[{}]".format(name), tpmconn)
+        if self.id_cache and len(match) == 1:
+            self.id_cache.set(self.tpmurl, name, match[0].get('id'))
+        return match
+
+    def find(self, search, tpmconn=None):
+        """Return all entries matching search, from the cache if possible.
+
+        Searches without a match are only remembered for negative_ttl
+        seconds, the entry might get created any moment.
+        """
+        tpmconn = tpmconn or self.tpmconn
+        item = normalize_search(search)
+        key = (self.scope, 'miss', item)
+        # writes must not rely on a remembered miss
+        if self.negative_ttl > 0 and not self.create:
+            if MISSES.get(key) or (self.shared_cache and self.shared_cache.get(self, 'miss', item)):
+                self.metrics.hit('negative')
+                return []
+        match = self.cached('search', item, lambda: self.api(tpmconn, 'list_passwords_search', search),
+                            lambda: self.detached('list_passwords_search', search))
+        if not match and self.negative_ttl > 0:
+            MISSES.set(key, True, self.negative_ttl)
+            if self.shared_cache:
+                self.shared_cache.set(self, 'miss', item, True, self.negative_ttl)
+        return match
+
+    def show_password(self, password_id, tpmconn=None):
+        """Return the full entry, from the cache if possible."""
+        if password_id not in self.shown:
+            tpmconn = tpmconn or self.tpmconn
+            self.shown[password_id] = self.cached('password', password_id, lambda: self.api(tpmconn, 'show_password', password_id),
+                                                  lambda: self.detached('show_password', password_id))
+        return self.shown[password_id]
+
+    @property
+    def fields(self):
+        """Requested fields, None for all fields of the entry."""
+        if self.return_value == '*':
+            return None
+        return [field.strip() for field in self.return_value.split(",") if field.strip()]
+
+    def value(self, entry, tpmconn=None):
+        """Return the return_value of a listed entry, fetch the full entry only if needed.
+
+        Several fields or '*' return a dict, built from a single show_password.
+        """
+        fields = self.fields
+        if fields is not None and all(FIELD_SOURCES.get(field) == 'search' and field in entry for field in fields):
+            result = entry
         else:
-            search = "name:[{}]".format(self.name)
-        # set default return_value to 'password'
-        if not hasattr(self, 'return_value'):
-            self.return_value = 'password'
-            
+            result = self.show_password(entry.get("id"), tpmconn)
+        if fields is None:
+            return result
+        if len(fields) > 1:
+            return dict((field, result.get(field)) for field in fields)
+        return result.get(fields[0])
+
+    def resolve(self, name):
+        """Return the return_value of the entry called name, on a client of its own."""
+        tpmconn = self.acquire()
         try:
-            if hasattr(self, "unlock_reason"):
-                self.tpmconn = tpm.TpmApiv4(self.tpmurl, username=self.tpmuser, password=self.tpmpass, unlock_reason=self.unlock_reason)
+            match = self.find_name(name, tpmconn)
+            if len(match) < 1:
+                raise AnsibleError("Found no match for: {}".format(name))
+            if len(match) > 1:
+                raise AnsibleError("Found more then one match for the entry, please be more specific: {}".format(name))
+            return self.value(match[0], tpmconn)
+        except tpm.TPMException as e:
+            tpmconn = None
+            raise AnsibleError(e)
+        finally:
+            if tpmconn is not None:
+                self.release(tpmconn)
+
+    def resolve_all(self):
+        """Resolve all requested names concurrently, return values in input order.
+
+        Every name is only resolved once. Failing entries raise, warn or
+        are returned as None depending on on_error.
+        """
+        unique = []
+        for name in self.names:
+            if name not in unique:
+                unique.append(name)
+
+        def safe_resolve(name):
+            try:
+                return (self.resolve(name), None)
+            except AnsibleError as e:
+                return (None, e)
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(self.batch_workers, len(unique)))
+        try:
+            results = dict(zip(unique, pool.map(safe_resolve, unique)))
+        finally:
+            pool.close()
+            pool.join()
+        values = []
+        for name in self.names:
+            (value, error) = results[name]
+            if error is not None:
+                if self.on_error == 'strict':
+                    raise error
+                if self.on_error == 'warn':
+                    display.warning("tpmstore: {}".format(error))
+            values.append(value)
+        return values
+
+    def search_pages(self, search):
+        """Yield the entries matching search as the pages of the listing arrive.
+
+        The number of pages is requested first, then the pages are fetched
+        concurrently and yielded in order. With a limit only the pages
+        needed for it are fetched.
+        """
+        if self.snapshot:
+            for entry in self.find(search):
+                yield entry
+            return
+        path = 'passwords/search/{}'.format(quote_plus(search))
+        count = self.api(self.tpmconn, 'get', '{}/count.json'.format(path)) or {}
+        num_pages = int(count.get('num_pages', 0))
+        if self.limit and count.get('num_items_per_page'):
+            per_page = int(count['num_items_per_page'])
+            num_pages = min(num_pages, (self.limit + per_page - 1) // per_page)
+        if num_pages < 1:
+            return
+
+        def fetch_page(page):
+            tpmconn = self.acquire()
+            result = self.api(tpmconn, 'get', '{}/page/{}.json'.format(path, page))
+            self.release(tpmconn)
+            return result or []
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(self.batch_workers, num_pages))
+        try:
+            for entries in pool.imap(fetch_page, range(1, num_pages + 1)):
+                for entry in entries:
+                    yield entry
+        finally:
+            pool.terminate()
+
+    def resolve_matches(self):
+        """Return the return_value of every entry matching the search, in listing order.
+
+        Entries are shown on a pool of batch_workers while further pages are
+        still arriving, with at most twice as many shows pending at a time.
+        Entries failing to show raise, warn or are left out depending on
+        on_error.
+        """
+        search = getattr(self, 'search', None) or "name:[{}]".format(self.name)
+
+        def value(entry):
+            tpmconn = self.acquire()
+            try:
+                return (self.value(entry, tpmconn), None)
+            except (AnsibleError, tpm.TPMException, ValueError) as e:
+                return (None, e)
+            finally:
+                self.release(tpmconn)
+
+        values = []
+
+        def collect(result):
+            (entry_value, error) = result.get()
+            if error is not None:
+                message = "tpmstore: {}".format(error)
+                if self.on_error == 'strict':
+                    raise AnsibleError(message)
+                if self.on_error == 'warn':
+                    display.warning(message)
             else:
-                self.tpmconn = tpm.TpmApiv4(self.tpmurl, username=self.tpmuser, password=self.tpmpass)
-            match = self.tpmconn.list_passwords_search(search)
-        except tpm.TpmApiv4.ConfigError as e:
-            raise AnsibleError("First argument has to be a valid URL to TeamPasswordManager API: {}".format(self.tpmurl))
+                values.append(entry_value)
+
+        from collections import deque
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(self.batch_workers)
+        pending = deque()
+        try:
+            for (number, entry) in enumerate(self.search_pages(search)):
+                if self.limit and number >= self.limit:
+                    break
+                pending.append(pool.apply_async(value, (entry,)))
+                if len(pending) >= 2 * self.batch_workers:
+                    collect(pending.popleft())
+            while pending:
+                collect(pending.popleft())
         except tpm.TPMException as e:
             raise AnsibleError(e)
-        return match
+        finally:
+            pool.terminate()
+        return values
+
+    def api(self, tpmconn, method, *args):
+        """Call a method of the TeamPasswordManager client through the scheduler and record its metrics."""
+        def attempt():
+            start = time.time()
+            try:
+                result = getattr(tpmconn, method)(*args)
+            except Exception:
+                self.metrics.call(method, time.time() - start, 0, error=True)
+                raise
+            seconds = time.time() - start
+            try:
+                size = len(json.dumps(result)) if result is not None else 0
+            except (TypeError, ValueError):
+                size = 0
+            self.metrics.call(method, seconds, size)
+            return result
+
+        if self.scheduler is None:
+            return attempt()
+        return self.scheduler.call(tpmconn, attempt, method in IDEMPOTENT_CALLS, self.retries, self.limits)
+
+    def detached(self, method, *args):
+        """Call a method of the TeamPasswordManager client on a client of its own.
+
+        For background threads, which must not share the client of the lookup.
+        """
+        tpmconn = self.acquire()
+        result = self.api(tpmconn, method, *args)
+        # only reached on success, see ClientRegistry.release
+        self.release(tpmconn)
+        return result
+
+    @property
+    def target(self):
+        """Name, search or ID the lookup is for, for messages."""
+        if hasattr(self, 'name'):
+            return self.name
+        if hasattr(self, 'search'):
+            return self.search
+        return "ID {}".format(self.password_id)
+
+    @property
+    def must_be_fresh(self):
+        """True if stale results must not be used, for writes and locked entries."""
+        return self.create or hasattr(self, 'unlock_reason')
+
+    def cached(self, kind, item, fetch, refresh=None):
+        """Return a cached result, else call fetch and cache what it returns.
+
+        The in-process cache is checked first, then the shared cache. A result
+        expired less than stale_ttl seconds ago is returned right away and
+        refreshed in the background with refresh.
+        """
+        key = (self.scope, kind, item)
+        coalesced = lambda: self.metrics.hit('coalesced')
+        if self.cache_ttl <= 0:
+            return FLIGHTS.do(key, fetch, coalesced)
+        allow_stale = refresh is not None and self.stale_ttl > 0 and not self.must_be_fresh
+        (value, stale) = RESULTS.lookup(key, allow_stale)
+        if value is not None:
+            if stale:
+                self.metrics.hit('stale')
+                revalidate(key, lambda: FLIGHTS.do(key, lambda: self._load(key, refresh)))
+            else:
+                self.metrics.hit('memory')
+            return value
+        return FLIGHTS.do(key, lambda: self._load(key, fetch), coalesced)
+
+    def _load(self, key, fetch):
+        """Get a result from the shared cache or fetch and cache it."""
+        (_, kind, item) = key
+        if self.shared_cache:
+            value = self.shared_cache.get(self, kind, item)
+            if value is not None:
+                self.metrics.hit('shared')
+                RESULTS.set(key, value, self.cache_ttl, self.stale_ttl)
+                return value
+        value = fetch()
+        if value:
+            RESULTS.set(key, value, self.cache_ttl, self.stale_ttl)
+            if self.shared_cache:
+                self.shared_cache.set(self, kind, item, value, self.cache_ttl)
+        return value
+
+    def invalidate(self, password_id=None):
+        """Forget cached results a write to password_id could have changed.
+
+        The caches of this process, the shared cache and the one of
+        tpmstore-agent are cleared, see invalidate_scope.
+        """
+        self.shown.pop(password_id, None)
+        invalidate_scope(self.scope, password_id)
+        if self.shared_cache:
+            self.shared_cache.invalidate(self, password_id)
+        invalidate_agent(self.scope, password_id)
+
+    def generate_password(self):
+        """Replace password=random by a generated password."""
+        if getattr(self, 'password', None) == "random":
+            if self.password_generator == 'local':
+                (length, classes) = self.password_policy()
+                new_password = generate_local_password(length, classes, self.password_exclude)
+            else:
+                new_password = self.api(self.tpmconn, 'generate_password').get("password")
+            self.new_entry.update({'password': new_password})
+            self.password = new_password
+
+    def password_policy(self):
+        """Return (length, classes) for local passwords.
+
+        With password_policy=tpm, whatever is not given is inferred from one
+        password TeamPasswordManager generates, once per process, or once per
+        run with a shared cache.
+        """
+        (length, classes) = (self.password_length, self.password_classes)
+        if self.password_policy_source == 'tpm' and (length is None or classes is None):
+            inferred = POLICIES.get(self.scope)
+            if inferred is None and self.shared_cache:
+                inferred = self.shared_cache.get(self, 'policy', '')
+            if inferred is None:
+                inferred = infer_password_policy(self.api(self.tpmconn, 'generate_password').get("password"))
+                if self.shared_cache:
+                    self.shared_cache.set(self, 'policy', '', inferred, POLICY_TTL)
+            POLICIES[self.scope] = inferred
+            (length, classes) = (length or inferred[0], classes or inferred[1])
+        return (length or PASSWORD_LENGTH, classes or list(PASSWORD_CLASSES))
+
+    def write(self):
+        """Create the entry, or update the one matching entry, return the password."""
+        # If there are no entries and we should create
+        if len(self.match) < 1:
+            display.display("No entry found, will create: {}".format(self.name))
+            if not hasattr(self, "project_id"):
+                raise AnsibleError("To create a complete new entry, project_id is mandatory.")
+            self.generate_password()
+            try:
+                newid = self.api(self.tpmconn, 'create_password', self.new_entry)
+                # older tpm versions return the created entry, newer ones only its ID
+                if isinstance(newid, dict):
+                    newid = newid.get('id')
+                display.display("Created new entry with ID: {}".format(newid))
+                self.written = ('created', newid)
+                return getattr(self, 'password', None)
+            except tpm.TPMException as e:
+                raise AnsibleError(e)
+            finally:
+                self.invalidate()
+        if len(self.match) > 1:
+            raise AnsibleError("Found more then one match for the entry, please be more specific: {}".format(self.name))
+        # compare with the current entry, not a cached one
+        try:
+            result = self.api(self.tpmconn, 'show_password', self.match[0].get("id"))
+        except tpm.TPMException as e:
+            raise AnsibleError(e)
+        self.generate_password()
+        if not changed_fields(result, self.new_entry):
+            display.display('Entry "{}" with ID "{}" is unchanged'.format(result.get("name"), result.get("id")))
+            self.written = ('unchanged', result.get("id"))
+            return getattr(self, 'password', None)
+        display.display('Will update entry "{}" with ID "{}"'.format(result.get("name"), result.get("id")))
+        try:
+            self.api(self.tpmconn, 'update_password', result.get("id"), self.new_entry)
+            self.written = ('updated', result.get("id"))
+            return getattr(self, 'password', None)
+        except tpm.TPMException as e:
+            raise AnsibleError(e)
+        finally:
+            self.invalidate(result.get("id"))
+
+    def apply_write(self):
+        """Search and write a deferred write, on a client of its own."""
+        self.tpmconn = self.acquire()
+        try:
+            self.shown = {}
+            if hasattr(self, 'password_id'):
+                self.match = [{'id': self.password_id}]
+            else:
+                self.match = self.find_name(self.name)
+            self.write()
+            return self.written
+        except tpm.TPMException as e:
+            self.tpmconn = None
+            raise AnsibleError(e)
+        finally:
+            self.close()
+
+    def close(self):
+        """Return the client to the pool so the next lookup can reuse it."""
+        if getattr(self, 'tpmconn', None) is not None:
+            self.release(self.tpmconn)
+            self.tpmconn = None
 
 
 class LookupModule(LookupBase):
 
     def run(self, terms, variables=None, **kwargs):
-        ret = []
-        th = TermsHost(terms)
+        result = ask_agent(terms)
+        if result is not None:
+            return result
+        return self.lookup(terms)
 
-        # If there are no entries and we should create
-        if len(th.match) < 1 and th.create == True:
-            display.display("No entry found, will create: {}".format(th.name))
-            if hasattr(th, "project_id"):
-                if hasattr(th, "password"):
-                    if th.password == "random":
-                        new_password = th.tpmconn.generate_password().get("password")
-                        th.new_entry.update({'password': new_password})
-                        th.password = new_password
-                try:
-                    newid = th.tpmconn.create_password(th.new_entry)
-                    display.display("Created new entry with ID: {}".format(newid.get('id')))
-                    ret = [th.password]
-                except tpm.TPMException as e:
-                    raise AnsibleError(e)
+    def lookup(self, terms, environ=None):
+        """Run the lookup in this process, with environ instead of os.environ if given."""
+        metrics = LookupMetrics()
+        profiler = get_profiler(terms)
+        profiling = profiler is not None and profiler.start()
+        th = None
+        error = None
+        try:
+            th = TermsHost(terms, metrics, environ)
+            return self._run(th)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            if th is not None:
+                th.close()
+            if profiling:
+                profiler.stop(self.lookup_kind(th))
+            if METRICS_HOOKS or os.environ.get('TPMSTORE_METRICS'):
+                emit_metrics(metrics.record(self.lookup_kind(th), error))
+
+    @staticmethod
+    def lookup_kind(th):
+        """Kind of lookup for the metrics, e.g. name or create."""
+        if th is None:
+            return 'invalid'
+        if th.create:
+            return 'create'
+        if th.batch:
+            return 'batch'
+        if th.multiple:
+            return 'multiple'
+        if hasattr(th, 'password_id'):
+            return 'id'
+        if hasattr(th, 'search'):
+            return 'search'
+        return 'name'
+
+    def _run(self, th):
+        ret = []
+        if th.batch:
+            values = th.resolve_all()
+            if th.aliases is not None:
+                return [dict(zip(th.aliases, values))]
+            return values
+        if th.multiple:
+            return th.resolve_matches()
+        if th.create == True:
+            if th.defer_writes:
+                ret = [WRITES.defer(th)]
             else:
-                raise AnsibleError("To create a complete new entry, project_id is mandatory.")
-        elif len(th.match) < 1 and th.create == False:
-            raise AnsibleError("Found no match for: {}".format(th.name))
+                ret = [th.write()]
+                WRITES.forget(th)
+        elif len(th.match) < 1:
+            raise AnsibleError("Found no match for: {}".format(th.target))
         elif len(th.match) > 1:
-            raise AnsibleError("Found more then one match for the entry, please be more specific: {}".format(th.name))
-        elif th.create == True:
-            result = th.tpmconn.show_password(th.match[0].get("id"))
-            display.display('Will update entry "{}" with ID "{}"'.format(result.get("name"), result.get("id")))
-            if hasattr(th, "password"):
-                if th.password == "random":
-                    new_password = th.tpmconn.generate_password().get("password")
-                    th.new_entry.update({'password': new_password})
-                    th.password = new_password
+            raise AnsibleError("Found more then one match for the entry, please be more specific: {}".format(th.target))
+        else:
             try:
-                th.tpmconn.update_password(result.get("id"),th.new_entry)
-                ret = [th.password]
+                ret = [th.value(th.match[0])]
             except tpm.TPMException as e:
                 raise AnsibleError(e)
-        else:
-            result = th.tpmconn.show_password(th.match[0].get("id"))
-            ret = [result.get(th.return_value)]
+
+        if th.cache_ttl > 0:
+            display.vvv("tpmstore cache: {}".format(RESULTS.stats()))
 
         return ret
@@ -0,0 +1,203 @@
+#
+# tpmstore - TeamPasswordManager lookup plugin for Ansible.
+# Copyright (C) 2017 Andreas Hubert
+# See LICENSE.txt for licensing details
+#
+# Heavy imports are deferred, see tpmstore.import_tpm()
+from ansible.errors import AnsibleError
+from ansible.module_utils import six
+from ansible.plugins.vars import BaseVarsPlugin
+import os
+"""
+DOCUMENTATION:
+    vars: tpmstore_vars
+    short_description: Attaches TeamPasswordManager entries as host and group variables.
+    requirements:
+      - enabled in configuration
+      - a tpmstore.yml next to the inventory, or TPMSTORE_VARS set to its path
+    description:
+      - Maps the hosts and groups of the inventory to entries in TeamPasswordManager, by name, search or ID.
+        When the variables of the first host or group are asked for, the entries of all hosts and groups
+        of the inventory are looked up at once, concurrently, with the options of the tpmstore lookup.
+        Every distinct lookup is only made once.
+      - Ansible loads the tpmstore lookup as a module of its own, so the plugins do not share clients or
+        in-process caches. Only the shared_cache file and tpmstore-agent are shared with the lookups of the play,
+        the entries the vars plugin stores in the shared_cache file in the ansible-playbook process are read by
+        its forks.
+      - "{host} in a spec of hosts is replaced by the inventory hostname, {group} in a spec of groups by the group name."
+      - The password is taken from tpmpass in the file, which can be vault encrypted, or from TPMSTORE_PASSWORD.
+EXAMPLES:
+  # ansible.cfg
+  #   [defaults]
+  #   vars_plugins_enabled = host_group_vars,tpmstore_vars
+  #
+  # tpmstore.yml next to the inventory
+  tpmurl: https://MyTpmHost.example.com
+  tpmuser: ansible
+  on_error: warn
+  workers: 16
+  # any option of the lookup, as name=value terms
+  options:
+    prefetch_project: 4
+    cache_ttl: 300
+  hosts:
+    ansible_password: "{host} root"
+    ansible_user:
+      name: "{host} root"
+      return_value: username
+  groups:
+    webservers:
+      db_password:
+        search: "tags:{group}-db"
+"""
+
+# Config file looked for in the inventory directory
+CONFIG_FILE = 'tpmstore.yml'
+# Keys of a spec passed to the lookup
+SPEC_KEYS = ('name', 'search', 'id', 'return_value')
+
+
+def spec_terms(spec, **names):
+    """Return the lookup terms of a spec, with placeholders replaced by names.
+
+    A spec is the name of an entry, or a dict with name, search or id and
+    optionally return_value.
+    """
+    if isinstance(spec, six.string_types):
+        spec = {'name': spec}
+    if not isinstance(spec, dict) or not any(key in spec for key in ('name', 'search', 'id')):
+        raise AnsibleError("tpmstore_vars: a spec needs name, search or id and not: {}".format(spec))
+    try:
+        return tuple("{}={}".format(key, six.text_type(spec[key]).format(**names)) for key in SPEC_KEYS if key in spec)
+    except (KeyError, IndexError, ValueError) as e:
+        raise AnsibleError("tpmstore_vars: invalid placeholder {} in spec {}, only {} can be used here".format(
+            e, spec, ", ".join("{" + name + "}" for name in names)))
+
+
+class InventoryResolver(object):
+    """Looks up the variables of all hosts and groups of an inventory with one config.
+
+    Resolved variables are kept per host and group name, a host added later,
+    e.g. by meta: refresh_inventory, is resolved when asked for.
+    """
+
+    def __init__(self, config):
+        self.tpmurl = config.get('tpmurl')
+        self.tpmuser = config.get('tpmuser')
+        self.tpmpass = config.get('tpmpass') or os.environ.get('TPMSTORE_PASSWORD')
+        if not self.tpmurl or not self.tpmuser or not self.tpmpass:
+            raise AnsibleError("tpmstore_vars: tpmurl, tpmuser and tpmpass or TPMSTORE_PASSWORD are mandatory.")
+        from tpmstore import tpmstore
+        self.workers = max(1, int(config.get('workers', tpmstore.BATCH_WORKERS)))
+        self.on_error = config.get('on_error', 'strict')
+        if self.on_error not in tpmstore.ERROR_POLICIES:
+            raise AnsibleError("on_error can only be one of {} and not: {}".format(", ".join(tpmstore.ERROR_POLICIES), self.on_error))
+        self.options = ["{}={}".format(key, value) for (key, value) in sorted((config.get('options') or {}).items())]
+        self.host_specs = config.get('hosts') or {}
+        self.group_specs = config.get('groups') or {}
+        # host or group name: variables
+        self.hosts = {}
+        self.groups = {}
+        # lookup terms: value
+        self.values = {}
+
+    def host_terms(self, host):
+        return dict((var, spec_terms(spec, host=host)) for (var, spec) in self.host_specs.items())
+
+    def group_terms(self, group):
+        return dict((var, spec_terms(spec, group=group)) for (var, spec) in (self.group_specs.get(group) or {}).items())
+
+    def resolve(self, hosts, groups):
+        """Look up the variables of all hosts and groups not resolved yet."""
+        hosts = [host for host in hosts if host not in self.hosts]
+        groups = [group for group in groups if group not in self.groups]
+        wanted = dict((('host', host), self.host_terms(host)) for host in hosts)
+        wanted.update((('group', group), self.group_terms(group)) for group in groups)
+        pending = sorted(set(terms for variables in wanted.values() for terms in variables.values()
+                             if terms not in self.values))
+        self.values.update(self.lookup_all(pending))
+        for ((kind, name), variables) in wanted.items():
+            resolved = dict((var, self.values[terms]) for (var, terms) in variables.items() if self.values[terms] is not None)
+            (self.hosts if kind == 'host' else self.groups)[name] = resolved
+
+    def lookup_all(self, pending):
+        """Run the lookups of pending concurrently, return a dict of terms to value.
+
+        Failing lookups raise, warn or are left out depending on on_error.
+        """
+        if not pending:
+            return {}
+        from tpmstore import tpmstore
+
+        def lookup(terms):
+            try:
+                value = tpmstore.LookupModule().run([self.tpmurl, self.tpmuser, self.tpmpass] + list(terms) + self.options)
+                return (terms, value[0], None)
+            except Exception as e:
+                return (terms, None, e)
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(self.workers, len(pending)))
+        try:
+            results = pool.map(lookup, pending)
+        finally:
+            pool.close()
+            pool.join()
+        values = {}
+        for (terms, value, error) in results:
+            if error is not None:
+                message = "tpmstore_vars: {} failed: {}".format(", ".join(terms), error)
+                if self.on_error == 'strict':
+                    raise AnsibleError(message)
+                if self.on_error == 'warn':
+                    tpmstore.display.warning(message)
+            values[terms] = value
+        return values
+
+
+# config file path: InventoryResolver
+RESOLVERS = {}
+
+
+def is_host(entity):
+    return hasattr(entity, 'get_groups')
+
+
+def inventory_of(entity):
+    """Return (hosts, groups) names of the whole inventory the entity belongs to."""
+    if is_host(entity):
+        groups = entity.get_groups()
+    else:
+        groups = [entity] + list(entity.get_ancestors())
+    for group in groups:
+        if group.name == 'all':
+            return ([host.name for host in group.get_hosts()],
+                    [group.name] + sorted(child.name for child in group.get_descendants()))
+    # not part of a reconciled inventory
+    if is_host(entity):
+        return ([entity.name], [])
+    return ([], [entity.name])
+
+
+class VarsModule(BaseVarsPlugin):
+
+    REQUIRES_ENABLED = True
+
+    def get_vars(self, loader, path, entities):
+        if not isinstance(entities, list):
+            entities = [entities]
+        super(VarsModule, self).get_vars(loader, path, entities)
+        config_path = os.environ.get('TPMSTORE_VARS') or os.path.join(self._basedir, CONFIG_FILE)
+        if not os.path.exists(config_path):
+            return {}
+        config_path = os.path.realpath(config_path)
+        resolver = RESOLVERS.get(config_path)
+        if resolver is None:
+            resolver = RESOLVERS[config_path] = InventoryResolver(loader.load_from_file(config_path) or {})
+        data = {}
+        for entity in entities:
+            resolved = resolver.hosts if is_host(entity) else resolver.groups
+            if entity.name not in resolved:
+                resolver.resolve(*inventory_of(entity))
+            data.update(resolved.get(entity.name, {}))
+        return data